@@ -0,0 +1,70 @@
+import os
+import time
+
+from util.analysis_cache import LocalAnalysisCache, NullAnalysisCache, analysis_cache_key, file_sha256
+
+
+def counting_compute(result, cacheable=True):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return result, cacheable
+    return compute, calls
+
+
+def test_key_depends_on_every_input(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(b"video bytes")
+    video_hash = file_sha256(str(path))
+    key = analysis_cache_key(video_hash, "model", "describe", {"temperature": 0.7})
+
+    assert key == analysis_cache_key(video_hash, "model", "describe", {"temperature": 0.7})
+    assert key != analysis_cache_key(video_hash, "other", "describe", {"temperature": 0.7})
+    assert key != analysis_cache_key(video_hash, "model", "describe.", {"temperature": 0.7})
+    assert key != analysis_cache_key(video_hash, "model", "describe", {"temperature": 0.2})
+    assert key != analysis_cache_key(file_sha256(__file__), "model", "describe", {"temperature": 0.7})
+
+
+def test_result_is_computed_once(tmp_path):
+    cache = LocalAnalysisCache(str(tmp_path))
+    compute, calls = counting_compute({"description": "[0:01] A cat"})
+
+    assert cache.get_or_compute("k", compute) == {"description": "[0:01] A cat"}
+    assert cache.get_or_compute("k", compute) == {"description": "[0:01] A cat"}
+    assert len(calls) == 1
+    assert cache.stats() == {"hits": 1, "misses": 1}
+
+
+def test_bypass_and_failures_skip_the_cache(tmp_path):
+    cache = LocalAnalysisCache(str(tmp_path))
+    compute, calls = counting_compute({"description": "ok"})
+    cache.get_or_compute("k", compute)
+    cache.get_or_compute("k", compute, bypass=True)
+    assert len(calls) == 2
+
+    failing, failing_calls = counting_compute({"description": "Error: failed"}, cacheable=False)
+    cache.get_or_compute("bad", failing)
+    cache.get_or_compute("bad", failing)
+    assert len(failing_calls) == 2
+
+
+def test_expired_entries_are_misses_and_evicted(tmp_path):
+    cache = LocalAnalysisCache(str(tmp_path), ttl_seconds=60, max_entries=2)
+    old = time.time() - 120
+    with open(tmp_path / "old.json", "w") as f:
+        f.write('{"created_at": %f, "result": "a"}' % old)
+    os.utime(tmp_path / "old.json", (old, old))
+    assert cache.get("old") is None
+
+    cache.put("b", "b")
+    cache.put("c", "c")
+    assert sorted(os.listdir(tmp_path)) == ["b.json", "c.json"]
+
+
+def test_null_cache_always_computes():
+    cache = NullAnalysisCache()
+    compute, calls = counting_compute("x")
+    cache.get_or_compute("k", compute)
+    cache.get_or_compute("k", compute)
+    assert len(calls) == 2
@@ -0,0 +1,36 @@
+import os
+import json
+import subprocess
+
+from util.segment_render import run_ffmpeg, ffprobe_binary
+from util.analysis_proxy import make_analysis_proxy, proxy_path_for
+
+
+def probe(path):
+    command = [ffprobe_binary(), "-v", "error", "-show_entries", "stream=codec_type,height,channels,avg_frame_rate:format=duration", "-of", "json", path]
+    return json.loads(subprocess.run(command, capture_output=True, check=True).stdout)
+
+
+def test_proxy_is_small_and_keeps_the_timeline(tmp_path):
+    video_path = str(tmp_path / "video.mp4")
+    run_ffmpeg([
+        "-f", "lavfi", "-i", "testsrc2=size=1280x720:rate=30:duration=4",
+        "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=48000:duration=4",
+        "-c:v", "libx264", "-preset", "ultrafast", "-crf", "10", "-c:a", "aac", "-ac", "2", "-shortest", video_path,
+    ])
+
+    proxy_path = make_analysis_proxy(video_path)
+
+    assert proxy_path == proxy_path_for(video_path)
+    assert os.path.getsize(proxy_path) < os.path.getsize(video_path)
+    info = probe(proxy_path)
+    streams = {stream["codec_type"]: stream for stream in info["streams"]}
+    assert streams["video"]["height"] == 360
+    assert streams["video"]["avg_frame_rate"] == "1/1"
+    assert streams["audio"]["channels"] == 1
+    assert abs(float(info["format"]["duration"]) - float(probe(video_path)["format"]["duration"])) < 1.1
+
+    # Built once per job
+    mtime = os.path.getmtime(proxy_path)
+    assert make_analysis_proxy(video_path) == proxy_path
+    assert os.path.getmtime(proxy_path) == mtime
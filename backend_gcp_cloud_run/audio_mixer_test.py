@@ -0,0 +1,106 @@
+import os
+import wave
+import numpy as np
+
+from util import audio_mixer
+from util.segment_render import run_ffmpeg
+
+
+def test_fades_are_linear_ramps():
+    samples = np.ones((4, 2), dtype=np.float32)
+
+    faded_in = audio_mixer.fade_in(samples, 4, sample_rate=1)
+    faded_out = audio_mixer.fade_out(samples, 4, sample_rate=1)
+
+    assert faded_in[:, 0].tolist() == [0.0, 0.25, 0.5, 0.75]
+    assert faded_out[:, 0].tolist() == [1.0, 0.75, 0.5, 0.25]
+    # The input buffer is never modified in place
+    assert samples.min() == 1.0
+
+
+def test_overlay_applies_gain_offset_and_truncates():
+    a = np.full((3, 2), 0.5, dtype=np.float32)
+    b = np.full((3, 2), 0.25, dtype=np.float32)
+
+    mixed = audio_mixer.overlay(4, [(a, 0, 1.0), (b, 2, 2.0), (b, 10, 1.0)], sample_rate=1)
+
+    assert mixed[:, 0].tolist() == [0.5, 0.5, 1.0, 0.5]
+
+
+def test_peak_and_gain():
+    samples = np.array([[0.1, -0.4], [0.2, 0.3]], dtype=np.float32)
+
+    assert audio_mixer.peak(samples) == np.float32(0.4)
+    assert audio_mixer.peak(np.zeros((0, 2), dtype=np.float32)) == 0.0
+    assert audio_mixer.gain_to(0.8, 0.4) == 2.0
+    assert audio_mixer.gain_to(0.8, 0) == 1.0
+
+
+def test_timeline_render_and_write_wav(tmp_path):
+    timeline = audio_mixer.AudioTimeline()
+    timeline.append(audio_mixer.silence(0.5))
+    timeline.append(np.full((22050, 2), 2.0, dtype=np.float32))
+    path = str(tmp_path / "mix.wav")
+
+    audio_mixer.write_wav(path, timeline.render())
+
+    assert timeline.duration == 1.0
+    with wave.open(path) as f:
+        assert f.getnframes() == 44100
+        assert f.getnchannels() == 2
+        frames = np.frombuffer(f.readframes(f.getnframes()), dtype="<i2")
+    # Out of range samples are clipped instead of wrapping around
+    assert frames.max() == 32767
+
+
+def test_pcm16_to_samples_resamples_mono_to_stereo():
+    pcm = (np.array([0, 16384, -16384, 0], dtype="<i2")).tobytes()
+
+    same_rate = audio_mixer.pcm16_to_samples(pcm, 44100)
+    assert same_rate.shape == (4, 2)
+    assert same_rate[1, 0] == same_rate[1, 1] == 0.5
+
+    upsampled = audio_mixer.pcm16_to_samples(pcm * 100, 22050)
+    assert upsampled.shape == (800, 2)
+    assert np.isclose(upsampled[2, 0], 0.5)
+
+
+def test_decode_audio_bytes(tmp_path):
+    path = str(tmp_path / "tone.wav")
+    samples = np.full((4410, 2), 0.25, dtype=np.float32)
+    audio_mixer.write_wav(path, samples)
+    with open(path, "rb") as f:
+        decoded = audio_mixer.decode_audio_bytes(f.read())
+
+    assert decoded.shape == (4410, 2)
+    assert np.allclose(decoded, 0.25, atol=1e-3)
+
+
+def make_tone_video(path, duration):
+    run_ffmpeg([
+        "-f", "lavfi", "-i", f"color=size=64x64:rate=10:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=44100:duration={duration}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-c:a", "pcm_s16le", "-shortest", path,
+    ])
+    return path
+
+
+def test_extract_audio_in_memory_and_spilled(tmp_path, monkeypatch):
+    path = make_tone_video(str(tmp_path / "tone.mkv"), 2)
+
+    in_memory = audio_mixer.extract_audio(path, 2.0)
+    spilled = audio_mixer.extract_audio(path, 2.0, spill_seconds=1, spill_dir=str(tmp_path / "spill"))
+
+    assert in_memory.shape == (88200, 2)
+    assert isinstance(spilled, np.memmap)
+    assert np.array_equal(in_memory, spilled)
+    # The spill file is unlinked as soon as it is mapped
+    assert os.listdir(tmp_path / "spill") == []
+
+
+def test_extract_audio_past_the_probed_duration(tmp_path):
+    path = make_tone_video(str(tmp_path / "tone.mkv"), 3)
+
+    samples = audio_mixer.extract_audio(path, 1.0)
+
+    assert samples.shape == (132300, 2)
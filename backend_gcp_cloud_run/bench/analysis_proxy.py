@@ -0,0 +1,75 @@
+# Compares sending the upload to Gemini against sending the analysis proxy.
+#
+#   python bench/analysis_proxy.py [video.mp4] [--duration 60] [--gemini]
+#
+# Without a video a synthetic one is generated. --gemini also times a real
+# analysis request for both (needs Vertex AI credentials). Prints JSON.
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util.segment_render import run_ffmpeg
+from util.analysis_proxy import make_analysis_proxy, proxy_profile
+
+
+def synthetic_video(path, duration):
+    run_ffmpeg([
+        "-f", "lavfi", "-i", f"testsrc2=size=1920x1080:rate=30:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={duration}",
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", "20", "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-b:a", "192k", "-shortest", path,
+    ])
+    return path
+
+
+def payload_stats(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    return {"bytes": len(data), "base64_bytes": len(base64.b64encode(data))}
+
+
+def time_gemini(path):
+    from util.gemini import VertexAIUtility
+    from util.llm_instructions import insturctions_combined_format
+    start = time.perf_counter()
+    VertexAIUtility().get_info_from_video(path, insturctions_combined_format, bypass_cache=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("video", nargs="?")
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--gemini", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        video_path = args.video or synthetic_video(os.path.join(work_dir, "source.mp4"), args.duration)
+        proxy_path = os.path.join(work_dir, "proxy.mp4")
+
+        start = time.perf_counter()
+        analysis_path = make_analysis_proxy(video_path, proxy_path)
+        transcode_seconds = time.perf_counter() - start
+
+        report = {
+            "profile": proxy_profile(),
+            "source": payload_stats(video_path),
+            "proxy": payload_stats(analysis_path),
+            "proxy_used": analysis_path != video_path,
+            "transcode_seconds": round(transcode_seconds, 3),
+        }
+        report["payload_ratio"] = round(report["proxy"]["bytes"] / report["source"]["bytes"], 4)
+        if args.gemini:
+            report["source"]["gemini_seconds"] = round(time_gemini(video_path), 3)
+            report["proxy"]["gemini_seconds"] = round(time_gemini(analysis_path), 3)
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
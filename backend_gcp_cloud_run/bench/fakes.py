@@ -0,0 +1,95 @@
+# Local stand-ins for the external services, for offline benchmarks.
+# Storage needs no fake: STORAGE_BACKEND=local keeps buckets on disk.
+import os
+import time
+import asyncio
+
+from util import tts_clients
+from util import text_to_speech
+from util.gemini import VertexAIUtility
+from util.timestamps import format_timestamp
+from util.llm_instructions import instructions_choose_category
+from util.segment_render import run_ffmpeg
+
+SPEECH_DURATIONS = (1.5, 2.5, 4.0)
+
+
+def canned_description(duration, lines, label="clip"):
+    # Evenly spaced lines, each worded differently so the TTS cache misses
+    step = duration / (lines + 1)
+    return "\n".join(
+        f"[{format_timestamp(step * (i + 1))}] In {label}, shot {i + 1} shows a person picking up object number {i + 1}."
+        for i in range(lines)
+    )
+
+
+def canned_speech(directory):
+    # mp3 clips like the ones ElevenLabs returns, one per duration
+    clips = []
+    for duration in SPEECH_DURATIONS:
+        path = os.path.join(directory, f"speech_{duration:g}.mp3")
+        if not os.path.exists(path):
+            run_ffmpeg([
+                "-f", "lavfi", "-i", f"sine=frequency=220:sample_rate=44100:duration={duration}",
+                "-ac", "1", "-c:a", "libmp3lame", "-b:a", "128k", path,
+            ])
+        with open(path, "rb") as f:
+            clips.append(f.read())
+    return clips
+
+
+class FakeVertexAI(VertexAIUtility):
+    # Answers with canned text after a fixed latency. Only the model calls are
+    # replaced, the analysis cache in front of them still runs.
+
+    description = ""
+    category = "Jazz"
+    latency = 0.0
+    calls = 0
+
+    def __init__(self):
+        pass
+
+    def _respond(self, text):
+        FakeVertexAI.calls += 1
+        time.sleep(self.latency)
+        return {"description": text}
+
+    def _get_info_from_video(self, video_path, inst, video_uri=None):
+        if inst == instructions_choose_category:
+            return self._respond(f'```json\n{{"category": "{self.category}"}}\n```')
+        return self._respond(self.description)
+
+    def _gemini_llm(self, prompt, inst):
+        return self._respond(self.description)
+
+
+class FakeElevenLabs():
+    # Streams a canned clip, picked by text length, after a fixed latency
+
+    def __init__(self, clips, latency=0.0, chunk_bytes=4096):
+        self.clips = clips
+        self.latency = latency
+        self.chunk_bytes = chunk_bytes
+        self.calls = 0
+
+    async def generate(self, text, voice, model, output_format):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        audio = self.clips[len(text) % len(self.clips)]
+
+        async def chunks():
+            for start in range(0, len(audio), self.chunk_bytes):
+                yield audio[start:start + self.chunk_bytes]
+        return chunks()
+
+
+def install(description, gemini_latency, tts_clips, tts_latency, category="Jazz"):
+    # Points the pipeline at the fakes, returns the TTS fake for its call count
+    FakeVertexAI.description = description
+    FakeVertexAI.category = category
+    FakeVertexAI.latency = gemini_latency
+    text_to_speech.VertexAIUtility = FakeVertexAI
+    tts = FakeElevenLabs(tts_clips, tts_latency)
+    tts_clients.CLIENT_FACTORIES["ElevenLabs"] = lambda http_client: tts
+    return tts
@@ -0,0 +1,288 @@
+# End-to-end benchmark of main_function, offline.
+#
+#   python bench/pipeline.py [--durations 10,60,600] [--output report.json]
+#
+# Vertex AI and ElevenLabs are replaced by the fakes in bench/fakes.py, with
+# configurable latency, and storage runs on the local backend. Inputs are
+# synthetic ffmpeg videos. Each case runs in its own process so peak RSS is
+# per case. Prints a JSON report: wall time per pipeline stage, peak RSS of the
+# pipeline process, of its largest ffmpeg child and of the whole process tree
+# (sampled), and the subprocesses it started, by program.
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from util.segment_render import run_ffmpeg
+
+
+def synthetic_video(path, duration, size, fps):
+    if not os.path.exists(path):
+        run_ffmpeg([
+            "-f", "lavfi", "-i", f"testsrc2=size={size}:rate={fps}:duration={duration}",
+            "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={duration}",
+            "-c:v", "libx264", "-preset", "veryfast", "-crf", "23", "-g", str(fps * 2), "-pix_fmt", "yuv420p",
+            "-c:a", "aac", "-b:a", "128k", "-shortest", "-movflags", "+faststart", path,
+        ])
+    return path
+
+
+def description_lines(duration, lines_per_minute):
+    return max(3, round(duration / 60 * lines_per_minute))
+
+
+class SubprocessCounter():
+    # Counts every child process by program name. Popen is patched on the
+    # class, so modules that imported it by name are counted too.
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+
+    def install(self):
+        popen_init = subprocess.Popen.__init__
+        counts = self.counts
+
+        def counting_init(popen, args, *rest, **kwargs):
+            program = args if isinstance(args, (str, bytes)) else args[0]
+            counts[os.path.basename(os.fsdecode(program)).split()[0]] += 1
+            popen_init(popen, args, *rest, **kwargs)
+
+        subprocess.Popen.__init__ = counting_init
+
+
+class TreeMemorySampler():
+    # Peak of the summed RSS of this process and all its descendants, read
+    # from /proc every interval. Concurrent ffmpeg children add up here, while
+    # RUSAGE_CHILDREN only reports the largest one. None without /proc.
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_kb = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _processes(self):
+        # pid -> (ppid, rss_kb)
+        processes = {}
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                with open(f"/proc/{name}/status") as f:
+                    fields = dict(line.split(":", 1) for line in f if ":" in line)
+            except OSError:
+                continue
+            rss = fields.get("VmRSS", "0 kB").split()[0]
+            processes[int(name)] = (int(fields["PPid"]), int(rss))
+        return processes
+
+    def sample(self):
+        processes = self._processes()
+        tree = {os.getpid()}
+        added = True
+        while added:
+            added = False
+            for pid, (ppid, _) in processes.items():
+                if ppid in tree and pid not in tree:
+                    tree.add(pid)
+                    added = True
+        total = sum(processes[pid][1] for pid in tree if pid in processes)
+        self.peak_kb = max(self.peak_kb or 0, total)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if os.path.isdir("/proc"):
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+
+class StageTimer():
+    # Wraps the scheduler's stage helpers as the pipeline module sees them.
+    # Seconds are summed, concurrent stages (TTS lines) can add up to more
+    # than the wall time.
+
+    def __init__(self):
+        self.stages = defaultdict(lambda: {"seconds": 0.0, "count": 0})
+
+    def record(self, name, seconds):
+        self.stages[name]["seconds"] += seconds
+        self.stages[name]["count"] += 1
+
+    def install(self, module):
+        stage, run_in_stage = module.stage, module.run_in_stage
+        timer = self
+
+        @asynccontextmanager
+        async def timed_stage(name):
+            async with stage(name):
+                start = time.perf_counter()
+                try:
+                    yield
+                finally:
+                    timer.record(name, time.perf_counter() - start)
+
+        async def timed_run_in_stage(name, func, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await run_in_stage(name, func, *args, **kwargs)
+            finally:
+                timer.record(name, time.perf_counter() - start)
+
+        module.stage = timed_stage
+        module.run_in_stage = timed_run_in_stage
+
+    def report(self):
+        return {name: {"seconds": round(value["seconds"], 3), "count": value["count"]} for name, value in sorted(self.stages.items())}
+
+
+def run_case(args):
+    # Runs in a fresh process with the work directory as cwd. The environment
+    # has to be set before the pipeline modules are imported.
+    os.environ["STORAGE_BACKEND"] = "local"
+    os.environ["LOCAL_STORAGE_DIR"] = os.path.abspath("storage")
+    os.environ["ANALYSIS_CACHE_DIR"] = os.path.abspath("analysis_cache")
+    os.environ["TTS_CACHE_DIR"] = os.path.abspath("tts_cache")
+    os.environ["LOUDNESS_CACHE_DIR"] = os.path.abspath("loudness_cache")
+    os.environ["WORKSPACE_DIR"] = os.path.abspath("workspaces")
+
+    import asyncio
+    import logging
+    from util import text_to_speech
+    from util.Constants import BUCKET_NAME
+    from util.bgaudio import BG_AUDIO_BUCKET
+    from util.gcs_bucket import upload_to_gcs
+    from util.tts_cache import get_tts_cache
+    from util.analysis_cache import get_analysis_cache
+    from bench import fakes
+
+    logging.getLogger().setLevel(logging.WARNING)
+    counter = SubprocessCounter()
+    timer = StageTimer()
+    label = f"case_{args.case:g}s"
+    lines = description_lines(args.case, args.lines_per_minute)
+
+    blob_name = f"{label}.mp4"
+    upload_to_gcs(BUCKET_NAME, args.video, blob_name)
+    if args.bg_music:
+        music_path = os.path.abspath("music.mp3")
+        run_ffmpeg(["-f", "lavfi", "-i", f"sine=frequency=330:sample_rate=44100:duration={args.case + 5}", "-ac", "2", "-c:a", "libmp3lame", music_path])
+        upload_to_gcs(BG_AUDIO_BUCKET, music_path, "Jazz_1.mp3")
+    tts = fakes.install(
+        fakes.canned_description(args.case, lines, label),
+        args.gemini_latency,
+        fakes.canned_speech(os.path.abspath(".")),
+        args.tts_latency,
+    )
+
+    counter.install()
+    timer.install(text_to_speech)
+    sampler = TreeMemorySampler()
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        result = asyncio.run(text_to_speech.main_function(blob_name, args.bg_music))
+    finally:
+        sampler.stop()
+    wall_seconds = time.perf_counter() - start
+
+    return {
+        "duration": args.case,
+        "description_lines": lines,
+        "status": result.get("status"),
+        "message": result.get("message"),
+        "wall_seconds": round(wall_seconds, 3),
+        "stages": timer.report(),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        # Largest child only. Linux keeps the high-water mark across exec, so a
+        # child forked from this process starts out at its size.
+        "peak_child_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        "peak_tree_rss_kb": sampler.peak_kb,
+        "subprocesses": dict(sorted(counter.counts.items())),
+        "gemini_calls": fakes.FakeVertexAI.calls,
+        "tts_calls": tts.calls,
+        "tts_cache": get_tts_cache().stats(),
+        "analysis_cache": get_analysis_cache().stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--durations", default="10,60,600", help="input durations in seconds, comma separated")
+    parser.add_argument("--lines-per-minute", type=float, default=4, help="description lines per minute of video, at least 3")
+    parser.add_argument("--size", default="1280x720")
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--gemini-latency", type=float, default=2.0)
+    parser.add_argument("--tts-latency", type=float, default=0.5)
+    parser.add_argument("--bg-music", action="store_true")
+    parser.add_argument("--inputs", help="directory to keep the synthetic inputs in between runs")
+    parser.add_argument("--output", help="also write the report to this file")
+    parser.add_argument("--case", type=float, help=argparse.SUPPRESS)
+    parser.add_argument("--video", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case is not None:
+        print(json.dumps(run_case(args)))
+        return
+
+    inputs_dir = args.inputs or tempfile.mkdtemp(prefix="bench_inputs_")
+    os.makedirs(inputs_dir, exist_ok=True)
+    cases = []
+    try:
+        for duration in [float(value) for value in args.durations.split(",")]:
+            video = synthetic_video(os.path.abspath(os.path.join(inputs_dir, f"source_{duration:g}s_{args.size}_{args.fps}.mp4")), duration, args.size, args.fps)
+            with tempfile.TemporaryDirectory(prefix="bench_case_") as work_dir:
+                command = [
+                    sys.executable, os.path.abspath(__file__),
+                    "--case", str(duration), "--video", video,
+                    "--lines-per-minute", str(args.lines_per_minute),
+                    "--gemini-latency", str(args.gemini_latency),
+                    "--tts-latency", str(args.tts_latency),
+                ] + (["--bg-music"] if args.bg_music else [])
+                output = subprocess.run(command, cwd=work_dir, env=dict(os.environ, PYTHONPATH=BACKEND_DIR), capture_output=True, check=True).stdout
+                case = json.loads(output.decode().strip().splitlines()[-1])
+                case["input_bytes"] = os.path.getsize(video)
+                cases.append(case)
+                print(f"{duration:g}s: {case['status']} in {case['wall_seconds']}s, peak RSS {case['peak_rss_kb']} kB, {case['peak_tree_rss_kb']} kB with children", file=sys.stderr)
+    finally:
+        if not args.inputs:
+            shutil.rmtree(inputs_dir, ignore_errors=True)
+
+    report = {
+        "config": {
+            "size": args.size,
+            "fps": args.fps,
+            "gemini_latency": args.gemini_latency,
+            "tts_latency": args.tts_latency,
+            "bg_music": args.bg_music,
+            "cpu_count": os.cpu_count(),
+            "env": {name: os.environ[name] for name in ("RENDER_MODE", "PIPELINE_MODE", "SEGMENT_FORMAT", "RENDER_WORKERS") if name in os.environ},
+        },
+        "cases": cases,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import numpy as np
+
+from util import audio_mixer
+from util.bgaudio import MusicLibrary, MusicTrack, BackgroundAudioGenerator
+
+
+class CountingLibrary(MusicLibrary):
+    # Serves a synthetic track instead of downloading from the bucket
+    def __init__(self, samples):
+        super().__init__()
+        self.samples = samples
+        self.loads = 0
+
+    def load(self, gcs_file):
+        self.loads += 1
+        samples = self.samples.copy()
+        samples.flags.writeable = False
+        return samples
+
+
+def ramp(seconds):
+    n = audio_mixer.seconds_to_samples(seconds)
+    mono = np.linspace(0, 1, n, dtype=np.float32)
+    return np.repeat(mono[:, None], 2, axis=1)
+
+
+def test_tracks_are_loaded_once_per_process():
+    library = CountingLibrary(ramp(10))
+
+    first = BackgroundAudioGenerator("Jazz", library)
+    second = BackgroundAudioGenerator("Jazz", library)
+
+    assert library.loads == 1
+    assert first.track is second.track
+
+
+def test_clips_are_views_with_their_own_peak():
+    track = MusicTrack("Jazz_1.mp3", ramp(10))
+
+    clip = track.clip(2, 4)
+
+    assert np.shares_memory(clip.samples, track.samples)
+    assert len(clip.samples) == audio_mixer.seconds_to_samples(2)
+    assert abs(clip.peak - 0.4) < 0.01
+    assert track.peak == track.samples.max()
+
+
+def test_generator_walks_through_the_track_and_wraps():
+    generator = BackgroundAudioGenerator("Jazz", CountingLibrary(ramp(10)))
+
+    assert generator.generate_music_from_collection(4).samples[0, 0] == 0
+    assert abs(generator.generate_music_from_collection(4).samples[0, 0] - 0.4) < 0.01
+    # Only 2 seconds left, so it starts over
+    assert generator.generate_music_from_collection(4).samples[0, 0] == 0
+    assert generator.current_position == 4
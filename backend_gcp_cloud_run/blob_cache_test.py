@@ -0,0 +1,76 @@
+import os
+import threading
+
+import pytest
+
+from util import gcs_bucket
+from util.gcs_bucket import LocalStorage
+from util.blob_cache import BlobCache
+
+
+class CountingStorage(LocalStorage):
+    def __init__(self, root):
+        super().__init__(root)
+        self.downloads = 0
+
+    def download(self, bucket_name, source_blob_name, destination_file_name):
+        self.downloads += 1
+        return super().download(bucket_name, source_blob_name, destination_file_name)
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    storage = CountingStorage(str(tmp_path / "storage"))
+    monkeypatch.setattr(gcs_bucket, "_storage", storage)
+    for name, size in [("sample_video1.mp4", 600), ("sample_video2.mp4", 600)]:
+        source = tmp_path / name
+        source.write_bytes(os.urandom(size))
+        gcs_bucket.upload_to_gcs("bucket", str(source), name)
+    return storage
+
+
+def test_objects_are_downloaded_once(storage, tmp_path):
+    cache = BlobCache(str(tmp_path / "cache"), 10000)
+    paths = []
+    threads = [threading.Thread(target=lambda: paths.append(cache.path("bucket", "sample_video1.mp4"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert storage.downloads == 1
+    assert len(set(paths)) == 1
+    with open(paths[0], "rb") as f:
+        assert f.read() == (tmp_path / "sample_video1.mp4").read_bytes()
+    assert cache.stats() == {"hits": 7, "misses": 1, "bytes": 600}
+
+
+def test_least_recently_used_objects_are_evicted(storage, tmp_path):
+    cache = BlobCache(str(tmp_path / "cache"), 1000)
+    first = cache.path("bucket", "sample_video1.mp4")
+    os.utime(first, (0, os.stat(first).st_mtime))
+    second = cache.path("bucket", "sample_video2.mp4")
+
+    assert not os.path.exists(first)
+    assert os.path.exists(second)
+    assert cache.stats()["bytes"] == 600
+
+
+def test_entries_being_served_are_not_evicted(storage, tmp_path):
+    cache = BlobCache(str(tmp_path / "cache"), 1000)
+    with cache.pinned("bucket", "sample_video1.mp4") as first:
+        os.utime(first, (0, os.stat(first).st_mtime))
+        second = cache.path("bucket", "sample_video2.mp4")
+        assert os.path.exists(first)
+
+    cache.evict()
+    assert not os.path.exists(first)
+    assert os.path.exists(second)
+
+
+def test_missing_objects_leave_nothing_behind(storage, tmp_path):
+    cache = BlobCache(str(tmp_path / "cache"), 1000)
+
+    with pytest.raises(Exception):
+        cache.path("bucket", "missing.mp4")
+    assert os.listdir(tmp_path / "cache") == []
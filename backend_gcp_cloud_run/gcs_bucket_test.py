@@ -0,0 +1,147 @@
+import os
+
+import pytest
+from google.api_core.exceptions import NotFound
+
+from util import gcs_bucket
+from util.gcs_bucket import LocalStorage, GCSStorage, create_storage
+
+
+@pytest.fixture
+def local_storage(tmp_path, monkeypatch):
+    storage = LocalStorage(str(tmp_path / "storage"))
+    monkeypatch.setattr(gcs_bucket, "_storage", storage)
+    return storage
+
+
+def test_local_round_trip(local_storage, tmp_path):
+    source = tmp_path / "video.mp4"
+    source.write_bytes(b"video data")
+
+    assert gcs_bucket.upload_to_gcs("bucket", str(source), "uploads/video.mp4") == "uploads/video.mp4"
+    destination = tmp_path / "downloaded.mp4"
+    gcs_bucket.download_from_gcs("bucket", "uploads/video.mp4", str(destination))
+
+    assert destination.read_bytes() == b"video data"
+    assert gcs_bucket.download_bytes_from_gcs("bucket", "uploads/video.mp4") == b"video data"
+    assert gcs_bucket.generate_signed_url("bucket", "uploads/video.mp4").startswith("file://")
+
+
+def test_local_stream_upload_is_checksummed(local_storage, tmp_path):
+    source = tmp_path / "video.mp4"
+    source.write_bytes(b"video data" * 1000)
+
+    info = gcs_bucket.upload_stream_to_gcs("bucket", iter([b"video data"] * 1000), "video.mp4")
+
+    assert info == gcs_bucket.ObjectInfo(10000, gcs_bucket.file_crc32c(str(source)))
+    assert gcs_bucket.download_bytes_from_gcs("bucket", "video.mp4") == source.read_bytes()
+
+
+def test_failed_local_stream_upload_leaves_nothing(local_storage):
+    def chunks():
+        yield b"video data"
+        raise ConnectionError("client went away")
+
+    with pytest.raises(ConnectionError):
+        gcs_bucket.upload_stream_to_gcs("bucket", chunks(), "video.mp4")
+    assert os.listdir(os.path.join(local_storage.root, "bucket")) == []
+
+
+def test_local_missing_and_deleted_objects_raise_not_found(local_storage, tmp_path):
+    source = tmp_path / "video.mp4"
+    source.write_bytes(b"video data")
+    gcs_bucket.upload_to_gcs("bucket", str(source), "video.mp4")
+    gcs_bucket.delete_from_gcs("bucket", "video.mp4")
+
+    with pytest.raises(NotFound):
+        gcs_bucket.download_from_gcs("bucket", "video.mp4", str(tmp_path / "out.mp4"))
+    with pytest.raises(NotFound):
+        gcs_bucket.delete_from_gcs("bucket", "video.mp4")
+
+
+def test_empty_downloads_are_rejected(local_storage, tmp_path):
+    source = tmp_path / "empty.mp4"
+    source.write_bytes(b"")
+    gcs_bucket.upload_to_gcs("bucket", str(source), "empty.mp4")
+
+    with pytest.raises(Exception, match="Failed to download"):
+        gcs_bucket.download_from_gcs("bucket", "empty.mp4", str(tmp_path / "out.mp4"))
+
+
+def test_local_blob_names_stay_inside_the_root(local_storage):
+    with pytest.raises(ValueError):
+        local_storage.path("bucket", "../../etc/passwd")
+
+
+def test_backend_selection():
+    assert isinstance(create_storage("gcs"), GCSStorage)
+    assert isinstance(create_storage("local"), LocalStorage)
+    with pytest.raises(ValueError):
+        create_storage("s3")
+
+
+def test_sliced_download_fetches_both_ends_first(local_storage, tmp_path, monkeypatch):
+    monkeypatch.setattr(gcs_bucket, "TRANSFER_CHUNK_BYTES", 1000)
+    data = bytes(range(256)) * 40
+    source = tmp_path / "video.mp4"
+    source.write_bytes(data)
+    gcs_bucket.upload_to_gcs("bucket", str(source), "video.mp4")
+
+    reads = []
+    read_range = local_storage.read_range
+    monkeypatch.setattr(local_storage, "read_range", lambda *args: reads.append(args[2:]) or read_range(*args))
+    heads = []
+
+    def on_head(path):
+        with open(path, "rb") as f:
+            heads.append(f.read())
+
+    destination = tmp_path / "downloaded.mp4"
+    gcs_bucket.download_from_gcs("bucket", "video.mp4", str(destination), parallel=True, on_head=on_head)
+
+    assert destination.read_bytes() == data
+    assert sorted(reads[:2]) == [(0, 1000), (10000, 10240)]
+    assert len(reads) == 11
+    assert heads[0][:1000] == data[:1000]
+    assert heads[0][-240:] == data[-240:]
+
+
+def test_small_objects_are_downloaded_whole(local_storage, tmp_path, monkeypatch):
+    source = tmp_path / "video.mp4"
+    source.write_bytes(b"video data")
+    gcs_bucket.upload_to_gcs("bucket", str(source), "video.mp4")
+    monkeypatch.setattr(local_storage, "read_range", None)
+    heads = []
+
+    destination = tmp_path / "downloaded.mp4"
+    gcs_bucket.download_from_gcs("bucket", "video.mp4", str(destination), parallel=True, on_head=heads.append)
+
+    assert destination.read_bytes() == b"video data"
+    assert heads == [str(destination)]
+
+
+def test_sliced_download_verifies_the_checksum(local_storage, tmp_path, monkeypatch):
+    monkeypatch.setattr(gcs_bucket, "TRANSFER_CHUNK_BYTES", 4)
+    source = tmp_path / "video.mp4"
+    source.write_bytes(b"video data")
+    gcs_bucket.upload_to_gcs("bucket", str(source), "video.mp4")
+    info = gcs_bucket.ObjectInfo(10, gcs_bucket.file_crc32c(str(source)))
+    monkeypatch.setattr(local_storage, "stat", lambda *args: info)
+
+    gcs_bucket.download_from_gcs("bucket", "video.mp4", str(tmp_path / "ok.mp4"), parallel=True)
+    source.write_bytes(b"video DATA")
+    gcs_bucket.upload_to_gcs("bucket", str(source), "video.mp4")
+    with pytest.raises(Exception, match="Checksum mismatch"):
+        gcs_bucket.download_from_gcs("bucket", "video.mp4", str(tmp_path / "bad.mp4"), parallel=True)
+
+
+def test_multiple_downloads(local_storage, tmp_path):
+    names = []
+    for i in range(5):
+        source = tmp_path / f"track_{i}.mp3"
+        source.write_bytes(b"track %d" % i)
+        names.append(gcs_bucket.upload_to_gcs("bucket", str(source), f"music/track_{i}.mp3"))
+    destinations = [str(tmp_path / f"out_{i}.mp3") for i in range(5)]
+
+    assert gcs_bucket.download_multiple_from_gcs("bucket", names, destinations) == destinations
+    assert [open(path, "rb").read() for path in destinations] == [b"track %d" % i for i in range(5)]
@@ -0,0 +1,32 @@
+from util import gemini
+from util.gemini import VertexAIUtility
+
+
+def make_utility():
+    # The cached lookup doesn't need an initialized client
+    return VertexAIUtility.__new__(VertexAIUtility)
+
+
+def test_videos_in_cloud_storage_are_sent_by_uri():
+    assert gemini.default_input_mode("gcs") == "uri"
+    assert gemini.default_input_mode("local") == "inline"
+
+
+def test_input_is_only_prepared_on_a_cache_miss(tmp_path, monkeypatch):
+    from util.analysis_cache import LocalAnalysisCache
+    monkeypatch.setattr(gemini, "get_analysis_cache", lambda: LocalAnalysisCache(str(tmp_path), 3600))
+    utility = make_utility()
+    sent = []
+    utility._get_info_from_video = lambda path, inst, uri=None: sent.append((path, uri)) or {"description": "00:01 A kitchen."}
+    prepared = []
+
+    def prepare_input():
+        prepared.append(True)
+        return "proxy.mp4", "gs://bucket/proxy.mp4"
+
+    for _ in range(2):
+        result = utility.get_info_from_video("video.mp4", "Describe", "abc:proxy", prepare_input=prepare_input)
+
+    assert result == {"description": "00:01 A kitchen."}
+    assert prepared == [True]
+    assert sent == [("proxy.mp4", "gs://bucket/proxy.mp4")]
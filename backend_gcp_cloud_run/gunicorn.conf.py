@@ -0,0 +1,7 @@
+# Loaded by gunicorn from the working directory
+
+
+def post_worker_init(worker):
+    # The app is imported by now, start its background work in this worker
+    import main
+    main.on_worker_start()
@@ -0,0 +1,252 @@
+import time
+
+import pytest
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+from util import job_store
+from util.job_store import (
+    InMemoryJobStore,
+    SQLiteJobStore,
+    GCSJobStore,
+    JOB_STATE_PROCESSING,
+    JOB_STATE_COMPLETED,
+    JOB_STATE_ERROR,
+    STATUS_COMPLETED,
+    STATUS_ERROR,
+)
+
+
+class FakeBucket():
+    # Objects are (data, metadata, generation), downloads are counted
+    def __init__(self):
+        self.objects = {}
+        self.downloads = 0
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def list_blobs(self, prefix=""):
+        blobs = []
+        for name in sorted(self.objects):
+            if name.startswith(prefix):
+                blob = FakeBlob(self, name)
+                blob.metadata = self.objects[name][1]
+                blobs.append(blob)
+        return blobs
+
+
+class FakeBlob():
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = None
+        self.generation = None
+
+    def _object(self, if_generation_match=None):
+        if self.name not in self.bucket.objects:
+            raise NotFound(self.name)
+        if if_generation_match is not None and self.bucket.objects[self.name][2] != if_generation_match:
+            raise PreconditionFailed(self.name)
+        return self.bucket.objects[self.name]
+
+    def reload(self):
+        self.generation = self._object()[2]
+
+    def download_as_bytes(self, if_generation_match=None):
+        self.bucket.downloads += 1
+        return self._object(if_generation_match)[0]
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        if if_generation_match is not None:
+            self._object(if_generation_match)
+        generation = self.bucket.objects.get(self.name, (None, None, 0))[2] + 1
+        self.bucket.objects[self.name] = (data.encode(), dict(self.metadata or {}), generation)
+
+    def delete(self):
+        self._object()
+        del self.bucket.objects[self.name]
+
+
+class FakeStorageClient():
+    def __init__(self):
+        self.fake_bucket = FakeBucket()
+
+    def bucket(self, name):
+        return self.fake_bucket
+
+
+@pytest.fixture(params=["memory", "sqlite", "gcs"])
+def store(request, tmp_path, monkeypatch):
+    if request.param == "memory":
+        return InMemoryJobStore()
+    if request.param == "gcs":
+        monkeypatch.setattr(job_store, "get_storage_client", FakeStorageClient)
+        return GCSJobStore("bucket")
+    return SQLiteJobStore(str(tmp_path / "jobs.sqlite3"))
+
+
+def test_create_and_get(store):
+    store.create_job("video_output.mp4", "video.mp4", True)
+    job = store.get("video_output.mp4")
+
+    assert job["state"] == JOB_STATE_PROCESSING
+    assert job["gcs_url"] == "video.mp4"
+    assert job["add_bg_music"] is True
+    assert store.get("missing_output.mp4") is None
+
+
+def test_status_transitions(store):
+    store.create_job("a_output.mp4", "a.mp4", False)
+    store.create_job("b_output.mp4", "b.mp4", False)
+    store.mark_completed("a_output.mp4", "https://signed.example/a")
+    store.mark_error("b_output.mp4")
+
+    assert store.get_status("a_output.mp4") == STATUS_COMPLETED
+    assert store.get_signed_url("a_output.mp4") == "https://signed.example/a"
+    assert store.get_status("b_output.mp4") == STATUS_ERROR
+    assert store.get_signed_url("b_output.mp4") is None
+    assert store.get_status("c_output.mp4", "default") == "default"
+    assert [j["output_video_name"] for j in store.list_by_state(JOB_STATE_COMPLETED)] == ["a_output.mp4"]
+    assert [j["output_video_name"] for j in store.list_by_state(JOB_STATE_ERROR)] == ["b_output.mp4"]
+
+
+def test_claim_orphaned_jobs(store):
+    store.create_job("orphan_output.mp4", "orphan.mp4", False)
+    store.claim("orphan_output.mp4", store.get("orphan_output.mp4")["owner"], "nohost:1")
+    # A process on another host is assumed to be alive while its lease runs
+    assert store.claim_orphaned_jobs() == []
+
+    store.claim("orphan_output.mp4", "nohost:1", None)
+    claimed = store.claim_orphaned_jobs()
+    assert [j["output_video_name"] for j in claimed] == ["orphan_output.mp4"]
+    # The claim is atomic, a second worker gets nothing
+    assert store.claim("orphan_output.mp4", None, "other:2") is False
+
+
+def test_sqlite_store_is_shared_between_connections(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    SQLiteJobStore(path).create_job("shared_output.mp4", "shared.mp4", False)
+
+    assert SQLiteJobStore(path).get("shared_output.mp4")["gcs_url"] == "shared.mp4"
+
+
+def test_delete_older_than(store):
+    store.create_job("old_output.mp4", "old.mp4", False)
+
+    assert store.delete_older_than(3600) == 0
+    assert store.delete_older_than(-1) == 1
+    assert store.get("old_output.mp4") is None
+
+
+def test_wait_for_update(store):
+    import threading
+    job = store.create_job("wait_output.mp4", "wait.mp4", False)
+
+    # Nothing changes, the wait runs out
+    assert store.wait_for_update("wait_output.mp4", job["updated_at"], timeout=0.1)["updated_at"] == job["updated_at"]
+
+    timer = threading.Timer(0.05, lambda: store.update_job("wait_output.mp4", stage="render", progress=60))
+    timer.start()
+    record = store.wait_for_update("wait_output.mp4", job["updated_at"], timeout=5, poll_interval=5)
+    timer.join()
+
+    assert record["stage"] == "render"
+    assert record["progress"] == 60
+
+
+def test_sqlite_adds_progress_columns_to_old_tables(tmp_path):
+    import sqlite3
+    path = str(tmp_path / "jobs.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE jobs (
+            output_video_name TEXT PRIMARY KEY, state TEXT NOT NULL, status TEXT NOT NULL, gcs_url TEXT,
+            add_bg_music INTEGER NOT NULL DEFAULT 0, signed_url TEXT, owner TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL
+        )
+    """)
+    conn.execute("INSERT INTO jobs VALUES ('old_output.mp4', 'processing', 'Processing', 'old.mp4', 0, NULL, NULL, 0, 0)")
+    conn.commit()
+    conn.close()
+
+    store = SQLiteJobStore(path)
+
+    assert store.get("old_output.mp4")["progress"] == 0
+    store.update_job("old_output.mp4", stage="speech", progress=40)
+    assert store.get("old_output.mp4")["stage"] == "speech"
+
+
+def test_updates_only_touch_their_fields(store):
+    store.create_job("video_output.mp4", "video.mp4", True)
+    store.update_job("video_output.mp4", stage="render", progress=50)
+    store.update_job("video_output.mp4", status="Rendering")
+
+    job = store.get("video_output.mp4")
+    assert (job["stage"], job["progress"], job["status"], job["add_bg_music"]) == ("render", 50, "Rendering", True)
+    with pytest.raises(KeyError):
+        store.update_job("missing_output.mp4", status="Rendering")
+    with pytest.raises(ValueError):
+        store.update_job("video_output.mp4", colour="blue")
+
+
+def test_finished_jobs_refuse_late_progress(store):
+    store.create_job("video_output.mp4", "video.mp4", False)
+    store.mark_completed("video_output.mp4", "https://signed.example/video")
+
+    job = store.update_job("video_output.mp4", stage="render", progress=90, status="Rendering the described video (90%)")
+
+    assert (job["state"], job["status"], job["signed_url"], job["progress"]) == (JOB_STATE_COMPLETED, STATUS_COMPLETED, "https://signed.example/video", 0)
+    assert store.get("video_output.mp4") == job
+    # Finishing again is still allowed
+    assert store.mark_error("video_output.mp4")["state"] == JOB_STATE_ERROR
+
+
+def test_expired_leases_are_claimed_whatever_the_host(store, monkeypatch):
+    store.create_job("video_output.mp4", "video.mp4", False)
+    monkeypatch.setattr(job_store, "JOB_LEASE_SECONDS", -1)
+    store.claim("video_output.mp4", store.get("video_output.mp4")["owner"], "otherhost:1")
+    monkeypatch.setattr(job_store, "JOB_LEASE_SECONDS", 120)
+
+    claimed = store.claim_orphaned_jobs()
+
+    assert [j["output_video_name"] for j in claimed] == ["video_output.mp4"]
+    assert store.get("video_output.mp4")["lease_expires_at"] > time.time()
+
+
+def test_leases_are_renewed_until_the_job_finishes(store):
+    store.create_job("video_output.mp4", "video.mp4", False)
+    job = store.get("video_output.mp4")
+
+    store.renew_leases()
+    renewed = store.get("video_output.mp4")
+    assert renewed["lease_expires_at"] >= job["lease_expires_at"]
+    # Renewing isn't a change waiters have to see
+    assert renewed["updated_at"] == job["updated_at"]
+
+    store.mark_completed("video_output.mp4", "https://signed.example/video")
+    assert store._held == set()
+
+
+def test_gcs_lists_and_expires_jobs_from_metadata(monkeypatch):
+    monkeypatch.setattr(job_store, "get_storage_client", FakeStorageClient)
+    store = GCSJobStore("bucket")
+    for name in ("a", "b", "c"):
+        store.create_job(f"{name}_output.mp4", f"{name}.mp4", False)
+    store.mark_completed("a_output.mp4", "https://signed.example/a")
+    store.bucket.downloads = 0
+
+    processing = store.list_by_state(JOB_STATE_PROCESSING)
+
+    assert [j["output_video_name"] for j in processing] == ["b_output.mp4", "c_output.mp4"]
+    assert store.bucket.downloads == 2
+    assert store.delete_older_than(-1) == 3
+    assert store.bucket.downloads == 2
+
+
+def test_gcs_claim_of_a_deleted_job_fails(monkeypatch):
+    monkeypatch.setattr(job_store, "get_storage_client", FakeStorageClient)
+    store = GCSJobStore("bucket")
+    store.create_job("video_output.mp4", "video.mp4", False)
+    owner = store.get("video_output.mp4")["owner"]
+    store.delete_older_than(-1)
+
+    assert store.claim("video_output.mp4", owner, "otherhost:1") is False
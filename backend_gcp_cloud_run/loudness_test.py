@@ -0,0 +1,78 @@
+import os
+import time
+
+import numpy as np
+
+from util.loudness import LoudnessIndex, get_loudness_index
+from util import loudness
+
+
+def make_track():
+    # 10 windows of 4 samples, stereo, with a known peak in each window
+    samples = np.zeros((40, 2), dtype=np.float32)
+    for window, value in enumerate([0.1, 0.5, 0.2, 0.9, 0.3, 0.05, 0.4, 0.6, 0.7, 0.2]):
+        samples[window * 4, 0] = value
+    return samples
+
+
+def test_peak_queries_match_brute_force():
+    samples = make_track()
+    index = LoudnessIndex.from_samples(samples, sample_rate=40, hop_seconds=0.1)
+
+    assert index.max_volume == np.float32(0.9)
+    for first in range(10):
+        for last in range(first + 1, 11):
+            expected = np.abs(samples[first * 4:last * 4]).max()
+            assert index.peak(first / 10, last / 10) == expected
+    assert index.peak(0.5, 0.5) == 0.0
+
+
+def test_rms():
+    samples = np.full((40, 2), 0.5, dtype=np.float32)
+    index = LoudnessIndex.from_samples(samples, sample_rate=40, hop_seconds=0.1)
+
+    assert abs(index.rms() - 0.5) < 1e-6
+    assert abs(index.rms(0.2, 0.6) - 0.5) < 1e-6
+
+
+
+def test_index_is_built_from_a_memmap_in_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(loudness, "LOUDNESS_CHUNK_WINDOWS", 3)
+    samples = np.random.default_rng(0).uniform(-1, 1, (4 * 10 + 3, 2)).astype(np.float32)
+    spilled = np.memmap(tmp_path / "track.f32", dtype=np.float32, mode="w+", shape=samples.shape)
+    spilled[:] = samples
+
+    index = LoudnessIndex.from_samples(spilled, sample_rate=40, hop_seconds=0.1)
+
+    assert len(index.levels[0]) == 11
+    assert index.max_volume == np.abs(samples).max()
+    assert index.peak(1.0, 1.1) == np.abs(samples[40:]).max()
+    assert abs(index.rms(0, 1.0) - np.sqrt(np.mean(np.square(samples[:40], dtype=np.float64)))) < 1e-6
+
+def test_cached_by_key(tmp_path, monkeypatch):
+    monkeypatch.setattr(loudness, "LOUDNESS_CACHE_DIR", str(tmp_path))
+    samples = make_track()
+
+    first = get_loudness_index("3f1c9a:48000", samples, 40)
+    assert get_loudness_index("3f1c9a:48000", samples, 40) is first
+
+    loudness._memory_cache.clear()
+    reloaded = get_loudness_index("3f1c9a:48000", samples, 40)
+    assert reloaded is not first
+    assert reloaded.max_volume == first.max_volume
+    assert reloaded.peak(0.3, 0.7) == first.peak(0.3, 0.7)
+
+
+def test_disk_cache_is_capped(tmp_path, monkeypatch):
+    monkeypatch.setattr(loudness, "LOUDNESS_CACHE_DIR", str(tmp_path))
+    samples = make_track()
+    get_loudness_index("first:40", samples, 40)
+    entry_bytes = sum(os.path.getsize(path) for path in tmp_path.iterdir())
+    old = time.time() - 60
+    for path in tmp_path.iterdir():
+        os.utime(path, (old, old))
+    monkeypatch.setattr(loudness, "LOUDNESS_CACHE_MAX_BYTES", entry_bytes)
+
+    get_loudness_index("second:40", samples, 40)
+
+    assert [path.name for path in tmp_path.iterdir()] == [os.path.basename(loudness._cache_path("second:40"))]
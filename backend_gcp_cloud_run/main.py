@@ -1,5 +1,6 @@
 from flask import Flask, request, jsonify, send_file, Response
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import HTTPException
 import os
 import shutil
 from google.cloud import storage
@@ -7,14 +8,26 @@ import datetime
 from datetime import timedelta
 import logging
 import asyncio
+import time
+import threading
 from util.Constants import BUCKET_NAME
-from util.gcs_bucket import download_from_gcs, download_multiple_from_gcs, upload_to_gcs, get_storage_client
+from util.gcs_bucket import download_from_gcs, download_multiple_from_gcs, upload_stream_to_gcs, generate_signed_url
+from util.multipart_stream import read_multipart
+from util import text_to_speech
 from util.text_to_speech import main_function
+from util.job_store import get_job_store, start_job_housekeeping, STATUS_PROCESSING, JOB_STATE_PROCESSING
+from util.progress import JobProgress, current_progress
+from util.blob_cache import get_blob_cache
+from util.tts_cache import get_tts_cache
+from util.analysis_cache import get_analysis_cache
+from util.metrics import registry as metrics, span
+from util.scheduler import get_scheduler, run_in_stage, SchedulerSaturated
+from util.workspace import start_workspace_sweeper
 import json
 from google.oauth2 import service_account
-processing_status = {}
 
-storage_client = get_storage_client()
+job_store = get_job_store()
+blob_cache = get_blob_cache()
 
 class VideoProcessRequest:
     def __init__(self, video_path: str, add_bg_music: str):
@@ -31,8 +44,6 @@ app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100 MB
 
 VIDDYSCRIBE_API_KEY = os.getenv("VIDDYSCRIBE_API_KEY")
 
-signed_urls = {}
-
 # Add CORS middleware
 from flask_cors import CORS
 CORS(app, resources={r"/*": {"origins": "*"}})
@@ -43,9 +54,73 @@ def verify_api_key():
         return jsonify({"detail": "Invalid API Key"}), 403
 
 
-from concurrent.futures import ThreadPoolExecutor
+scheduler = get_scheduler()
+
+
+def cache_stats():
+    return {
+        "tts": get_tts_cache().stats(),
+        "analysis": get_analysis_cache().stats(),
+        "blob": blob_cache.stats(),
+    }
+
+
+def cache_hits():
+    # The TTS cache counts hits in its shared tier separately
+    return {(name,): stats.get("hits", 0) + stats.get("shared_hits", 0) for name, stats in cache_stats().items()}
+
+
+def cache_misses():
+    return {(name,): stats.get("misses", 0) for name, stats in cache_stats().items()}
+
+
+def cache_hit_ratio():
+    hits, misses = cache_hits(), cache_misses()
+    return {key: hits[key] / (hits[key] + misses[key]) if hits[key] + misses[key] else 0 for key in hits}
+
+
+metrics.gauge("viddyscribe_jobs_queued", "Jobs waiting for a slot in this worker", lambda: scheduler.stats()["queued"])
+metrics.gauge("viddyscribe_jobs_running", "Jobs running in this worker", lambda: scheduler.stats()["running"])
+metrics.counter("viddyscribe_cache_hits_total", "Cache hits", cache_hits, ["cache"])
+metrics.counter("viddyscribe_cache_misses_total", "Cache misses", cache_misses, ["cache"])
+metrics.gauge("viddyscribe_cache_hit_ratio", "Hits over lookups since the worker started", cache_hit_ratio, ["cache"])
+metrics.counter("viddyscribe_render_fallbacks_total", "Segment renders redone by the serial moviepy render", lambda: text_to_speech.render_fallbacks)
+
+
+def queued_status(position):
+    return f"Waiting in queue (position {position}). This may take a few extra minutes. Keep this tab open."
+
+
+def mark_job_started(output_video_name):
+    job_store.update_job(output_video_name, status=STATUS_PROCESSING)
+
+
+def mark_job_queued(output_video_name, position):
+    job_store.update_job(output_video_name, status=queued_status(position))
+
+
+def schedule_job(gcs_url, add_bg_music, output_video_name, force=False):
+    # All jobs run on the scheduler's event loop. Raises SchedulerSaturated
+    # when the queue is full. The queued status is written before the job can
+    # start, so it never replaces the status of a running job.
+    return scheduler.submit(
+        output_video_name, process_video_task, gcs_url, add_bg_music, output_video_name,
+        force=force, on_start=mark_job_started, on_queued=mark_job_queued,
+    )
+
+
+def saturated_response(e):
+    response = jsonify({"detail": "Server is busy, please retry later", "retry_after": e.retry_after})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
 
-executor = ThreadPoolExecutor()
+
+def resume_orphaned_jobs():
+    # Pick up jobs whose worker process died (restart, crash) before finishing
+    for job in job_store.claim_orphaned_jobs():
+        logging.info(f"Resuming orphaned job: {job['output_video_name']}")
+        schedule_job(job["gcs_url"], job["add_bg_music"], job["output_video_name"], force=True)
 
 @app.route("/upload_video", methods=["POST"])
 def upload_video():
@@ -53,26 +128,45 @@ def upload_video():
     if error_response:
         return error_response
 
-    try:
-        add_bg_music = True if request.form.get('add_bg_music') == "true" else False
-        print("Add bg music:"+str(add_bg_music))
-        file = request.files['file']
-        filename = secure_filename(file.filename)
-        file_location = f"/tmp/{filename}"
-        file.save(file_location)
-        
-        gcs_url = upload_to_gcs(BUCKET_NAME, file_location, filename)
+    boundary = request.mimetype_params.get("boundary")
+    if request.mimetype != "multipart/form-data" or not boundary:
+        return jsonify({"detail": "Expected a multipart/form-data upload"}), 400
 
-         # Clean up the temporary file
-        os.remove(file_location)
+    def store_file(field_name, filename, chunks):
+        # The file part goes to storage as it arrives, there is no local copy
+        filename = secure_filename(filename or "")
+        if field_name != "file" or not filename:
+            return None
+        with span("upload_stream"):
+            info = upload_stream_to_gcs(BUCKET_NAME, chunks, filename)
+        logging.info(f"Stored upload {filename}: {info.size} bytes, crc32c {info.crc32c}")
+        return filename
+
+    try:
+        # The body is parsed from the request stream instead of being spooled
+        # by Werkzeug first, so the thread is done as soon as the last byte
+        # reaches storage
+        fields, files = read_multipart(request.stream, boundary.encode("latin-1"), store_file)
+        filename = files.get("file")
+        if not filename:
+            return jsonify({"detail": "A video file is required"}), 400
+        add_bg_music = True if fields.get('add_bg_music') == "true" else False
+        logging.info(f"Add bg music: {add_bg_music}")
+        gcs_url = filename
 
         output_video_name = os.path.splitext(filename)[0] + "_output.mp4"
-        processing_status[output_video_name] = "Processing video... This may take 4-10 minutes. Keep this tab open."
+        job_store.create_job(output_video_name, gcs_url, add_bg_music)
 
-        # Schedule the task in a separate thread
-        executor.submit(asyncio.run, process_video_task(gcs_url, add_bg_music, output_video_name))
+        # Schedule the task on the job scheduler
+        try:
+            position = schedule_job(gcs_url, add_bg_music, output_video_name)
+        except SchedulerSaturated as e:
+            job_store.mark_error(output_video_name, status="Server is busy, please try again later")
+            return saturated_response(e)
         
-        return jsonify({"status": "processing", "gcs_url": gcs_url, "output_video_name": output_video_name})
+        return jsonify({"status": "processing", "gcs_url": gcs_url, "output_video_name": output_video_name, "queue_position": position})
+    except HTTPException as e:
+        return jsonify({"detail": e.description}), e.code
     except Exception as e:
         logging.error(f"Error in /upload_video: {e}")
         return jsonify({"detail": "Internal Server Error"}), 500
@@ -82,37 +176,46 @@ async def process_video_task(gcs_url: str, add_bg_music: str, output_video_name:
     try:
         logging.info(f"Starting to process video: {gcs_url}")
         request = VideoProcessRequest(video_path=gcs_url, add_bg_music=add_bg_music)
-        result = await process_video(request)
+        # Stages report into this, it writes stage and percent to the job
+        progress = JobProgress(output_video_name, job_store)
+        current_progress.set(progress)
+        try:
+            result = await process_video(request)
+        finally:
+            await asyncio.to_thread(progress.close)
         
         if not isinstance(result, dict) or 'status' not in result:
             raise ValueError("Invalid result format from process_video")
 
         if result['status'] == 'error':
             logging.error(f"Error processing video: {result.get('message', 'Unknown error')}")
-            processing_status[output_video_name] = "Error processing video"
+            await asyncio.to_thread(job_store.mark_error, output_video_name)
             return
 
         if 'output_url' not in result:
             logging.error("No output_url in result")
-            processing_status[output_video_name] = "Error processing video"
+            await asyncio.to_thread(job_store.mark_error, output_video_name)
             return
 
         processed_video_filename = os.path.basename(result["output_url"])
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(processed_video_filename)
-        signed_url = blob.generate_signed_url(
-            version="v4",
-            expiration=timedelta(minutes=15),
-            method="GET"
-        )
+        with span("signed_url", job_id=output_video_name):
+            signed_url = await run_in_stage(
+                "upload",
+                generate_signed_url,
+                BUCKET_NAME,
+                processed_video_filename,
+                expiration=timedelta(minutes=15),
+                method="GET"
+            )
         
-        signed_urls[processed_video_filename] = signed_url
-        processing_status[output_video_name] = "Processing completed"
+        # Store writes are network round trips with the GCS store, they run
+        # off the event loop the other jobs share
+        await asyncio.to_thread(job_store.mark_completed, output_video_name, signed_url)
         logging.info(f"Video processing completed: {output_video_name}")
         
     except Exception as e:
         logging.error(f"Error in process_video_task: {str(e)}")
-        processing_status[output_video_name] = "Error processing video"
+        await asyncio.to_thread(job_store.mark_error, output_video_name)
 
 @app.route("/start_processing", methods=["POST"])
 def start_processing():
@@ -131,12 +234,16 @@ def start_processing():
         # Remove the gs:// prefix if it exists
         gcs_url = filename if not filename.startswith('gs://') else filename[5:]
         output_video_name = os.path.splitext(filename)[0] + "_output.mp4"
-        processing_status[output_video_name] = "Processing video... This may take 4-10 minutes. Keep this tab open."
+        job_store.create_job(output_video_name, gcs_url, add_bg_music)
 
-        # Schedule the task in a separate thread
-        executor.submit(asyncio.run, process_video_task(gcs_url, add_bg_music, output_video_name))
+        # Schedule the task on the job scheduler
+        try:
+            position = schedule_job(gcs_url, add_bg_music, output_video_name)
+        except SchedulerSaturated as e:
+            job_store.mark_error(output_video_name, status="Server is busy, please try again later")
+            return saturated_response(e)
         
-        return jsonify({"status": "processing", "output_video_name": output_video_name})
+        return jsonify({"status": "processing", "output_video_name": output_video_name, "queue_position": position})
     except Exception as e:
         logging.error(f"Error in /start_processing: {e}")
         return jsonify({"error": "Internal Server Error"}), 500
@@ -163,12 +270,10 @@ def get_upload_url():
             logging.error(f"Missing filename or content_type. Filename: {filename}, Content-Type: {content_type}")
             return jsonify({"error": "Filename and content type are required"}), 400
 
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(filename)
-
         # Generate a signed URL for uploading
-        url = blob.generate_signed_url(
-            version="v4",
+        url = generate_signed_url(
+            BUCKET_NAME,
+            filename,
             expiration=datetime.timedelta(minutes=15),
             method="PUT",
             content_type=content_type,
@@ -181,10 +286,87 @@ def get_upload_url():
         return jsonify({"error": "Internal Server Error", "details": str(e)}), 500
 
 
+# Requests waiting on a job (long-polls and event streams) hold a worker
+# thread each. All but STATUS_FREE_THREADS of gunicorn's threads may wait, so
+# uploads and downloads always find one. Past that, long-polls answer right
+# away and streams are refused, and clients fall back to plain polling.
+GUNICORN_THREADS = int(os.getenv("GUNICORN_THREADS", 8))
+STATUS_FREE_THREADS = 2
+STATUS_MAX_WAITERS = int(os.getenv("STATUS_MAX_WAITERS", max(GUNICORN_THREADS - STATUS_FREE_THREADS, 1)))
+STATUS_MAX_WAIT_SECONDS = float(os.getenv("STATUS_MAX_WAIT_SECONDS", 25))
+# Streams end after this long, like a long-poll, and EventSource reconnects
+# on its own, resuming from the last event id
+STATUS_STREAM_SECONDS = float(os.getenv("STATUS_STREAM_SECONDS", 25))
+STATUS_STREAM_RETRY_MS = 1000
+STATUS_HEARTBEAT_SECONDS = 15
+status_waiters = threading.BoundedSemaphore(STATUS_MAX_WAITERS)
+
+
+def status_payload(output_video_name, record):
+    if record is None:
+        payload = {"status": "Processing video. This may take 4-10 minutes. Keep this tab open.", "state": JOB_STATE_PROCESSING, "stage": None, "progress": 0, "updated_at": None}
+    else:
+        payload = {
+            "status": record["status"],
+            "state": record["state"],
+            "stage": record.get("stage"),
+            "progress": record.get("progress") or 0,
+            "updated_at": record["updated_at"],
+        }
+    # Only known to the worker process that queued the job
+    position = scheduler.queue_position(output_video_name)
+    if position:
+        payload.update(status=queued_status(position), queue_position=position)
+    return payload
+
+
 @app.route("/update_status/<output_video_name>", methods=["GET"])
 def update_status(output_video_name: str):
-    status = processing_status.get(output_video_name, "Processing video. This may take 4-10 minutes. Keep this tab open.")
-    return jsonify({"status": status})
+    # With ?since=<updated_at>&wait=<seconds> the request is held until the job
+    # changes (a long-poll), instead of the client polling on a timer
+    since = request.args.get("since", type=float)
+    wait = min(request.args.get("wait", 0, type=float), STATUS_MAX_WAIT_SECONDS)
+    if since is not None and wait > 0 and status_waiters.acquire(blocking=False):
+        try:
+            record = job_store.wait_for_update(output_video_name, since, wait)
+        finally:
+            status_waiters.release()
+    else:
+        record = job_store.get(output_video_name)
+    return jsonify(status_payload(output_video_name, record))
+
+
+@app.route("/status_events/<output_video_name>", methods=["GET"])
+def status_events(output_video_name: str):
+    # Server-sent events: a "status" event whenever the job changes, until it
+    # completes or fails
+    if not status_waiters.acquire(blocking=False):
+        response = jsonify({"detail": "Too many status streams, poll /update_status instead"})
+        response.status_code = 503
+        response.headers["Retry-After"] = str(int(STATUS_MAX_WAIT_SECONDS))
+        return response
+    # Set when EventSource reconnects, to the updated_at of the last event it got
+    since = request.headers.get("Last-Event-ID", type=float)
+
+    def events():
+        nonlocal since
+        try:
+            deadline = time.time() + STATUS_STREAM_SECONDS
+            yield f"retry: {STATUS_STREAM_RETRY_MS}\n\n"
+            while time.time() < deadline:
+                record = job_store.wait_for_update(output_video_name, since, min(STATUS_HEARTBEAT_SECONDS, max(deadline - time.time(), 0)))
+                updated_at = record["updated_at"] if record else 0.0
+                if since is None or updated_at > since:
+                    yield f"id: {updated_at}\nevent: status\ndata: {json.dumps(status_payload(output_video_name, record))}\n\n"
+                    since = updated_at
+                else:
+                    yield ": keep-alive\n\n"
+                if record is not None and record["state"] != JOB_STATE_PROCESSING:
+                    return
+        finally:
+            status_waiters.release()
+
+    return Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.route("/process_video", methods=["POST"])
 async def process_video(request):
@@ -210,13 +392,12 @@ def download_sample_videos():
     ui_names = ["Battery", "Smoothie"]
     
     signed_urls = []
-    bucket = storage_client.bucket(bucket_name)
     
     for blob_name, ui_name in zip(source_blob_names, ui_names):
-        blob = bucket.blob(blob_name)
         try:
-            signed_url = blob.generate_signed_url(
-                version="v4",
+            signed_url = generate_signed_url(
+                bucket_name,
+                blob_name,
                 expiration=timedelta(minutes=15),  # URL valid for 15 minutes
                 method="GET"
             )
@@ -230,7 +411,6 @@ def download_sample_videos():
 @app.route("/serve_video/<video_name>", methods=["GET"])
 def serve_video(video_name: str):
     bucket_name = BUCKET_NAME
-    bucket = storage_client.bucket(bucket_name)
     
     # Mapping of UI names to blob names
     video_mapping = {
@@ -242,21 +422,29 @@ def serve_video(video_name: str):
     if not blob_name:
         return jsonify({"detail": "Video not found"}), 404
     
-    blob = bucket.blob(blob_name)
-    
     try:
-        video_data = blob.download_as_bytes()
-        return Response(video_data, mimetype="video/mp4")
+        # Served from the local blob cache, send_file answers Range and
+        # conditional requests (206, 304) from the file without reading it whole.
+        # The entry is pinned until send_file has opened it.
+        with blob_cache.pinned(bucket_name, blob_name) as video_path:
+            response = send_file(video_path, mimetype="video/mp4", conditional=True, etag=True, max_age=3600)
+        response.headers["Accept-Ranges"] = "bytes"
+        return response
     except Exception as e:
         logging.error(f"Error serving video {video_name}: {e}")
         return jsonify({"detail": f"Error serving video {video_name}"}), 500
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/download_video/<file_name>", methods=["GET"])
 def download_video(file_name: str):
     try:
-        # Retrieve the signed URL from the in-memory dictionary
-        signed_url = signed_urls.get(file_name)
+        # Retrieve the signed URL from the job store
+        signed_url = job_store.get_signed_url(file_name)
         if not signed_url:
             return jsonify({"detail": "File not found"}), 404
         
@@ -265,5 +453,16 @@ def download_video(file_name: str):
         logging.error(f"Error retrieving signed URL for {file_name}: {e}")
         return jsonify({"detail": "Error retrieving signed URL"}), 500
 
+def on_worker_start():
+    # Background work of a serving process. Called once per gunicorn worker
+    # from gunicorn.conf.py, not on import, so tools and tests that import
+    # this module don't resume jobs or sweep workspaces.
+    resume_orphaned_jobs()
+    # Keeps the leases of this worker's jobs alive and deletes old jobs
+    start_job_housekeeping(job_store)
+    # Removes scratch files left behind by jobs of crashed workers
+    start_workspace_sweeper()
+
 if __name__ == "__main__":
+    on_worker_start()
     app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
\ No newline at end of file
@@ -12,28 +12,217 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os
 import pytest
+from google.api_core.exceptions import NotFound
 
 import main
+from util import gcs_bucket
+from util.Constants import BUCKET_NAME
+from util.blob_cache import BlobCache
+from util.gcs_bucket import LocalStorage
+from util.job_store import SQLiteJobStore
 
 
 @pytest.fixture
-def client():
+def client(tmp_path, monkeypatch):
+    # Local storage and a throwaway job store, nothing leaves the machine
+    monkeypatch.setattr(gcs_bucket, "_storage", LocalStorage(str(tmp_path / "storage")))
+    monkeypatch.setattr(main, "blob_cache", BlobCache(str(tmp_path / "blob_cache"), 10 * 1024 * 1024))
+    monkeypatch.setattr(main, "job_store", SQLiteJobStore(str(tmp_path / "jobs.sqlite3")))
     main.app.testing = True
     return main.app.test_client()
 
 
-def test_handler_no_env_variable(client):
-    r = client.get("/")
+def upload_sample(tmp_path, name, data):
+    source = tmp_path / name
+    source.write_bytes(data)
+    gcs_bucket.upload_to_gcs(BUCKET_NAME, str(source), name)
+
+
+def test_routes_require_the_api_key(client):
+    r = client.post("/start_processing", json={"filename": "video.mp4"})
+
+    assert r.status_code == 403
+
+
+def test_unknown_job_status(client):
+    r = client.get("/update_status/missing_output.mp4")
+
+    assert r.status_code == 200
+    assert r.json["status"].startswith("Processing video")
+
+
+def test_unknown_download(client):
+    r = client.get("/download_video/missing_output.mp4")
+
+    assert r.status_code == 404
+
+
+def test_sample_video_urls(client):
+    r = client.get("/download_sample_videos")
+
+    assert r.status_code == 200
+    assert [sample["name"] for sample in r.json] == ["Battery", "Smoothie"]
+    assert r.json[0]["url"].endswith("sample_video1.mp4")
+
+
+def test_serve_video_supports_ranges_and_conditional_requests(client, tmp_path):
+    data = bytes(range(256)) * 100
+    upload_sample(tmp_path, "sample_video1.mp4", data)
+
+    r = client.get("/serve_video/Battery", headers={"Range": "bytes=100-199"})
+    assert r.status_code == 206
+    assert r.data == data[100:200]
+    assert r.headers["Content-Range"] == f"bytes 100-199/{len(data)}"
+
+    r = client.get("/serve_video/Battery", headers={"If-None-Match": r.headers["ETag"]})
+    assert r.status_code == 304
+
+
+def test_serve_unknown_video(client):
+    r = client.get("/serve_video/Unknown")
+
+    assert r.status_code == 404
+
+
+def test_metrics(client):
+    r = client.get("/metrics")
+
+    assert r.status_code == 200
+    assert r.mimetype == "text/plain"
+    assert "viddyscribe_jobs_queued 0.0" in r.data.decode()
+    assert 'viddyscribe_cache_hits_total{cache="blob"} 0.0' in r.data.decode()
+    assert "viddyscribe_render_fallbacks_total 0.0" in r.data.decode()
+
+
+def test_status_long_poll_returns_on_update(client):
+    import threading
+    job = main.job_store.create_job("video_output.mp4", "video.mp4", False)
+    timer = threading.Timer(0.1, lambda: main.job_store.update_job("video_output.mp4", stage="speech", progress=40, status="Generating narration (40%). Keep this tab open."))
+    timer.start()
+
+    r = client.get(f"/update_status/video_output.mp4?since={job['updated_at']}&wait=5")
+    timer.join()
+
+    assert r.json["stage"] == "speech"
+    assert r.json["progress"] == 40
+    assert r.json["updated_at"] > job["updated_at"]
+
+
+def test_status_events_stream_until_the_job_finishes(client):
+    import json
+    import threading
+    main.job_store.create_job("video_output.mp4", "video.mp4", False)
+    timer = threading.Timer(0.1, lambda: main.job_store.mark_completed("video_output.mp4", "file:///video_output.mp4"))
+    timer.start()
+
+    r = client.get("/status_events/video_output.mp4")
+    events = [json.loads(line[len("data: "):]) for line in r.get_data(as_text=True).splitlines() if line.startswith("data: ")]
+    timer.join()
+
+    assert r.mimetype == "text/event-stream"
+    assert [event["state"] for event in events] == ["processing", "completed"]
+    assert events[-1]["status"] == "Processing completed"
+
+
+
+def test_status_events_end_early_and_resume(client, monkeypatch):
+    import json
+    monkeypatch.setattr(main, "STATUS_STREAM_SECONDS", 0.2)
+    job = main.job_store.create_job("video_output.mp4", "video.mp4", False)
+
+    r = client.get("/status_events/video_output.mp4")
+    body = r.get_data(as_text=True)
+    assert f"id: {job['updated_at']}" in body
+    assert len([line for line in body.splitlines() if line.startswith("data: ")]) == 1
+
+    # A reconnect gets only what changed since the last event
+    r = client.get("/status_events/video_output.mp4", headers={"Last-Event-ID": str(job["updated_at"])})
+    assert "data: " not in r.get_data(as_text=True)
+
+    main.job_store.mark_completed("video_output.mp4", "file:///video_output.mp4")
+    r = client.get("/status_events/video_output.mp4", headers={"Last-Event-ID": str(job["updated_at"])})
+    events = [json.loads(line[len("data: "):]) for line in r.get_data(as_text=True).splitlines() if line.startswith("data: ")]
+    assert [event["state"] for event in events] == ["completed"]
+
+
+def test_status_waiters_are_capped(client, monkeypatch):
+    import threading
+    monkeypatch.setattr(main, "status_waiters", threading.BoundedSemaphore(1))
+    job = main.job_store.create_job("video_output.mp4", "video.mp4", False)
+    main.status_waiters.acquire()
+    try:
+        r = client.get("/status_events/video_output.mp4")
+        assert r.status_code == 503
+        assert r.headers["Retry-After"]
+
+        # The long-poll answers right away instead of waiting
+        r = client.get(f"/update_status/video_output.mp4?since={job['updated_at']}&wait=25")
+        assert r.status_code == 200
+        assert r.json["updated_at"] == job["updated_at"]
+    finally:
+        main.status_waiters.release()
+
+def test_upload_streams_the_file_to_storage(client, monkeypatch):
+    import io
+    scheduled = []
+    monkeypatch.setattr(main, "schedule_job", lambda *args: scheduled.append(args) or 0)
+    data = bytes(range(256)) * 4096
+
+    r = client.post(
+        "/upload_video",
+        data={"file": (io.BytesIO(data), "my video.mp4"), "add_bg_music": "true"},
+        headers={"Authorization": f"Bearer {main.VIDDYSCRIBE_API_KEY}"},
+    )
 
-    assert r.data.decode() == "Hello World!"
     assert r.status_code == 200
+    assert r.json["gcs_url"] == "my_video.mp4"
+    assert gcs_bucket.download_bytes_from_gcs(BUCKET_NAME, "my_video.mp4") == data
+    assert scheduled == [("my_video.mp4", True, "my_video_output.mp4")]
+    assert main.job_store.get("my_video_output.mp4")["add_bg_music"]
+
+
+def test_upload_without_a_file_is_rejected(client):
+    r = client.post(
+        "/upload_video",
+        data={"add_bg_music": "false"},
+        content_type="multipart/form-data",
+        headers={"Authorization": f"Bearer {main.VIDDYSCRIBE_API_KEY}"},
+    )
+
+    assert r.status_code == 400
+
+
+def test_truncated_upload_stores_nothing(client, monkeypatch):
+    monkeypatch.setattr(main, "schedule_job", lambda *args: 0)
+    body = b'--xx\r\nContent-Disposition: form-data; name="file"; filename="video.mp4"\r\n\r\n' + b"video data" * 1000
+
+    r = client.post(
+        "/upload_video",
+        data=body,
+        content_type="multipart/form-data; boundary=xx",
+        headers={"Authorization": f"Bearer {main.VIDDYSCRIBE_API_KEY}"},
+    )
+
+    assert r.status_code == 400
+    with pytest.raises(NotFound):
+        gcs_bucket.download_bytes_from_gcs(BUCKET_NAME, "video.mp4")
+
+
+def test_invalid_video_fails_the_job(client, monkeypatch, tmp_path):
+    import asyncio
+    from util import text_to_speech
+    from util.job_store import JOB_STATE_ERROR
+    video = tmp_path / "video.mp4"
+    video.write_bytes(b"not a video")
+    monkeypatch.setattr(text_to_speech, "VertexAIUtility", lambda: None)
+
+    async def main_function(gcs_url, add_bg_music):
+        return text_to_speech.get_audio_desc_util(str(video), add_bg_music)
 
+    monkeypatch.setattr(main, "main_function", main_function)
+    main.job_store.create_job("video_output.mp4", "video.mp4", False)
 
-def test_handler_with_env_variable(client):
-    os.environ["NAME"] = "Foo"
-    r = client.get("/")
+    asyncio.run(main.process_video_task("video.mp4", False, "video_output.mp4"))
 
-    assert r.data.decode() == "Hello Foo!"
-    assert r.status_code == 200
\ No newline at end of file
+    assert main.job_store.get("video_output.mp4")["state"] == JOB_STATE_ERROR
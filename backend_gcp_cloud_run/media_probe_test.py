@@ -0,0 +1,81 @@
+from util.segment_render import run_ffmpeg
+import os
+
+from util.media_probe import MediaInfo, probe_media, probe_partial
+
+
+def make_video(path, audio=True):
+    args = ["-f", "lavfi", "-i", "testsrc2=size=320x240:rate=25:duration=3"]
+    if audio:
+        args += ["-f", "lavfi", "-i", "sine=frequency=440:duration=3", "-c:a", "aac", "-shortest"]
+    run_ffmpeg(args + ["-c:v", "libx264", "-preset", "ultrafast", "-g", "25", path])
+    return path
+
+
+def test_probe_reads_streams_once(tmp_path):
+    media = probe_media(make_video(str(tmp_path / "video.mp4")))
+
+    assert media.has_audio
+    assert abs(media.duration - 3) < 0.1
+    assert media.fps == 25
+    assert media.video_stream["codec_name"] == "h264"
+    assert media.video_stream["duration"] == media.duration
+    assert media._keyframes is None
+    assert media.keyframes == [0.0, 1.0, 2.0]
+    assert media.keyframes is media.keyframes
+
+
+def test_video_without_audio(tmp_path):
+    media = probe_media(make_video(str(tmp_path / "silent.mp4"), audio=False))
+
+    assert not media.has_audio
+    assert media.audio_stream is None
+
+
+def test_clip_is_opened_lazily_and_reused(tmp_path):
+    media = probe_media(make_video(str(tmp_path / "video.mp4")))
+
+    clip = media.video_clip()
+    assert media.video_clip() is clip
+    media.close()
+    assert media._clip is None
+
+
+def test_content_hash_depends_on_the_bytes_not_the_name(tmp_path):
+    first = probe_media(make_video(str(tmp_path / "clip.mp4")))
+    os.makedirs(tmp_path / "other")
+    second = probe_media(make_video(str(tmp_path / "other" / "clip.mp4"), audio=False))
+
+    assert first.content_hash == probe_media(first.path).content_hash
+    assert first.content_hash != second.content_hash
+
+
+def test_missing_streams():
+    media = MediaInfo("audio.mp3", [{"codec_type": "audio"}], {"duration": "1.5"})
+
+    assert media.video_stream is None
+    assert media.fps is None
+    assert media.duration == 1.5
+
+
+def test_partial_download_probes_from_the_headers(tmp_path):
+    path = make_video(str(tmp_path / "video.mp4"))
+    size = os.path.getsize(path)
+    # Only the first and last 4 KB have arrived
+    with open(path, "r+b") as f:
+        f.seek(4096)
+        f.write(b"\0" * (size - 8192))
+
+    media = probe_partial(path)
+
+    assert media is not None
+    assert abs(media.duration - 3) < 0.1
+    assert media.has_audio
+
+
+def test_partial_download_that_cant_be_probed(tmp_path):
+    path = str(tmp_path / "video.mp4")
+    with open(path, "wb") as f:
+        f.write(b"\0" * 8192)
+
+    assert probe_partial(path) is None
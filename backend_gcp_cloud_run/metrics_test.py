@@ -0,0 +1,69 @@
+import asyncio
+import pytest
+
+from util.metrics import MetricsRegistry, span, stage_seconds, current_job
+from util.scheduler import JobScheduler
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("test_seconds", "Test", ["stage"], buckets=(1, 5))
+    for value in (0.5, 2, 10):
+        histogram.observe(value, "tts")
+
+    lines = registry.render().splitlines()
+
+    assert "# TYPE test_seconds histogram" in lines
+    assert 'test_seconds_bucket{stage="tts",le="1.0"} 1' in lines
+    assert 'test_seconds_bucket{stage="tts",le="5.0"} 2' in lines
+    assert 'test_seconds_bucket{stage="tts",le="+Inf"} 3' in lines
+    assert 'test_seconds_sum{stage="tts"} 12.5' in lines
+    assert 'test_seconds_count{stage="tts"} 3' in lines
+
+
+def test_callback_metrics_are_read_at_scrape_time():
+    registry = MetricsRegistry()
+    hits = {("tts",): 1}
+    registry.counter("test_hits_total", "Hits", lambda: hits, ["cache"])
+    registry.gauge("test_queued", "Queued", lambda: 3)
+    hits[("tts",)] = 4
+
+    lines = registry.render().splitlines()
+
+    assert 'test_hits_total{cache="tts"} 4.0' in lines
+    assert "test_queued 3.0" in lines
+
+
+def test_failing_callbacks_are_skipped():
+    registry = MetricsRegistry()
+    registry.gauge("test_broken", "Broken", lambda: 1 / 0)
+
+    assert registry.render() == "\n"
+
+
+def test_spans_record_status_and_job(caplog):
+    before = (stage_seconds.samples(["test_stage", "error"]) or {"count": 0})["count"]
+    caplog.set_level("INFO")
+    token = current_job.set("video_output.mp4")
+    try:
+        with pytest.raises(ValueError):
+            with span("test_stage"):
+                raise ValueError("failed")
+    finally:
+        current_job.reset(token)
+
+    assert stage_seconds.samples(["test_stage", "error"])["count"] == before + 1
+    assert "span stage=test_stage job=video_output.mp4 status=error" in caplog.text
+
+
+def test_job_context_follows_blocking_stage_work():
+    scheduler = JobScheduler()
+
+    async def job():
+        current_job.set("video_output.mp4")
+        return await scheduler.run_in_stage("render", current_job.get)
+
+    try:
+        assert asyncio.run(job()) == "video_output.mp4"
+    finally:
+        scheduler.stop()
@@ -0,0 +1,66 @@
+from util.job_store import InMemoryJobStore
+from util.progress import JobProgress, current_progress, report, reporter
+
+
+def test_progress_is_weighted_and_monotonic():
+    store = InMemoryJobStore()
+    store.create_job("video_output.mp4", "video.mp4", False)
+    progress = JobProgress("video_output.mp4", store, min_interval=0)
+
+    progress.update("download", 1.0)
+    progress.update("analysis", 1.0)
+    assert progress.percent == 25
+    progress.update("speech", 0.5)
+    progress.update("render", 0.2)
+    assert (progress.stage, progress.percent) == ("render", 46)
+    # A render fraction that dips (a still's length became known) doesn't
+    # move the percentage back
+    progress.update("render", 0.1)
+    assert progress.percent == 46
+    progress.close()
+
+    job = store.get("video_output.mp4")
+    assert (job["stage"], job["progress"]) == ("render", 46)
+    assert job["status"] == "Rendering the described video (46%). Keep this tab open."
+
+
+def test_writes_are_throttled_within_a_stage():
+    class CountingStore(InMemoryJobStore):
+        writes = 0
+
+        def update_job(self, output_video_name, **fields):
+            CountingStore.writes += 1
+            return super().update_job(output_video_name, **fields)
+
+    store = CountingStore()
+    store.create_job("video_output.mp4", "video.mp4", False)
+    progress = JobProgress("video_output.mp4", store, min_interval=3600)
+
+    for i in range(1, 11):
+        progress.update("speech", i / 10)
+    progress.update("render")
+    progress.close()
+
+    # The first update of each stage is written, the rest wait for the interval
+    assert CountingStore.writes == 2
+    assert store.get("video_output.mp4")["stage"] == "render"
+
+
+def test_reporting_without_a_job_does_nothing():
+    report("speech", 0.5)
+    assert reporter("render") is None
+
+
+def test_report_follows_the_current_job():
+    store = InMemoryJobStore()
+    store.create_job("video_output.mp4", "video.mp4", False)
+    progress = JobProgress("video_output.mp4", store, min_interval=0)
+    token = current_progress.set(progress)
+    try:
+        report("download", 1.0)
+        on_render = reporter("render")
+    finally:
+        current_progress.reset(token)
+    on_render(0.5)
+
+    assert (progress.stage, progress.percent) == ("render", 27)
@@ -0,0 +1,150 @@
+import time
+import asyncio
+import threading
+import pytest
+
+from util.scheduler import JobScheduler, SchedulerSaturated
+
+
+@pytest.fixture
+def scheduler():
+    s = JobScheduler(max_running=1, max_queued=2, stage_limits={"render": 1})
+    yield s
+    s.stop()
+
+
+def test_queue_positions_and_admission(scheduler):
+    release = threading.Event()
+
+    async def job():
+        while not release.is_set():
+            await asyncio.sleep(0.01)
+
+    assert scheduler.submit("a", job) == 0
+    assert scheduler.submit("b", job) == 1
+    assert scheduler.submit("c", job) == 2
+    with pytest.raises(SchedulerSaturated) as e:
+        scheduler.submit("d", job)
+    assert e.value.retry_after >= 1
+    # Forced submissions (resumed jobs) bypass admission control
+    assert scheduler.submit("d", job, force=True) == 3
+    assert scheduler.queue_position("c") == 2
+
+    release.set()
+    deadline = time.time() + 5
+    while scheduler.stats() != {"queued": 0, "running": 0} and time.time() < deadline:
+        time.sleep(0.01)
+    assert scheduler.stats() == {"queued": 0, "running": 0}
+    assert scheduler.queue_position("a") is None
+
+
+def test_all_jobs_share_one_loop(scheduler):
+    scheduler.max_running = 2
+    loops = []
+    done = threading.Event()
+
+    async def job():
+        loops.append(asyncio.get_running_loop())
+        if len(loops) == 2:
+            done.set()
+
+    scheduler.submit("a", job)
+    scheduler.submit("b", job)
+
+    assert done.wait(5)
+    assert loops[0] is loops[1]
+
+
+def test_stage_limit_serializes_blocking_work(scheduler):
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def render():
+        with lock:
+            active.append(1)
+            peak.append(len(active))
+        time.sleep(0.05)
+        with lock:
+            active.pop()
+        return "ok"
+
+    async def run_all():
+        return await asyncio.gather(*(scheduler.run_in_stage("render", render) for _ in range(3)))
+
+    assert asyncio.run(run_all()) == ["ok", "ok", "ok"]
+    assert max(peak) == 1
+
+
+def test_queued_callback_runs_before_the_job_starts(scheduler):
+    events = []
+    release = threading.Event()
+    started = threading.Event()
+
+    async def job():
+        while not release.is_set():
+            await asyncio.sleep(0.01)
+
+    def on_start(job_id):
+        events.append(("start", job_id))
+        if job_id == "b":
+            started.set()
+
+    on_queued = lambda job_id, position: events.append(("queued", job_id, position))
+    scheduler.submit("a", job, on_start=on_start, on_queued=on_queued)
+    scheduler.submit("b", job, on_start=on_start, on_queued=on_queued)
+    release.set()
+
+    assert started.wait(5)
+    assert ("queued", "a", 0) not in events
+    assert events.index(("queued", "b", 1)) < events.index(("start", "b"))
+
+
+def test_stage_semaphores_are_dropped_with_their_loop(scheduler):
+    import gc
+
+    async def use_stage():
+        async with scheduler.stage("render"):
+            pass
+
+    for _ in range(3):
+        asyncio.run(use_stage())
+    gc.collect()
+
+    assert len(scheduler._stage_semaphores) == 0
+
+
+def test_failed_queued_callback_frees_its_slot(scheduler):
+    release = threading.Event()
+
+    async def job():
+        while not release.is_set():
+            await asyncio.sleep(0.01)
+
+    def on_queued(job_id, position):
+        raise ConnectionError("job store unreachable")
+
+    scheduler.submit("a", job)
+    deadline = time.time() + 5
+    while scheduler.stats()["running"] == 0 and time.time() < deadline:
+        time.sleep(0.01)
+    with pytest.raises(ConnectionError):
+        scheduler.submit("b", job, on_queued=on_queued)
+
+    assert scheduler.queue_position("b") is None
+    assert scheduler.stats() == {"queued": 0, "running": 1}
+    release.set()
+
+
+def test_start_callback_runs_off_the_loop(scheduler):
+    threads = []
+    done = threading.Event()
+
+    async def job():
+        threads.append(("job", threading.current_thread()))
+        done.set()
+
+    scheduler.submit("a", job, on_start=lambda job_id: threads.append(("start", threading.current_thread())))
+
+    assert done.wait(5)
+    assert dict(threads)["start"] is not dict(threads)["job"]
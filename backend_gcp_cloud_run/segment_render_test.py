@@ -0,0 +1,172 @@
+import json
+import subprocess
+
+import pytest
+
+from util import segment_render
+from util.media_probe import ffprobe_binary
+from util.segment_render import SegmentRenderer, VideoSpan, StillFrame, run_ffmpeg, ffmpeg_binary
+
+STREAM = {"codec_name": "h264", "profile": "High", "pix_fmt": "yuv420p", "avg_frame_rate": "25/1", "duration": 30.0}
+
+
+def make_renderer(keyframes=(0, 2, 4, 6, 8, 10, 12, 14, 16, 18, 20, 22, 24, 26, 28)):
+    return SegmentRenderer("in.mp4", "work", stream=dict(STREAM), keyframes=list(keyframes), workers=1)
+
+
+def test_span_is_copied_between_keyframes_and_encoded_at_the_edges():
+    renderer = make_renderer()
+
+    assert renderer.split_span(VideoSpan(3, 9.5)) == [(3, 4, False), (4, 8, True), (8, 9.5, False)]
+    assert renderer.split_span(VideoSpan(4, 8)) == [(4, 8, True)]
+
+
+def test_span_without_a_full_gop_is_encoded():
+    renderer = make_renderer()
+
+    assert renderer.split_span(VideoSpan(2.5, 3.5)) == [(2.5, 3.5, False)]
+    assert renderer.split_span(VideoSpan(3, 3)) == []
+
+
+def test_span_to_the_end_copies_the_last_gop():
+    renderer = make_renderer()
+
+    assert renderer.split_span(VideoSpan(27, 30)) == [(27, 28, False), (28, 30, True)]
+
+
+def test_plan_pieces_keeps_output_order():
+    renderer = make_renderer()
+    plan = [VideoSpan(0, 3), StillFrame(3, 1.5), VideoSpan(3, 30)]
+
+    assert renderer.plan_pieces(plan) == [
+        ("copy", 0, 2), ("encode", 2, 3),
+        ("still", 3, 1.5),
+        ("encode", 3, 4), ("copy", 4, 30),
+    ]
+
+
+def test_cores_are_split_between_the_workers():
+    import os
+    cpus = os.cpu_count() or 1
+    threads = lambda renderer: renderer.encoder_args()[renderer.encoder_args().index("-threads") + 1]
+
+    assert threads(make_renderer()) == str(cpus)
+    assert threads(SegmentRenderer("in.mp4", "work", stream=dict(STREAM), keyframes=[0], workers=cpus)) == "1"
+
+
+def test_stream_copy_needs_h264_with_keyframes():
+    assert make_renderer().supports_stream_copy()
+    assert not make_renderer(keyframes=()).supports_stream_copy()
+    renderer = make_renderer()
+    renderer.stream["codec_name"] = "vp9"
+    assert not renderer.supports_stream_copy()
+
+
+def test_without_stream_copy_spans_are_encoded_in_frame_aligned_chunks():
+    renderer = SegmentRenderer("in.mp4", "work", stream=dict(STREAM), keyframes=[0, 2], stream_copy=False)
+
+    pieces = renderer.split_span(VideoSpan(0, 29.6))
+    assert [copy for _, _, copy in pieces] == [False, False]
+    assert pieces[0][0] == 0 and pieces[-1][1] == 29.6
+    for start, end, _ in pieces:
+        assert abs((end - start) * 25 - round((end - start) * 25)) < 1e-9
+
+
+class RecordingRenderer(SegmentRenderer):
+    # Records pieces instead of running ffmpeg
+    def render_piece(self, index, piece, on_progress=None):
+        if on_progress:
+            on_progress(self.piece_frames(piece))
+        return [(f"piece_{index}", piece[2])]
+
+    def concat(self, pieces, output_path):
+        return pieces
+
+
+def test_session_encodes_stills_once_their_duration_is_known(tmp_path):
+    renderer = RecordingRenderer("in.mp4", str(tmp_path / "work"), stream=dict(STREAM), keyframes=[0], workers=2, stream_copy=False)
+    session = renderer.start([StillFrame(3, None), VideoSpan(3, 5), StillFrame(5, 1.5)])
+
+    assert sorted(session._futures) == [1, 2]
+    session.set_still_duration(0, 2.0)
+
+    assert session.finish("out.mp4") == [("piece_0", 2.0), ("piece_1", 5), ("piece_2", 1.5)]
+
+
+def test_session_can_run_on_a_shared_executor(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    submitted = []
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        def submit(func, *args):
+            submitted.append(func.__name__)
+            return executor.submit(func, *args)
+
+        renderer = RecordingRenderer("in.mp4", str(tmp_path / "work"), stream=dict(STREAM), keyframes=[0], workers=2, stream_copy=False)
+        session = renderer.start([VideoSpan(0, 3), StillFrame(3, None)], submit=submit)
+        session.set_still_duration(0, 1.0)
+
+        assert session.finish("out.mp4") == [("piece_0", 3), ("piece_1", 1.0)]
+    assert submitted == ["split_source", "render_piece", "render_piece"]
+    assert session._pool is None
+
+
+def test_session_fails_when_a_still_has_no_duration(tmp_path):
+    renderer = RecordingRenderer("in.mp4", str(tmp_path / "work"), stream=dict(STREAM), keyframes=[0], workers=1, stream_copy=False)
+    session = renderer.start([StillFrame(3, None)])
+
+    with pytest.raises(ValueError):
+        session.finish("out.mp4")
+
+
+def test_session_reports_frame_progress(tmp_path):
+    class HalfwayRenderer(RecordingRenderer):
+        def render_piece(self, index, piece, on_progress=None):
+            on_progress(self.piece_frames(piece) // 2)
+            return super().render_piece(index, piece, on_progress)
+
+    renderer = HalfwayRenderer("in.mp4", str(tmp_path / "work"), stream=dict(STREAM), keyframes=[0], workers=1, stream_copy=False)
+    fractions = []
+    renderer.render([VideoSpan(0, 3), StillFrame(3, 1.0)], "out.mp4", fractions.append)
+
+    assert fractions == [0.37, 0.75, 0.87, 1.0, 1.0]
+
+
+def test_ffmpeg_progress_is_reported(tmp_path):
+    frames = []
+    run_ffmpeg(["-f", "lavfi", "-i", "testsrc2=size=64x64:rate=25:duration=2", "-c:v", "libx264", "-preset", "ultrafast", str(tmp_path / "out.mp4")], frames.append)
+
+    assert frames
+    assert frames[-1] == 50
+
+
+def segment_format_is_readable(tmp_path, segment_format):
+    # Some static ffmpeg builds crash reading MPEG-TS on some machines
+    path = str(tmp_path / f"probe{segment_render.SEGMENT_EXTENSIONS[segment_format]}")
+    run_ffmpeg(["-f", "lavfi", "-i", "testsrc2=size=64x64:rate=25:duration=0.2", "-c:v", "libx264", "-f", segment_format, path])
+    return subprocess.run([ffmpeg_binary(), "-v", "error", "-i", path, "-f", "null", "-"], capture_output=True).returncode == 0
+
+
+@pytest.mark.parametrize("segment_format", ["mpegts", "matroska"])
+def test_smart_render_of_a_real_clip(tmp_path, monkeypatch, segment_format):
+    if not segment_format_is_readable(tmp_path, segment_format):
+        pytest.skip(f"This ffmpeg can't read {segment_format}")
+    monkeypatch.setattr(segment_render, "SEGMENT_FORMAT", segment_format)
+    source = str(tmp_path / "in.mp4")
+    run_ffmpeg([
+        "-f", "lavfi", "-i", "testsrc2=size=320x240:rate=25:duration=6",
+        "-c:v", "libx264", "-preset", "ultrafast", "-g", "25", "-pix_fmt", "yuv420p", source,
+    ])
+    renderer = SegmentRenderer(source, str(tmp_path / "segments"), workers=2)
+    plan = [VideoSpan(0, 2.5), StillFrame(2.5, 1), VideoSpan(2.5, 6)]
+    assert renderer.stream_copy
+    assert any(kind == "copy" for kind, _, _ in renderer.plan_pieces(plan))
+
+    output = renderer.render(plan, str(tmp_path / "out.mp4"))
+
+    result = subprocess.run([
+        ffprobe_binary(), "-v", "error", "-select_streams", "v:0", "-count_frames",
+        "-show_entries", "stream=nb_read_frames:format=duration", "-of", "json", output,
+    ], capture_output=True, check=True)
+    info = json.loads(result.stdout)
+    assert int(info["streams"][0]["nb_read_frames"]) == 7 * 25
+    assert abs(float(info["format"]["duration"]) - 7) < 0.1
@@ -0,0 +1,42 @@
+from util.timestamps import normalize_description, parse_timestamp, format_timestamp
+
+
+def test_parse_and_format_timestamps():
+    assert parse_timestamp("0:05") == 5
+    assert parse_timestamp("00:05.1") == 5.1
+    assert parse_timestamp("1:02:03") == 3723
+    assert parse_timestamp("0:01,25") == 1.25
+    assert format_timestamp(65.1) == "1:05.100"
+    assert format_timestamp(0) == "0:00.000"
+
+
+def test_normalizes_the_variants_gemini_produces():
+    description = "\n".join([
+        "Here are the audio descriptions:",
+        "```",
+        "- **[00:12]** A dog runs.",
+        "* [0:05.1] A man walks in.",
+        "1. [0:20 - 0:25]: A range.",
+        "(0:30) In parentheses.",
+        "**[0:40]**",
+        "On the next line.",
+        "[0:05.1] A man walks in.",
+        "```",
+    ])
+
+    assert normalize_description(description) == "\n".join([
+        "[0:05.100] A man walks in.",
+        "[0:12.000] A dog runs.",
+        "[0:20.000] A range.",
+        "[0:30.000] In parentheses.",
+        "[0:40.000] On the next line.",
+    ])
+
+
+def test_clamps_to_the_video_duration():
+    assert normalize_description("[0:05] Start\n[1:02:03] Way past the end", duration=30.5) == "[0:05.000] Start\n[0:30.500] Way past the end"
+
+
+def test_returns_none_without_timestamps():
+    assert normalize_description("No timestamps returned from Gemini.") is None
+    assert normalize_description("At 10:30 the scene changes.") is None
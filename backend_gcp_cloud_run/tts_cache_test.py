@@ -0,0 +1,56 @@
+import os
+import time
+
+from util.tts_cache import TTSCache, tts_cache_key
+
+
+def test_key_covers_every_field():
+    key = tts_cache_key("ElevenLabs", "voice", "model", "Hello", "mp3_44100_128")
+
+    assert key == tts_cache_key("ElevenLabs", "voice", "model", "Hello", "mp3_44100_128")
+    assert key != tts_cache_key("ElevenLabs", "voice", "model", "Hello.", "mp3_44100_128")
+    assert key != tts_cache_key("ElevenLabs", "other", "model", "Hello", "mp3_44100_128")
+    assert key != tts_cache_key("ElevenLabs", "voice", "model", "Hello", "pcm_44100")
+
+
+def test_get_and_put_count_hits_and_misses(tmp_path):
+    cache = TTSCache(str(tmp_path), max_bytes=1024)
+
+    assert cache.get("a") is None
+    cache.put("a", b"audio")
+    assert cache.get("a") == b"audio"
+    assert cache.stats() == {"hits": 1, "shared_hits": 0, "misses": 1, "bytes": 5}
+
+
+
+def test_overwriting_an_entry_replaces_its_size(tmp_path):
+    cache = TTSCache(str(tmp_path), max_bytes=1024)
+
+    for _ in range(3):
+        cache.put("a", b"audio")
+    cache.put("a", b"longer audio")
+
+    assert cache.stats()["bytes"] == len(b"longer audio")
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = TTSCache(str(tmp_path), max_bytes=10)
+    cache.put("a", b"1234")
+    cache.put("b", b"1234")
+    # Make "a" the most recently used entry
+    old = time.time() - 60
+    os.utime(os.path.join(tmp_path, "b"), (old, old))
+    os.utime(os.path.join(tmp_path, "a"), (old - 60, old - 60))
+    assert cache.get("a") == b"1234"
+
+    cache.put("c", b"1234")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1234"
+    assert cache.get("c") == b"1234"
+    assert cache.stats()["bytes"] == 8
+
+
+def test_existing_entries_count_towards_the_cap(tmp_path):
+    TTSCache(str(tmp_path), max_bytes=100).put("a", b"12345")
+
+    assert TTSCache(str(tmp_path), max_bytes=100).stats()["bytes"] == 5
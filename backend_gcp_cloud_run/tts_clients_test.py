@@ -0,0 +1,36 @@
+import asyncio
+
+from util.tts_clients import TTSClientRegistry
+
+
+class FakeClient():
+    def __init__(self, http_client):
+        self.http_client = http_client
+
+
+def make_registry():
+    return TTSClientRegistry(pool_size=3, keepalive_seconds=5, factories={"Fake": FakeClient})
+
+
+def test_client_is_shared_within_a_loop():
+    registry = make_registry()
+
+    async def get_twice():
+        return registry.get("Fake"), registry.get("Fake")
+
+    first, second = asyncio.run(get_twice())
+    assert first is second
+    assert first.http_client.timeout.read == registry.timeout
+
+
+def test_closed_loops_get_a_new_client():
+    registry = make_registry()
+
+    async def get():
+        return registry.get("Fake")
+
+    first = asyncio.run(get())
+    second = asyncio.run(get())
+
+    assert first is not second
+    assert len(registry._clients) == 1
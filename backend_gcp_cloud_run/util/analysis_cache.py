@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from google.api_core.exceptions import NotFound
+from util.Constants import BUCKET_NAME
+from util.gcs_bucket import get_storage_client
+
+ANALYSIS_CACHE_TTL_SECONDS = float(os.getenv("ANALYSIS_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", 1000))
+# Set to skip the cache lookup. Results are still stored, so this also refreshes entries.
+ANALYSIS_CACHE_BYPASS = os.getenv("ANALYSIS_CACHE_BYPASS", "").lower() in ("1", "true", "yes")
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def analysis_cache_key(content_hash, model_name, instruction, generation_config):
+    payload = json.dumps([content_hash, model_name, instruction, generation_config], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class AnalysisCache():
+    # Stores model responses by analysis_cache_key. Entries older than the TTL
+    # are treated as missing. Backends implement _load, _store and evict.
+
+    def __init__(self, ttl_seconds=ANALYSIS_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _load(self, key):
+        raise NotImplementedError
+
+    def _store(self, key, entry):
+        raise NotImplementedError
+
+    def evict(self):
+        raise NotImplementedError
+
+    def get(self, key):
+        entry = self._load(key)
+        fresh = entry is not None and time.time() - entry["created_at"] <= self.ttl_seconds
+        with self._lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry["result"] if fresh else None
+
+    def put(self, key, result):
+        self._store(key, {"created_at": time.time(), "result": result})
+
+    def get_or_compute(self, key, compute, bypass=False):
+        # compute() returns the result and whether it may be cached, so
+        # failures are never served from the cache
+        if not (bypass or ANALYSIS_CACHE_BYPASS):
+            result = self.get(key)
+            if result is not None:
+                logging.info(f"Analysis cache hit for {key}")
+                return result
+        result, cacheable = compute()
+        if cacheable:
+            try:
+                self.put(key, result)
+            except Exception as e:
+                logging.warning(f"Failed to store analysis cache entry {key}: {e}")
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+class NullAnalysisCache(AnalysisCache):
+    # Used when caching is turned off, every lookup is a miss
+
+    def _load(self, key):
+        return None
+
+    def _store(self, key, entry):
+        pass
+
+    def evict(self):
+        pass
+
+
+class LocalAnalysisCache(AnalysisCache):
+    # One JSON file per entry. Eviction drops expired entries, then the oldest
+    # ones beyond max_entries.
+
+    def __init__(self, directory, ttl_seconds=ANALYSIS_CACHE_TTL_SECONDS, max_entries=ANALYSIS_CACHE_MAX_ENTRIES):
+        super().__init__(ttl_seconds)
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _load(self, key):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _store(self, key, entry):
+        path = self._path(key)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(temp_path, path)
+        if len(os.listdir(self.directory)) > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except FileNotFoundError:
+                continue
+        entries.sort()
+        expired_before = time.time() - self.ttl_seconds
+        excess = len(entries) - self.max_entries
+        for i, (mtime, path) in enumerate(entries):
+            if mtime >= expired_before and i >= excess:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class GCSAnalysisCache(AnalysisCache):
+    # One JSON object per entry in a bucket, shared by all instances. Expired
+    # objects are left to a bucket lifecycle rule.
+
+    def __init__(self, bucket_name, prefix="analysis_cache/", ttl_seconds=ANALYSIS_CACHE_TTL_SECONDS):
+        super().__init__(ttl_seconds)
+        self.prefix = prefix
+        self.bucket = get_storage_client().bucket(bucket_name)
+
+    def _blob(self, key):
+        return self.bucket.blob(f"{self.prefix}{key}.json")
+
+    def _load(self, key):
+        try:
+            return json.loads(self._blob(key).download_as_bytes())
+        except NotFound:
+            return None
+
+    def _store(self, key, entry):
+        self._blob(key).upload_from_string(json.dumps(entry), content_type="application/json")
+
+    def evict(self):
+        pass
+
+
+_analysis_cache = None
+_analysis_cache_lock = threading.Lock()
+
+
+def create_analysis_cache(backend=None):
+    backend = backend or os.getenv("ANALYSIS_CACHE_BACKEND", "local")
+    if backend == "local":
+        return LocalAnalysisCache(os.getenv("ANALYSIS_CACHE_DIR", "/tmp/viddyscribe/analysis_cache"))
+    elif backend == "gcs":
+        return GCSAnalysisCache(os.getenv("ANALYSIS_CACHE_BUCKET", BUCKET_NAME))
+    elif backend == "off":
+        return NullAnalysisCache()
+    else:
+        raise ValueError(f"Unsupported analysis cache backend: {backend}")
+
+
+def get_analysis_cache():
+    global _analysis_cache
+    with _analysis_cache_lock:
+        if _analysis_cache is None:
+            _analysis_cache = create_analysis_cache()
+            logging.info(f"Using analysis cache: {type(_analysis_cache).__name__}")
+        return _analysis_cache
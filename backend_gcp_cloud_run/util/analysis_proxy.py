@@ -0,0 +1,58 @@
+import os
+import logging
+from util.segment_render import run_ffmpeg
+
+# Gemini samples video at about 1 fps and doesn't need full resolution or
+# audio quality to describe it, so a much smaller proxy is sent instead of the
+# upload. Timestamps are unchanged, the proxy has the same timeline.
+ANALYSIS_PROXY = os.getenv("ANALYSIS_PROXY", "1").lower() in ("1", "true", "yes")
+ANALYSIS_PROXY_HEIGHT = int(os.getenv("ANALYSIS_PROXY_HEIGHT", 360))
+ANALYSIS_PROXY_FPS = float(os.getenv("ANALYSIS_PROXY_FPS", 1))
+ANALYSIS_PROXY_CRF = int(os.getenv("ANALYSIS_PROXY_CRF", 30))
+ANALYSIS_PROXY_AUDIO_BITRATE = os.getenv("ANALYSIS_PROXY_AUDIO_BITRATE", "32k")
+
+
+def proxy_profile():
+    # Part of the analysis cache key, results from different proxies don't mix
+    if not ANALYSIS_PROXY:
+        return "source"
+    return f"proxy-{ANALYSIS_PROXY_HEIGHT}p-{ANALYSIS_PROXY_FPS:g}fps-crf{ANALYSIS_PROXY_CRF}-{ANALYSIS_PROXY_AUDIO_BITRATE}"
+
+
+def proxy_path_for(video_path):
+    return f"{os.path.splitext(video_path)[0]}_proxy.mp4"
+
+
+def make_analysis_proxy(video_path, proxy_path=None):
+    # Returns the path of the file to analyze. The proxy is built once per job
+    # and reused, and the source is used when a proxy wouldn't be smaller.
+    if not ANALYSIS_PROXY:
+        return video_path
+    proxy_path = proxy_path or proxy_path_for(video_path)
+    if os.path.exists(proxy_path) and os.path.getsize(proxy_path) > 0:
+        return proxy_path
+
+    temp_path = f"{proxy_path}.tmp.mp4"
+    try:
+        run_ffmpeg([
+            "-i", video_path,
+            "-map", "0:v:0", "-map", "0:a:0?",
+            "-vf", f"fps={ANALYSIS_PROXY_FPS:g},scale=-2:'min({ANALYSIS_PROXY_HEIGHT},ih)'",
+            "-c:v", "libx264", "-preset", "veryfast", "-crf", str(ANALYSIS_PROXY_CRF), "-pix_fmt", "yuv420p",
+            "-c:a", "aac", "-ac", "1", "-ar", "16000", "-b:a", ANALYSIS_PROXY_AUDIO_BITRATE,
+            "-movflags", "+faststart",
+            temp_path,
+        ])
+        os.replace(temp_path, proxy_path)
+    except Exception as e:
+        logging.warning(f"Failed to build analysis proxy for {video_path}, analyzing the source: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return video_path
+
+    source_size, proxy_size = os.path.getsize(video_path), os.path.getsize(proxy_path)
+    logging.info(f"Analysis proxy for {video_path}: {proxy_size} bytes, source {source_size} bytes")
+    if proxy_size >= source_size:
+        os.remove(proxy_path)
+        return video_path
+    return proxy_path
@@ -0,0 +1,214 @@
+import os
+import wave
+import logging
+import tempfile
+import subprocess
+import numpy as np
+from moviepy.config import get_setting
+
+# All audio is mixed as float32 PCM in [-1, 1], shape (samples, channels)
+SAMPLE_RATE = 44100
+CHANNELS = 2
+# Soundtracks longer than this are extracted into a memory-mapped temp file
+# instead of process memory (about 350 KB per second of audio)
+AUDIO_SPILL_SECONDS = float(os.getenv("AUDIO_SPILL_SECONDS", 600))
+# Spill files go to the caller's directory (the job's workspace in the
+# pipeline) unless this is set, say to a disk when workspaces are on tmpfs
+AUDIO_SPILL_DIR = os.getenv("AUDIO_SPILL_DIR")
+
+
+def ffmpeg_binary():
+    return get_setting("FFMPEG_BINARY")
+
+
+def decode_audio(path, sample_rate=SAMPLE_RATE, channels=CHANNELS):
+    # Decode any audio/video file to PCM in one ffmpeg pass, straight into memory
+    command = [
+        ffmpeg_binary(), "-v", "error", "-i", path,
+        "-vn", "-f", "f32le", "-acodec", "pcm_f32le",
+        "-ac", str(channels), "-ar", str(sample_rate), "-",
+    ]
+    result = subprocess.run(command, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to decode audio from {path}: {result.stderr.decode(errors='ignore')}")
+    return np.frombuffer(result.stdout, dtype=np.float32).reshape(-1, channels)
+
+
+def extract_audio(path, duration, sample_rate=SAMPLE_RATE, channels=CHANNELS, spill_seconds=None, spill_dir=None):
+    # Decode a video's soundtrack straight from ffmpeg's stdout into a buffer
+    # sized from the probed duration, without an intermediate file. Long
+    # soundtracks go to an unlinked memory-mapped file, so they are paged by the
+    # kernel instead of held in memory.
+    spill_seconds = AUDIO_SPILL_SECONDS if spill_seconds is None else spill_seconds
+    spill_dir = AUDIO_SPILL_DIR or spill_dir or tempfile.gettempdir()
+    # A little headroom, the audio stream can run past the container duration
+    capacity = seconds_to_samples(duration + 1, sample_rate)
+    if duration > spill_seconds:
+        os.makedirs(spill_dir, exist_ok=True)
+        with tempfile.TemporaryFile(dir=spill_dir) as spill_file:
+            buffer = np.memmap(spill_file, dtype=np.float32, mode="w+", shape=(capacity, channels))
+        logging.info(f"Extracting {duration:.1f}s of audio from {path} into a memory-mapped buffer")
+    else:
+        buffer = np.empty((capacity, channels), dtype=np.float32)
+
+    command = [
+        ffmpeg_binary(), "-v", "error", "-i", path,
+        "-vn", "-f", "f32le", "-acodec", "pcm_f32le",
+        "-ac", str(channels), "-ar", str(sample_rate), "-",
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    view = memoryview(buffer.reshape(-1)).cast("B")
+    filled = 0
+    overflow = []
+    while True:
+        if filled < len(view):
+            n = process.stdout.readinto(view[filled:])
+            if not n:
+                break
+            filled += n
+        else:
+            chunk = process.stdout.read(1024 * 1024)
+            if not chunk:
+                break
+            overflow.append(chunk)
+    stderr = process.stderr.read()
+    if process.wait() != 0:
+        raise RuntimeError(f"Failed to extract audio from {path}: {stderr.decode(errors='ignore')}")
+
+    frame_bytes = 4 * channels
+    samples = buffer[:filled // frame_bytes]
+    if overflow:
+        extra = np.frombuffer(b"".join(overflow), dtype=np.float32)
+        samples = np.concatenate([samples, extra[:len(extra) // channels * channels].reshape(-1, channels)])
+    return samples
+
+
+def decode_audio_bytes(data, sample_rate=SAMPLE_RATE, channels=CHANNELS):
+    # Same as decode_audio, for encoded audio that is already in memory
+    command = [
+        ffmpeg_binary(), "-v", "error", "-i", "pipe:0",
+        "-vn", "-f", "f32le", "-acodec", "pcm_f32le",
+        "-ac", str(channels), "-ar", str(sample_rate), "-",
+    ]
+    result = subprocess.run(command, input=data, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to decode audio from memory: {result.stderr.decode(errors='ignore')}")
+    return np.frombuffer(result.stdout, dtype=np.float32).reshape(-1, channels)
+
+
+def pcm16_to_samples(data, source_rate, sample_rate=SAMPLE_RATE, channels=CHANNELS):
+    # Raw mono 16-bit PCM to the mixing format, no subprocess needed
+    mono = np.frombuffer(data[:len(data) // 2 * 2], dtype="<i2").astype(np.float32) / 32768
+    if source_rate != sample_rate and len(mono):
+        n = seconds_to_samples(len(mono) / source_rate, sample_rate)
+        mono = np.interp(np.arange(n) * (source_rate / sample_rate), np.arange(len(mono)), mono).astype(np.float32)
+    return np.repeat(mono[:, None], channels, axis=1)
+
+
+def silence(duration, sample_rate=SAMPLE_RATE, channels=CHANNELS):
+    return np.zeros((seconds_to_samples(duration, sample_rate), channels), dtype=np.float32)
+
+
+def seconds_to_samples(seconds, sample_rate=SAMPLE_RATE):
+    return max(int(round(seconds * sample_rate)), 0)
+
+
+def duration_of(samples, sample_rate=SAMPLE_RATE):
+    return len(samples) / sample_rate
+
+
+def peak(samples):
+    # Same as moviepy's max_volume()
+    if samples.size == 0:
+        return 0.0
+    return float(np.abs(samples).max())
+
+
+def gain_to(target_volume, current_volume):
+    if current_volume == 0:
+        return 1.0
+    return target_volume / current_volume
+
+
+def slice_seconds(samples, start, end, sample_rate=SAMPLE_RATE):
+    return samples[seconds_to_samples(start, sample_rate):seconds_to_samples(end, sample_rate)]
+
+
+def fade_in(samples, duration, sample_rate=SAMPLE_RATE):
+    # Linear ramp from 0 to 1 over the first `duration` seconds, like audio_fadein
+    n = min(seconds_to_samples(duration, sample_rate), len(samples))
+    faded = np.array(samples, dtype=np.float32, copy=True)
+    if n > 0:
+        faded[:n] *= (np.arange(n, dtype=np.float32) / n)[:, None]
+    return faded
+
+
+def fade_out(samples, duration, sample_rate=SAMPLE_RATE):
+    # Linear ramp from 1 to 0 over the last `duration` seconds, like audio_fadeout
+    n = min(seconds_to_samples(duration, sample_rate), len(samples))
+    faded = np.array(samples, dtype=np.float32, copy=True)
+    if n > 0:
+        faded[len(faded) - n:] *= (np.arange(n, 0, -1, dtype=np.float32) / n)[:, None]
+    return faded
+
+
+def overlay(duration, layers, sample_rate=SAMPLE_RATE, channels=CHANNELS):
+    # Sum (samples, start_seconds, gain) layers into a buffer of the given
+    # duration. Anything past the end is cut off, like a clip's set_audio.
+    mixed = silence(duration, sample_rate, channels)
+    for samples, start, gain in layers:
+        offset = seconds_to_samples(start, sample_rate)
+        if offset >= len(mixed):
+            continue
+        n = min(len(samples), len(mixed) - offset)
+        mixed[offset:offset + n] += samples[:n] * np.float32(gain)
+    return mixed
+
+
+class AudioTimeline():
+    # Collects the pieces of the final soundtrack in order and renders them
+    # into one buffer at the end.
+
+    def __init__(self, sample_rate=SAMPLE_RATE, channels=CHANNELS):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.parts = []
+
+    def append(self, samples):
+        self.parts.append(samples)
+
+    @property
+    def duration(self):
+        return sum(len(part) for part in self.parts) / self.sample_rate
+
+    def render(self):
+        if not self.parts:
+            return np.zeros((0, self.channels), dtype=np.float32)
+        return np.concatenate(self.parts)
+
+
+def write_wav(path, samples, sample_rate=SAMPLE_RATE):
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype("<i2")
+    with wave.open(path, "wb") as f:
+        f.setnchannels(samples.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(pcm.tobytes())
+    return path
+
+
+def mux_audio(video_path, audio_path, output_path, audio_codec="aac"):
+    # Attach the mixed soundtrack to a rendered video without re-encoding the video
+    command = [
+        ffmpeg_binary(), "-v", "error", "-y",
+        "-i", video_path, "-i", audio_path,
+        "-map", "0:v:0", "-map", "1:a:0",
+        "-c:v", "copy", "-c:a", audio_codec,
+        "-movflags", "+faststart",
+        output_path,
+    ]
+    result = subprocess.run(command, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to mux audio into {output_path}: {result.stderr.decode(errors='ignore')}")
+    logging.info(f"Muxed {audio_path} into {output_path}")
+    return output_path
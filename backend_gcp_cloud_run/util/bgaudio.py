@@ -1,29 +1,101 @@
 import random
 import os
-from moviepy.editor import AudioFileClip
+import logging
+import threading
+from collections import namedtuple
 from util.gcs_bucket import download_from_gcs
-import uuid
+from util import audio_mixer
+from util.loudness import LoudnessIndex
+from util.workspace import Workspace
+
+BG_AUDIO_BUCKET = "viddyscribe_bg_audio_samples"
+
+# A piece of a music track. samples is a view into the library's decoded track
+# and peak is its precomputed peak volume.
+MusicClip = namedtuple("MusicClip", ["samples", "peak"])
+
+
+class MusicTrack():
+    # A decoded track with a loudness index, so the peak of any slice is O(1)
+
+    def __init__(self, name, samples):
+        self.name = name
+        self.samples = samples
+        self.loudness = LoudnessIndex.from_samples(samples, audio_mixer.SAMPLE_RATE)
+        self.duration = audio_mixer.duration_of(samples)
+        self.peak = self.loudness.max_volume
+        self.rms = self.loudness.rms()
+
+    def clip(self, start_time, end_time):
+        samples = audio_mixer.slice_seconds(self.samples, start_time, end_time)
+        return MusicClip(samples, self.loudness.peak(start_time, end_time))
+
+
+class MusicLibrary():
+    # Every track is downloaded and decoded once per process and kept as PCM.
+    # The samples are read-only and shared by all jobs.
+
+    def __init__(self, bucket_name=BG_AUDIO_BUCKET, workspace_root=None):
+        self.bucket_name = bucket_name
+        self.workspace_root = workspace_root
+        self._tracks = {}
+        self._track_locks = {}
+        self._lock = threading.Lock()
+
+    def track(self, gcs_file):
+        with self._lock:
+            if gcs_file in self._tracks:
+                return self._tracks[gcs_file]
+            track_lock = self._track_locks.setdefault(gcs_file, threading.Lock())
+        # Concurrent jobs asking for the same track wait for one download
+        with track_lock:
+            with self._lock:
+                if gcs_file in self._tracks:
+                    return self._tracks[gcs_file]
+            track = MusicTrack(gcs_file, self.load(gcs_file))
+            logging.info(f"Loaded background track {gcs_file}: {track.duration:.1f}s, peak {track.peak:.3f}")
+            with self._lock:
+                self._tracks[gcs_file] = track
+            return track
+
+    def load(self, gcs_file):
+        # Only the decoded samples are kept, the download goes to a workspace
+        # of its own that is removed right after
+        with Workspace(f"music_{os.path.basename(gcs_file)}", root=self.workspace_root) as workspace:
+            local_file = workspace.path(os.path.basename(gcs_file))
+            download_from_gcs(self.bucket_name, gcs_file, local_file)
+            samples = audio_mixer.decode_audio(local_file)
+        samples.flags.writeable = False
+        return samples
+
+
+_music_library = None
+_music_library_lock = threading.Lock()
+
+
+def get_music_library():
+    global _music_library
+    with _music_library_lock:
+        if _music_library is None:
+            _music_library = MusicLibrary()
+        return _music_library
+
 
 class BackgroundAudioGenerator():
-    def __init__(self, category):
+    def __init__(self, category, library=None):
         self.category = category
-        self.bucket_name = "viddyscribe_bg_audio_samples"
+        self.bucket_name = BG_AUDIO_BUCKET
         self.gcs_files = [f'{category}_{i}.mp3' for i in range(1, 2)]
         self.selected_file = random.choice(self.gcs_files)
-        self.local_file = self.download_file(self.selected_file)
+        self.track = (library or get_music_library()).track(self.selected_file)
         self.current_position = 0 
 
-    def download_file(self, gcs_file):
-        local_file = f'/tmp/{os.path.basename(gcs_file)}'
-        download_from_gcs(self.bucket_name, gcs_file, local_file)
-        return local_file
-
     def generate_music_from_collection(self, duration):
-        audio_clip = AudioFileClip(self.local_file)
+        # Returns a MusicClip of the next `duration` seconds of the track
         start_time = self.current_position
         end_time = start_time + duration
 
-        if end_time > audio_clip.duration:
+        if end_time > self.track.duration:
             # Reset to start from 0 to duration
             start_time = 0
             end_time = duration
@@ -31,7 +103,4 @@ class BackgroundAudioGenerator():
         else:
             self.current_position = end_time
 
-        subclip = audio_clip.subclip(start_time, end_time)
-        temp_music_path = f"/tmp/temp_music_{uuid.uuid4()}.mp3"
-        subclip.write_audiofile(temp_music_path)
-        return temp_music_path
\ No newline at end of file
+        return self.track.clip(start_time, end_time)
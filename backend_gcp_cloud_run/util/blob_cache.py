@@ -0,0 +1,129 @@
+import os
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from util.gcs_bucket import download_from_gcs
+
+BLOB_CACHE_DIR = os.getenv("BLOB_CACHE_DIR", "/tmp/viddyscribe/blob_cache")
+BLOB_CACHE_MAX_BYTES = int(os.getenv("BLOB_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+
+def blob_cache_key(bucket_name, blob_name):
+    return hashlib.sha256(f"{bucket_name}/{blob_name}".encode("utf-8")).hexdigest()
+
+
+class BlobCache():
+    # Local copies of objects that are served repeatedly, like the sample
+    # videos. Entries are plain files, so they can be streamed with Range
+    # support instead of being held in memory. The directory is capped in size
+    # with LRU eviction. A hit refreshes the file's atime, not its mtime, which
+    # the ETag and Last-Modified headers are derived from.
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._fetch_locks = {}
+        # Entries being served, by key, with how many requests serve each
+        self._pins = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            # Skip in-flight temporary files, entries are named by their key only
+            if "." in name:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_atime))
+        return entries
+
+    def _fetch_lock(self, key):
+        with self._lock:
+            return self._fetch_locks.setdefault(key, threading.Lock())
+
+    def path(self, bucket_name, blob_name):
+        # Local path of the object, downloaded once however many requests
+        # ask for it at the same time
+        key = blob_cache_key(bucket_name, blob_name)
+        path = os.path.join(self.directory, key)
+        with self._fetch_lock(key):
+            try:
+                os.utime(path, (time.time(), os.stat(path).st_mtime))
+                with self._lock:
+                    self.hits += 1
+                return path
+            except FileNotFoundError:
+                pass
+
+            temp_path = f"{path}.{uuid.uuid4().hex}.download"
+            try:
+                download_from_gcs(bucket_name, blob_name, temp_path, parallel=True)
+                os.replace(temp_path, path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            with self._lock:
+                self.misses += 1
+            logging.info(f"Cached {blob_name} from bucket {bucket_name}")
+        self.evict(keep=path)
+        return path
+
+    @contextmanager
+    def pinned(self, bucket_name, blob_name):
+        # Like path(), but eviction leaves the entry alone until the block
+        # exits. Open the file inside it, an open file outlives its eviction.
+        key = blob_cache_key(bucket_name, blob_name)
+        with self._lock:
+            self._pins[key] = self._pins.get(key, 0) + 1
+        try:
+            yield self.path(bucket_name, blob_name)
+        finally:
+            with self._lock:
+                self._pins[key] -= 1
+                if not self._pins[key]:
+                    del self._pins[key]
+
+    def evict(self, keep=None):
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            # Removed under the lock, so an entry can't be pinned in between
+            with self._lock:
+                if os.path.basename(path) in self._pins:
+                    continue
+                try:
+                    os.remove(path)
+                    total -= size
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        return {"hits": hits, "misses": misses, "bytes": sum(size for _, size, _ in self._entries())}
+
+
+_blob_cache = None
+_blob_cache_lock = threading.Lock()
+
+
+def get_blob_cache():
+    global _blob_cache
+    with _blob_cache_lock:
+        if _blob_cache is None:
+            _blob_cache = BlobCache(BLOB_CACHE_DIR, BLOB_CACHE_MAX_BYTES)
+        return _blob_cache
@@ -1,15 +1,37 @@
 from google.cloud import storage
 import os
+import uuid
+import shutil
 import logging
 import json
+import base64
+import mimetypes
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import google_crc32c
+from google.api_core.exceptions import NotFound
+from google.cloud.storage import transfer_manager
 from google.oauth2 import service_account
 from urllib.parse import unquote
 
+# "gcs" or "local". The local backend keeps every bucket as a directory under
+# LOCAL_STORAGE_DIR, so the pipeline can run without Cloud Storage.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "gcs")
+LOCAL_STORAGE_DIR = os.getenv("LOCAL_STORAGE_DIR", "/tmp/viddyscribe/storage")
+SIGNED_URL_EXPIRATION = timedelta(minutes=15)
+# Objects larger than one chunk are moved as parallel ranged requests
+TRANSFER_CHUNK_BYTES = int(os.getenv("TRANSFER_CHUNK_BYTES", 16 * 1024 * 1024))
+TRANSFER_WORKERS = int(os.getenv("TRANSFER_WORKERS", 8))
+
+ObjectInfo = namedtuple("ObjectInfo", ["size", "crc32c"])
+
 def get_environment():
     return os.getenv('ENVIRONMENT', 'development')
 
 
-def get_storage_client():
+def create_storage_client():
     if get_environment() == 'development':
         # Explicitly use service account credentials from file
         credentials_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
@@ -29,46 +51,330 @@ def get_storage_client():
             return storage.Client(credentials=credentials)
 
 
+_storage_client = None
+_storage_client_lock = threading.Lock()
+
+
+def get_storage_client():
+    # One client, and so one HTTP connection pool, per process. It is created
+    # on first use, so importing this module needs no credentials.
+    global _storage_client
+    with _storage_client_lock:
+        if _storage_client is None:
+            _storage_client = create_storage_client()
+        return _storage_client
+
+
+class Storage():
+    # Object storage used by the pipeline. Missing objects raise NotFound on
+    # every backend.
+
+    def upload(self, bucket_name, source_file_name, destination_blob_name):
+        raise NotImplementedError
+
+    def upload_stream(self, bucket_name, chunks, destination_blob_name, content_type=None):
+        # Uploads an iterable of byte chunks without a local copy. Returns the
+        # ObjectInfo of what was sent, checksummed on the fly.
+        raise NotImplementedError
+
+    def download(self, bucket_name, source_blob_name, destination_file_name):
+        raise NotImplementedError
+
+    def download_bytes(self, bucket_name, blob_name):
+        raise NotImplementedError
+
+    def stat(self, bucket_name, blob_name):
+        # ObjectInfo, crc32c is the base64 checksum when the backend has one
+        raise NotImplementedError
+
+    def read_range(self, bucket_name, blob_name, start, end):
+        # Bytes [start, end) of the object
+        raise NotImplementedError
+
+    def delete(self, bucket_name, blob_name):
+        raise NotImplementedError
+
+    def signed_url(self, bucket_name, blob_name, method="GET", expiration=SIGNED_URL_EXPIRATION, content_type=None):
+        raise NotImplementedError
+
+
+class GCSStorage(Storage):
+    # Transfers are verified with CRC32C by the client library, which raises
+    # DataCorruption on a mismatch, so no extra round-trip is needed to check
+    # that an upload landed.
+
+    def __init__(self, client=None):
+        self._client = client
+
+    @property
+    def client(self):
+        return self._client or get_storage_client()
+
+    def blob(self, bucket_name, blob_name):
+        return self.client.bucket(bucket_name).blob(blob_name)
+
+    def upload(self, bucket_name, source_file_name, destination_blob_name):
+        blob = self.blob(bucket_name, destination_blob_name)
+        if os.path.getsize(source_file_name) > TRANSFER_CHUNK_BYTES and TRANSFER_WORKERS > 1:
+            # XML multipart upload, the parts are sent concurrently
+            transfer_manager.upload_chunks_concurrently(
+                source_file_name, blob,
+                chunk_size=TRANSFER_CHUNK_BYTES,
+                max_workers=TRANSFER_WORKERS,
+                worker_type=transfer_manager.THREAD,
+                checksum="crc32c",
+            )
+        else:
+            blob.upload_from_filename(source_file_name, checksum="crc32c")
+        return destination_blob_name
+
+    def upload_stream(self, bucket_name, chunks, destination_blob_name, content_type=None):
+        # Resumable upload, sent TRANSFER_CHUNK_BYTES at a time. The service
+        # checks the CRC32C at the end, and an upload that fails midway is
+        # cancelled instead of leaving a partial object. Like
+        # upload_from_filename, the content type defaults to the name's.
+        blob = self.blob(bucket_name, destination_blob_name)
+        content_type = content_type or mimetypes.guess_type(destination_blob_name)[0]
+        checksum = StreamChecksum()
+        with blob.open("wb", chunk_size=TRANSFER_CHUNK_BYTES, content_type=content_type, checksum="crc32c") as writer:
+            for chunk in chunks:
+                checksum.update(chunk)
+                writer.write(chunk)
+        return checksum.info()
+
+    def download(self, bucket_name, source_blob_name, destination_file_name):
+        self.blob(bucket_name, unquote(source_blob_name)).download_to_filename(destination_file_name, checksum="crc32c")
+        return destination_file_name
+
+    def download_bytes(self, bucket_name, blob_name):
+        return self.blob(bucket_name, blob_name).download_as_bytes(checksum="crc32c")
+
+    def stat(self, bucket_name, blob_name):
+        blob = self.client.bucket(bucket_name).get_blob(unquote(blob_name))
+        if blob is None:
+            raise NotFound(f"{blob_name} not found in bucket {bucket_name}")
+        return ObjectInfo(blob.size, blob.crc32c)
+
+    def read_range(self, bucket_name, blob_name, start, end):
+        # Ranges can't be checked against the object checksum, the assembled
+        # file is verified instead
+        return self.blob(bucket_name, unquote(blob_name)).download_as_bytes(start=start, end=end - 1, checksum=None)
+
+    def delete(self, bucket_name, blob_name):
+        self.blob(bucket_name, blob_name).delete()
+
+    def signed_url(self, bucket_name, blob_name, method="GET", expiration=SIGNED_URL_EXPIRATION, content_type=None):
+        return self.blob(bucket_name, blob_name).generate_signed_url(
+            version="v4",
+            expiration=expiration,
+            method=method,
+            content_type=content_type,
+        )
+
+
+class LocalStorage(Storage):
+    # Buckets are directories under root. Signed URLs are file:// URLs, which
+    # is enough for offline runs and benchmarks.
+
+    def __init__(self, root=LOCAL_STORAGE_DIR):
+        self.root = root
+
+    def path(self, bucket_name, blob_name):
+        path = os.path.abspath(os.path.join(self.root, bucket_name, unquote(blob_name)))
+        if not path.startswith(os.path.abspath(self.root) + os.sep):
+            raise ValueError(f"Invalid blob name: {blob_name}")
+        return path
+
+    def _existing_path(self, bucket_name, blob_name):
+        path = self.path(bucket_name, blob_name)
+        if not os.path.isfile(path):
+            raise NotFound(f"{blob_name} not found in bucket {bucket_name}")
+        return path
+
+    def upload(self, bucket_name, source_file_name, destination_blob_name):
+        path = self.path(bucket_name, destination_blob_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        shutil.copyfile(source_file_name, temp_path)
+        os.replace(temp_path, path)
+        return destination_blob_name
+
+    def upload_stream(self, bucket_name, chunks, destination_blob_name, content_type=None):
+        path = self.path(bucket_name, destination_blob_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        checksum = StreamChecksum()
+        try:
+            with open(temp_path, "wb") as f:
+                for chunk in chunks:
+                    checksum.update(chunk)
+                    f.write(chunk)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return checksum.info()
+
+    def download(self, bucket_name, source_blob_name, destination_file_name):
+        shutil.copyfile(self._existing_path(bucket_name, source_blob_name), destination_file_name)
+        return destination_file_name
+
+    def download_bytes(self, bucket_name, blob_name):
+        with open(self._existing_path(bucket_name, blob_name), "rb") as f:
+            return f.read()
+
+    def stat(self, bucket_name, blob_name):
+        return ObjectInfo(os.path.getsize(self._existing_path(bucket_name, blob_name)), None)
+
+    def read_range(self, bucket_name, blob_name, start, end):
+        with open(self._existing_path(bucket_name, blob_name), "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def delete(self, bucket_name, blob_name):
+        os.remove(self._existing_path(bucket_name, blob_name))
+
+    def signed_url(self, bucket_name, blob_name, method="GET", expiration=SIGNED_URL_EXPIRATION, content_type=None):
+        return f"file://{self.path(bucket_name, blob_name)}"
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def create_storage(backend=None):
+    backend = backend or STORAGE_BACKEND
+    if backend == "gcs":
+        return GCSStorage()
+    elif backend == "local":
+        return LocalStorage(LOCAL_STORAGE_DIR)
+    else:
+        raise ValueError(f"Unsupported storage backend: {backend}")
+
+
+def get_storage():
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            _storage = create_storage()
+            logging.info(f"Using storage: {type(_storage).__name__}")
+        return _storage
+
+
+def set_storage(backend_storage):
+    global _storage
+    with _storage_lock:
+        _storage = backend_storage
+
+
 # Add this new function to delete files from GCS
 def delete_from_gcs(bucket_name, blob_name):
-    storage_client = get_storage_client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    blob.delete()
+    get_storage().delete(bucket_name, blob_name)
 
 def upload_to_gcs(bucket_name, source_file_name, destination_blob_name):
-    storage_client = get_storage_client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
-    blob.upload_from_filename(source_file_name)
-    
-    # Check if the file exists in the bucket
-    if not blob.exists():
-        raise Exception(f"Failed to upload {destination_blob_name} to bucket {bucket_name}")
-    
-    return destination_blob_name 
-
-def download_from_gcs(bucket_name, source_blob_name, destination_file_name):
-    storage_client = get_storage_client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(unquote(source_blob_name))
-    
-    #logging.info(f"Starting download of {source_blob_name} from bucket {bucket_name} to {destination_file_name}")
-    blob.download_to_filename(destination_file_name)
-    
+    return get_storage().upload(bucket_name, source_file_name, destination_blob_name)
+
+def upload_stream_to_gcs(bucket_name, chunks, destination_blob_name, content_type=None):
+    return get_storage().upload_stream(bucket_name, chunks, destination_blob_name, content_type)
+
+def chunk_ranges(size, chunk_bytes):
+    return [(start, min(start + chunk_bytes, size)) for start in range(0, size, chunk_bytes)]
+
+
+class StreamChecksum():
+    # CRC32C and size of data seen a chunk at a time
+
+    def __init__(self):
+        self.checksum = google_crc32c.Checksum()
+        self.size = 0
+
+    def update(self, chunk):
+        self.checksum.update(chunk)
+        self.size += len(chunk)
+
+    def info(self):
+        return ObjectInfo(self.size, base64.b64encode(self.checksum.digest()).decode("utf-8"))
+
+
+def file_crc32c(path):
+    checksum = google_crc32c.Checksum()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            checksum.update(block)
+    return base64.b64encode(checksum.digest()).decode("utf-8")
+
+
+def sliced_download(storage, bucket_name, source_blob_name, destination_file_name, info, on_head=None):
+    ranges = chunk_ranges(info.size, TRANSFER_CHUNK_BYTES)
+    # The first and last chunks are fetched first. Containers keep their
+    # headers at one end (the mp4 moov atom at either), so the file can be
+    # probed while the middle is still downloading.
+    edges = [ranges[0], ranges[-1]] if len(ranges) > 1 else ranges
+    fd = os.open(destination_file_name, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, info.size)
+
+        def fetch(byte_range):
+            start, end = byte_range
+            data = storage.read_range(bucket_name, source_blob_name, start, end)
+            if len(data) != end - start:
+                raise Exception(f"Short read downloading {source_blob_name} bytes {start}-{end}")
+            os.pwrite(fd, data, start)
+
+        with ThreadPoolExecutor(max_workers=TRANSFER_WORKERS) as pool:
+            for future in [pool.submit(fetch, byte_range) for byte_range in edges]:
+                future.result()
+            pending = [pool.submit(fetch, byte_range) for byte_range in ranges[1:-1]]
+            if on_head:
+                on_head(destination_file_name)
+            for future in pending:
+                future.result()
+    finally:
+        os.close(fd)
+
+    if info.crc32c and file_crc32c(destination_file_name) != info.crc32c:
+        raise Exception(f"Checksum mismatch downloading {source_blob_name} from bucket {bucket_name}")
+
+
+def download_from_gcs(bucket_name, source_blob_name, destination_file_name, parallel=False, on_head=None):
+    # parallel fetches large objects as concurrent ranged reads, which costs an
+    # extra metadata request, so it's meant for the input videos. on_head is
+    # called with the path as soon as both ends of the file are on disk.
+    storage = get_storage()
+    info = storage.stat(bucket_name, source_blob_name) if parallel else None
+    if info and info.size > TRANSFER_CHUNK_BYTES and TRANSFER_WORKERS > 1:
+        sliced_download(storage, bucket_name, source_blob_name, destination_file_name, info, on_head)
+    else:
+        storage.download(bucket_name, source_blob_name, destination_file_name)
+        if on_head:
+            on_head(destination_file_name)
+
     if os.path.getsize(destination_file_name) == 0:
         logging.error(f"Downloaded file {destination_file_name} is empty.")
         raise Exception(f"Failed to download {source_blob_name} from bucket {bucket_name}")
-    
+
     #logging.info(f"Successfully downloaded {source_blob_name} to {destination_file_name}")
     return destination_file_name
 
+def download_bytes_from_gcs(bucket_name, blob_name):
+    return get_storage().download_bytes(bucket_name, blob_name)
+
+def generate_signed_url(bucket_name, blob_name, method="GET", expiration=SIGNED_URL_EXPIRATION, content_type=None):
+    return get_storage().signed_url(bucket_name, blob_name, method, expiration, content_type)
+
 def download_multiple_from_gcs(bucket_name, source_blob_names, destination_file_names):
-    storage_client = get_storage_client()
     if len(source_blob_names) != len(destination_file_names):
         raise ValueError("Source and destination lists must have the same length")
-    
-    for source_blob_name, destination_file_name in zip(source_blob_names, destination_file_names):
-        download_from_gcs(bucket_name, source_blob_name, destination_file_name)
-    
-    return destination_file_names
\ No newline at end of file
+
+    if not source_blob_names:
+        return destination_file_names
+    # The storage client is thread safe, the objects are fetched concurrently
+    with ThreadPoolExecutor(max_workers=min(TRANSFER_WORKERS, len(source_blob_names))) as pool:
+        futures = [
+            pool.submit(download_from_gcs, bucket_name, source_blob_name, destination_file_name)
+            for source_blob_name, destination_file_name in zip(source_blob_names, destination_file_names)
+        ]
+        for future in futures:
+            future.result()
+
+    return destination_file_names
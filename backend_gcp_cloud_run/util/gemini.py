@@ -1,9 +1,8 @@
 import os
 import json
+import logging
 import subprocess
 import time
-import base64
-from moviepy.editor import VideoFileClip
 import warnings
 import vertexai
 from vertexai.generative_models import GenerativeModel, Part
@@ -11,7 +10,27 @@ import vertexai.preview.generative_models as generative_models
 from google.oauth2 import service_account
 import google.auth.transport.requests
 import random
+from util.analysis_cache import get_analysis_cache, analysis_cache_key, file_sha256
+from util.gcs_bucket import STORAGE_BACKEND
 
+PRO_MODEL_NAME = "gemini-1.5-pro-002"
+FLASH_MODEL_NAME = "gemini-1.5-flash-002"
+
+
+def default_input_mode(storage_backend=STORAGE_BACKEND):
+    # Videos in Cloud Storage are referenced by URI. Only with local storage,
+    # which the model can't read, is the video sent with the request.
+    return "uri" if storage_backend == "gcs" else "inline"
+
+
+# "inline" sends the video bytes with the request, "uri" references an object
+# that is already in Cloud Storage so no video bytes pass through this process
+GEMINI_INPUT_MODE = os.getenv("GEMINI_INPUT_MODE") or default_input_mode()
+GENERATION_CONFIG = {
+    "max_output_tokens": 8192,
+    "temperature": 0.7,
+    "top_p": 0.95,
+}
 
 # Suppress specific warnings
 warnings.filterwarnings("ignore", category=UserWarning, module="moviepy")
@@ -21,10 +40,10 @@ class VertexAIUtility():
         vertexai.init(project="viddyscribe", location="us-east4")
         #vertexai.init(project="planar-abbey-418313", location="us-central1")  # Initialize here
         self.proModel = GenerativeModel(
-            "gemini-1.5-pro-002",
+            PRO_MODEL_NAME,
         )
         self.flashModel = GenerativeModel(
-            "gemini-1.5-flash-002",
+            FLASH_MODEL_NAME,
         )
         pass
 
@@ -48,25 +67,11 @@ class VertexAIUtility():
         )
         return video1
     
-    def load_video_b64(self, file_path):
-        # Load the video file synchronously
-        with open(file_path, "rb") as f:
-            video_data = f.read()
-        encoded_video_data = base64.b64encode(video_data).decode('utf-8')
-        return encoded_video_data  # Return the base64 encoded video data
+    def video_part(self, file_path, video_uri=None):
+        if video_uri:
+            return Part.from_uri(video_uri, mime_type="video/mp4")
+        return self.load_video(file_path)
 
-    def validate_video(self, file_path):
-        #vertexai.init(project="planar-abbey-418313", location="us-central1")  # Initialize here
-        try:
-            clip = VideoFileClip(file_path)
-            duration = clip.duration
-            clip.close()
-            return duration > 0
-        except Exception as e:
-            print(f"Error loading video: {e}")
-            return False
-                  
-    
     # def get_info_from_video(self, video_path, inst):
     #     video1 = self.load_video(video_path)
     #     generation_config = {
@@ -97,19 +102,29 @@ class VertexAIUtility():
 
     #     end_time = time.time()  # End time measurement
     #     time_taken = end_time - start_time  # Calculate time taken
-    #     print(f"Time taken for response: {time_taken} seconds")  # Print time taken
-    #     print({"Gemini response": result})
+    #     logging.info(f"Time taken for response: {time_taken} seconds")
+    #     logging.info(f"Gemini response: {result}")
 
     #     return {"description": result}
 
 
-    def get_info_from_video(self, video_path, inst):
-        video1 = self.load_video(video_path)
-        generation_config = {
-            "max_output_tokens": 8192,
-            "temperature": 0.7,
-            "top_p": 0.95,
-        }
+    def get_info_from_video(self, video_path, inst, video_hash=None, bypass_cache=False, video_uri=None, prepare_input=None):
+        # Identical analysis of the same video bytes is served from the cache.
+        # prepare_input, if given, returns the (path, uri) to send and is only
+        # called on a miss, so inputs that are costly to make are made lazily.
+        video_hash = video_hash or file_sha256(video_path)
+        key = analysis_cache_key(video_hash, PRO_MODEL_NAME, inst, GENERATION_CONFIG)
+
+        def compute():
+            input_path, input_uri = prepare_input() if prepare_input else (video_path, video_uri)
+            result = self._get_info_from_video(input_path, inst, input_uri)
+            return result, not result["description"].startswith("Error: ")
+
+        return get_analysis_cache().get_or_compute(key, compute, bypass=bypass_cache)
+
+    def _get_info_from_video(self, video_path, inst, video_uri=None):
+        video1 = self.video_part(video_path, video_uri)
+        generation_config = GENERATION_CONFIG
         safety_settings = {
             generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
             generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
@@ -144,27 +159,27 @@ class VertexAIUtility():
 
                 end_time = time.time()
                 time_taken = end_time - start_time
-                print(f"Time taken for response: {time_taken} seconds")
-                print({"Gemini response": result})
+                logging.info(f"Time taken for response: {time_taken} seconds")
+                logging.info(f"Gemini response: {result}")
 
                 return {"description": result}
 
             except Exception as e:
-                print(f"Error in video analysis (Attempt {attempt + 1}/{max_retries}): {str(e)}")
+                logging.warning(f"Error in video analysis (Attempt {attempt + 1}/{max_retries}): {str(e)}")
                 if attempt < max_retries - 1:
                     wait_time = (2 ** attempt) + random.uniform(0, 1)  # Exponential backoff with jitter
-                    print(f"Retrying in {wait_time:.2f} seconds...")
+                    logging.info(f"Retrying in {wait_time:.2f} seconds...")
                     time.sleep(wait_time)
                 else:
                     return {"description": f"Error: Failed after {max_retries} attempts. Last error: {str(e)}"}
 
 
-    def gemini_llm(self, prompt, inst):
-        generation_config = {
-            "max_output_tokens": 8192,
-            "temperature": 0.7,
-            "top_p": 0.95,
-        }
+    def gemini_llm(self, prompt, inst, bypass_cache=False):
+        key = analysis_cache_key(None, FLASH_MODEL_NAME, inst + prompt, GENERATION_CONFIG)
+        return get_analysis_cache().get_or_compute(key, lambda: (self._gemini_llm(prompt, inst), True), bypass=bypass_cache)
+
+    def _gemini_llm(self, prompt, inst):
+        generation_config = GENERATION_CONFIG
         safety_settings = {
             generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
             generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
@@ -188,64 +203,11 @@ class VertexAIUtility():
 
         end_time = time.time()  # End time measurement
         time_taken = end_time - start_time  # Calculate time taken
-        print(f"Time taken for response: {time_taken} seconds")  # Print time taken
-        print({"Gemini response": result})
+        logging.info(f"Time taken for response: {time_taken} seconds")
+        logging.info(f"Gemini response: {result}")
 
         return {"description": result}
     
-    def get_info_from_video_curl(self, file_path, inst):
-        # Get the base64 encoded video data
-        encoded_video_data = self.load_video_b64(file_path)  # Use load_video_b64 to get base64 encoded data
-        # Prepare the JSON payload
-        payload = {
-            "contents": [
-                {
-                    "role": "user",
-                    "parts": [
-                        {
-                            "inlineData": {
-                                "mimeType": "video/mp4",
-                                "data": encoded_video_data  # Use the base64 encoded video data
-                            }
-                        },
-                        {
-                            "text": f"{inst}. Here is the video."
-                        }
-                    ]
-                }
-            ]
-        }
-
-        # Write the payload to a JSON file
-        with open('request.json', 'w') as json_file:
-            json.dump(payload, json_file)
-
-        # Obtain the access token using the service account key file
-        access_token = self.get_access_token()
-
-        # Prepare the curl command
-        curl_command = [
-            "curl",
-            "-X", "POST",
-            "-H", f"Authorization: Bearer {access_token}",  # Use the access token
-            "-H", "Content-Type: application/json",
-            "https://us-central1-aiplatform.googleapis.com/v1/projects/viddyscribe/locations/us-east4/publishers/google/models/gemini-1.5-pro-001:streamGenerateContent",
-            "-d", "@request.json"  # Use the JSON file as the data source
-        ]
-
-        start_time = time.time()  # Start time measurement
-
-        # Execute the curl command
-        result = subprocess.run(curl_command, capture_output=True, text=True)
-        response = result.stdout
-
-        end_time = time.time()  # End time measurement
-        time_taken = end_time - start_time  # Calculate time taken
-        print(f"Time taken for response: {time_taken} seconds")  # Print time taken
-        print({"Gemini response": response})
-
-        return {"description": response}
-
     def gemini_llm_curl(self, prompt, inst):
         # Obtain the access token using the service account key file
         access_token = self.get_access_token()
@@ -277,8 +239,8 @@ class VertexAIUtility():
 
         end_time = time.time()  # End time measurement
         time_taken = end_time - start_time  # Calculate time taken
-        print(f"Time taken for response: {time_taken} seconds")  # Print time taken
-        print({"Gemini response": response})
+        logging.info(f"Time taken for response: {time_taken} seconds")
+        logging.info(f"Gemini response: {response}")
 
         return {"description": response}
 
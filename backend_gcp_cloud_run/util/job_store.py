@@ -0,0 +1,559 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+import threading
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from util.Constants import BUCKET_NAME
+from util.gcs_bucket import get_storage_client
+
+# Job states. The human readable status message shown in the UI lives in the
+# "status" field, the state is what the backends index on.
+JOB_STATE_PROCESSING = "processing"
+JOB_STATE_COMPLETED = "completed"
+JOB_STATE_ERROR = "error"
+JOB_TERMINAL_STATES = (JOB_STATE_COMPLETED, JOB_STATE_ERROR)
+
+STATUS_PROCESSING = "Processing video... This may take 4-10 minutes. Keep this tab open."
+STATUS_COMPLETED = "Processing completed"
+STATUS_ERROR = "Error processing video"
+
+# Attempts of a GCS read-modify-write before giving up on contention
+GCS_UPDATE_ATTEMPTS = 10
+
+JOB_FIELDS = ("output_video_name", "state", "status", "gcs_url", "add_bg_music", "signed_url", "owner", "created_at", "updated_at", "stage", "progress", "lease_expires_at")
+
+# A job's owner renews its lease while it holds the job. A job whose lease
+# ran out is taken over, wherever its owner ran, since a Cloud Run instance
+# can't tell whether another instance is still alive.
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", 120))
+# Jobs untouched for this long are deleted by the housekeeping thread
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", 7 * 24 * 3600))
+JOB_RETENTION_INTERVAL = 3600
+
+# How often waiters re-read a job that is updated by another process. Updates
+# made in this process wake them right away.
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", 1.0))
+_job_updated = threading.Condition()
+
+
+def notify_job_updated():
+    with _job_updated:
+        _job_updated.notify_all()
+
+
+def update_applies(state, fields):
+    # A finished job only takes writes that finish it (again), so a late
+    # progress or queue status write can't reopen it
+    return state not in JOB_TERMINAL_STATES or fields.get("state") in JOB_TERMINAL_STATES
+
+
+def current_owner():
+    # Identifies the worker process that is running a job, so that jobs left
+    # behind by a dead process can be picked up again after a restart.
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def lease_expired(record, now=None):
+    # Records written before leases existed expire a lease after their last update
+    now = now or time.time()
+    expires_at = record.get("lease_expires_at") or record["updated_at"] + JOB_LEASE_SECONDS
+    return expires_at < now
+
+
+def owner_is_alive(owner):
+    if not owner:
+        return False
+    host, _, pid = owner.rpartition(":")
+    if host != socket.gethostname():
+        # We can't tell for processes on other hosts, their lease decides.
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        return True
+    return True
+
+
+class JobStore():
+    # Common interface for all job store backends. Records are plain dicts
+    # with the keys in JOB_FIELDS.
+
+    def __init__(self):
+        # Jobs this process holds and renews the lease of
+        self._held = set()
+
+    def get(self, output_video_name):
+        raise NotImplementedError
+
+    def put(self, record):
+        raise NotImplementedError
+
+    def update(self, output_video_name, fields):
+        # Sets the given fields atomically, without touching the others.
+        # Returns the record as it is afterwards, unchanged if
+        # update_applies() refused the write, or None for unknown jobs.
+        raise NotImplementedError
+
+    def list_by_state(self, state, limit=100):
+        raise NotImplementedError
+
+    def claim(self, output_video_name, expected_owner, new_owner):
+        raise NotImplementedError
+
+    def delete_older_than(self, max_age_seconds):
+        raise NotImplementedError
+
+    def create_job(self, output_video_name, gcs_url, add_bg_music, status=STATUS_PROCESSING):
+        now = time.time()
+        record = {
+            "output_video_name": output_video_name,
+            "state": JOB_STATE_PROCESSING,
+            "status": status,
+            "gcs_url": gcs_url,
+            "add_bg_music": bool(add_bg_music),
+            "signed_url": None,
+            "owner": current_owner(),
+            "created_at": now,
+            "updated_at": now,
+            "stage": None,
+            "progress": 0,
+            "lease_expires_at": now + JOB_LEASE_SECONDS,
+        }
+        self.put(record)
+        self._hold(output_video_name)
+        notify_job_updated()
+        return record
+
+    def _hold(self, output_video_name):
+        with _held_lock:
+            self._held.add(output_video_name)
+
+    def _release(self, output_video_name):
+        with _held_lock:
+            self._held.discard(output_video_name)
+
+    def renew_leases(self):
+        # Extends the lease of every unfinished job this process holds. Not
+        # an update_job(), so waiters aren't woken for nothing.
+        with _held_lock:
+            names = list(self._held)
+        for name in names:
+            try:
+                record = self.update(name, {"lease_expires_at": time.time() + JOB_LEASE_SECONDS})
+            except Exception as e:
+                logging.warning(f"Failed to renew the lease of job {name}: {e}")
+                continue
+            if record is None or record["state"] != JOB_STATE_PROCESSING or record["owner"] != current_owner():
+                self._release(name)
+
+    def update_job(self, output_video_name, **fields):
+        unknown = set(fields) - set(JOB_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown job fields: {', '.join(sorted(unknown))}")
+        fields["updated_at"] = time.time()
+        record = self.update(output_video_name, fields)
+        if record is None:
+            raise KeyError(f"Unknown job: {output_video_name}")
+        notify_job_updated()
+        return record
+
+    def mark_completed(self, output_video_name, signed_url):
+        self._release(output_video_name)
+        return self.update_job(output_video_name, state=JOB_STATE_COMPLETED, status=STATUS_COMPLETED, signed_url=signed_url)
+
+    def mark_error(self, output_video_name, status=STATUS_ERROR):
+        self._release(output_video_name)
+        return self.update_job(output_video_name, state=JOB_STATE_ERROR, status=status)
+
+    def get_status(self, output_video_name, default=None):
+        record = self.get(output_video_name)
+        if record is None:
+            return default
+        return record["status"]
+
+    def wait_for_update(self, output_video_name, since=None, timeout=25, poll_interval=None):
+        # Returns the job once it was updated after `since` (an updated_at
+        # value) or has finished, or as it is when the timeout runs out.
+        # Without `since` it returns right away.
+        poll_interval = poll_interval or JOB_POLL_SECONDS
+        deadline = time.time() + timeout
+        while True:
+            record = self.get(output_video_name)
+            if since is None or (record is not None and (record["updated_at"] > since or record["state"] != JOB_STATE_PROCESSING)):
+                return record
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return record
+            with _job_updated:
+                _job_updated.wait(min(poll_interval, remaining))
+
+    def get_signed_url(self, output_video_name):
+        record = self.get(output_video_name)
+        if record is None:
+            return None
+        return record.get("signed_url")
+
+    def claim_orphaned_jobs(self):
+        # Takes over processing jobs whose owner has died, found dead on this
+        # host or by its expired lease, and returns them so the caller can
+        # schedule them again.
+        me = current_owner()
+        claimed = []
+        for record in self.list_by_state(JOB_STATE_PROCESSING, limit=1000):
+            if record["owner"] == me:
+                continue
+            if not lease_expired(record) and owner_is_alive(record["owner"]):
+                continue
+            if self.claim(record["output_video_name"], record["owner"], me):
+                self._hold(record["output_video_name"])
+                record["owner"] = me
+                claimed.append(record)
+        return claimed
+
+
+class InMemoryJobStore(JobStore):
+    # Process local stand-in, used for tests and single worker setups.
+
+    def __init__(self):
+        super().__init__()
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def get(self, output_video_name):
+        with self._lock:
+            record = self._jobs.get(output_video_name)
+            return dict(record) if record else None
+
+    def put(self, record):
+        with self._lock:
+            self._jobs[record["output_video_name"]] = dict(record)
+
+    def update(self, output_video_name, fields):
+        with self._lock:
+            record = self._jobs.get(output_video_name)
+            if record is None:
+                return None
+            if update_applies(record["state"], fields):
+                record.update(fields)
+            return dict(record)
+
+    def list_by_state(self, state, limit=100):
+        with self._lock:
+            records = [dict(r) for r in self._jobs.values() if r["state"] == state]
+        records.sort(key=lambda r: r["updated_at"])
+        return records[:limit]
+
+    def claim(self, output_video_name, expected_owner, new_owner):
+        with self._lock:
+            record = self._jobs.get(output_video_name)
+            if record is None or record["owner"] != expected_owner:
+                return False
+            record["owner"] = new_owner
+            record["updated_at"] = time.time()
+            record["lease_expires_at"] = record["updated_at"] + JOB_LEASE_SECONDS
+            return True
+
+    def delete_older_than(self, max_age_seconds):
+        cutoff = time.time() - max_age_seconds
+        with self._lock:
+            stale = [name for name, r in self._jobs.items() if r["updated_at"] < cutoff]
+            for name in stale:
+                del self._jobs[name]
+        return len(stale)
+
+
+class SQLiteJobStore(JobStore):
+    # SQLite in WAL mode, so several gunicorn workers in the same container can
+    # read and write the job table concurrently.
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                output_video_name TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                status TEXT NOT NULL,
+                gcs_url TEXT,
+                add_bg_music INTEGER NOT NULL DEFAULT 0,
+                signed_url TEXT,
+                owner TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                stage TEXT,
+                progress INTEGER NOT NULL DEFAULT 0,
+                lease_expires_at REAL
+            )
+        """)
+        # Tables created before progress tracking and leases lack their columns
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        if "stage" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN stage TEXT")
+        if "progress" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN progress INTEGER NOT NULL DEFAULT 0")
+        if "lease_expires_at" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN lease_expires_at REAL")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_state_updated_at ON jobs (state, updated_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_updated_at ON jobs (updated_at)")
+        conn.commit()
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA busy_timeout=30000")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _to_record(self, row):
+        record = dict(row)
+        record["add_bg_music"] = bool(record["add_bg_music"])
+        return record
+
+    def get(self, output_video_name):
+        row = self._connection().execute("SELECT * FROM jobs WHERE output_video_name = ?", (output_video_name,)).fetchone()
+        return self._to_record(row) if row else None
+
+    def put(self, record):
+        values = [record.get(field) for field in JOB_FIELDS]
+        values[JOB_FIELDS.index("add_bg_music")] = int(bool(record.get("add_bg_music")))
+        values[JOB_FIELDS.index("progress")] = int(record.get("progress") or 0)
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO jobs ({', '.join(JOB_FIELDS)}) VALUES ({', '.join('?' * len(JOB_FIELDS))})",
+                values,
+            )
+
+    def update(self, output_video_name, fields):
+        # One UPDATE of just these columns, concurrent writers of other
+        # columns don't overwrite each other
+        values = dict(fields)
+        if "add_bg_music" in values:
+            values["add_bg_music"] = int(bool(values["add_bg_music"]))
+        if "progress" in values:
+            values["progress"] = int(values["progress"] or 0)
+        assignments = ", ".join(f"{field} = ?" for field in values)
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                f"UPDATE jobs SET {assignments} WHERE output_video_name = ? AND (state NOT IN (?, ?) OR ?)",
+                list(values.values()) + [output_video_name, *JOB_TERMINAL_STATES, int(fields.get("state") in JOB_TERMINAL_STATES)],
+            )
+        return self.get(output_video_name)
+
+    def list_by_state(self, state, limit=100):
+        rows = self._connection().execute(
+            "SELECT * FROM jobs WHERE state = ? ORDER BY updated_at LIMIT ?", (state, limit)
+        ).fetchall()
+        return [self._to_record(row) for row in rows]
+
+    def claim(self, output_video_name, expected_owner, new_owner):
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET owner = ?, updated_at = ?, lease_expires_at = ? WHERE output_video_name = ? AND owner IS ?",
+                (new_owner, now, now + JOB_LEASE_SECONDS, output_video_name, expected_owner),
+            )
+        return cursor.rowcount == 1
+
+    def delete_older_than(self, max_age_seconds):
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute("DELETE FROM jobs WHERE updated_at < ?", (time.time() - max_age_seconds,))
+        return cursor.rowcount
+
+
+class GCSJobStore(JobStore):
+    # One JSON object per job in a bucket. Slower than SQLite but shared by all
+    # Cloud Run instances, so a status lookup can land on any of them. The
+    # state and updated_at are also kept in each object's metadata, so listing
+    # and expiring jobs doesn't download every record.
+
+    def __init__(self, bucket_name, prefix="jobs/"):
+        super().__init__()
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.bucket = get_storage_client().bucket(bucket_name)
+
+    def _blob(self, output_video_name):
+        return self.bucket.blob(f"{self.prefix}{output_video_name}.json")
+
+    def _upload(self, blob, record, **kwargs):
+        blob.metadata = {"state": record["state"], "updated_at": repr(record["updated_at"])}
+        blob.upload_from_string(json.dumps(record), content_type="application/json", **kwargs)
+
+    def _listed_fields(self, blob):
+        # (state, updated_at) of a listed object, from its metadata when it has
+        # any. Objects written before the metadata are read.
+        metadata = blob.metadata or {}
+        if "state" in metadata and "updated_at" in metadata:
+            return metadata["state"], float(metadata["updated_at"])
+        try:
+            record = json.loads(blob.download_as_bytes())
+        except NotFound:
+            return None, None
+        return record["state"], record["updated_at"]
+
+    def get(self, output_video_name):
+        blob = self._blob(output_video_name)
+        try:
+            return json.loads(blob.download_as_bytes())
+        except NotFound:
+            return None
+
+    def put(self, record):
+        self._upload(self._blob(record["output_video_name"]), record)
+
+    def _read_for_update(self, blob):
+        # Reads the record at the blob's current generation, which a
+        # conditional upload can then check
+        blob.reload()
+        return json.loads(blob.download_as_bytes(if_generation_match=blob.generation))
+
+    def update(self, output_video_name, fields):
+        # Read-modify-write guarded by the object generation, retried when
+        # another writer got in between
+        blob = self._blob(output_video_name)
+        for _ in range(GCS_UPDATE_ATTEMPTS):
+            try:
+                record = self._read_for_update(blob)
+            except NotFound:
+                return None
+            except PreconditionFailed:
+                continue
+            if not update_applies(record["state"], fields):
+                return record
+            record.update(fields)
+            try:
+                self._upload(blob, record, if_generation_match=blob.generation)
+                return record
+            except PreconditionFailed:
+                continue
+        raise RuntimeError(f"Too much contention updating job {output_video_name}")
+
+    def list_by_state(self, state, limit=100):
+        matches = []
+        for blob in self.bucket.list_blobs(prefix=self.prefix):
+            blob_state, updated_at = self._listed_fields(blob)
+            if blob_state == state:
+                matches.append((updated_at, blob.name))
+        records = []
+        for _, name in sorted(matches)[:limit]:
+            try:
+                records.append(json.loads(self.bucket.blob(name).download_as_bytes()))
+            except NotFound:
+                pass
+        return records
+
+    def claim(self, output_video_name, expected_owner, new_owner):
+        # False when the job is gone or another claimer got in first
+        blob = self._blob(output_video_name)
+        try:
+            record = self._read_for_update(blob)
+        except (NotFound, PreconditionFailed):
+            return False
+        if record["owner"] != expected_owner:
+            return False
+        record["owner"] = new_owner
+        record["updated_at"] = time.time()
+        record["lease_expires_at"] = record["updated_at"] + JOB_LEASE_SECONDS
+        try:
+            # Only one claimer can win the generation precondition.
+            self._upload(blob, record, if_generation_match=blob.generation)
+        except (NotFound, PreconditionFailed):
+            return False
+        return True
+
+    def delete_older_than(self, max_age_seconds):
+        cutoff = time.time() - max_age_seconds
+        deleted = 0
+        for blob in self.bucket.list_blobs(prefix=self.prefix):
+            _, updated_at = self._listed_fields(blob)
+            if updated_at is None or updated_at >= cutoff:
+                continue
+            try:
+                blob.delete()
+                deleted += 1
+            except NotFound:
+                pass
+        return deleted
+
+
+_held_lock = threading.Lock()
+_job_store = None
+_job_store_lock = threading.Lock()
+
+
+def create_job_store(backend=None):
+    # "sqlite" is per container. Deployments with more than one instance need
+    # JOB_STORE_BACKEND=gcs, which the Dockerfile sets.
+    backend = backend or os.getenv("JOB_STORE_BACKEND", "sqlite")
+    if backend == "sqlite":
+        return SQLiteJobStore(os.getenv("JOB_STORE_PATH", "/tmp/viddyscribe/jobs.sqlite3"))
+    elif backend == "memory":
+        return InMemoryJobStore()
+    elif backend == "gcs":
+        return GCSJobStore(os.getenv("JOB_STORE_BUCKET", BUCKET_NAME))
+    else:
+        raise ValueError(f"Unsupported job store backend: {backend}")
+
+
+def get_job_store():
+    global _job_store
+    with _job_store_lock:
+        if _job_store is None:
+            _job_store = create_job_store()
+            logging.info(f"Using job store: {type(_job_store).__name__}")
+        return _job_store
+
+
+def set_job_store(store):
+    global _job_store
+    with _job_store_lock:
+        _job_store = store
+
+
+_housekeeper = None
+
+
+def start_job_housekeeping(store, interval=None):
+    # Renews the leases of this process's jobs every third of the lease, and
+    # deletes old jobs once an hour, in a daemon thread
+    global _housekeeper
+    interval = interval or JOB_LEASE_SECONDS / 3
+
+    def run():
+        last_cleanup = 0
+        while True:
+            store.renew_leases()
+            if time.time() - last_cleanup >= JOB_RETENTION_INTERVAL:
+                last_cleanup = time.time()
+                try:
+                    deleted = store.delete_older_than(JOB_RETENTION_SECONDS)
+                    if deleted:
+                        logging.info(f"Deleted {deleted} jobs older than {JOB_RETENTION_SECONDS:.0f}s")
+                except Exception as e:
+                    logging.warning(f"Failed to delete old jobs: {e}")
+            time.sleep(interval)
+
+    with _job_store_lock:
+        if _housekeeper is None:
+            _housekeeper = threading.Thread(target=run, name="job-housekeeping", daemon=True)
+            _housekeeper.start()
+        return _housekeeper
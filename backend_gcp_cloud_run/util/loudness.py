@@ -0,0 +1,176 @@
+import os
+import uuid
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Loudness is summarized per window of HOP_SECONDS. Range queries are answered
+# on whole windows, which is plenty for gain decisions.
+HOP_SECONDS = 0.05
+LOUDNESS_CACHE_DIR = os.getenv("LOUDNESS_CACHE_DIR", "/tmp/viddyscribe/loudness")
+# An index is about 1 KB per minute of audio, compressed
+LOUDNESS_CACHE_MAX_BYTES = int(os.getenv("LOUDNESS_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+MEMORY_CACHE_SIZE = 16
+# Windows summarized at a time, about 18 MB of 44.1 kHz stereo float32
+LOUDNESS_CHUNK_WINDOWS = 1024
+
+
+class LoudnessIndex():
+    # Windowed peak and RMS of a track, built in one pass. peak() uses a sparse
+    # table and rms() uses prefix sums, so every query is O(1).
+
+    def __init__(self, window_peaks, energy_prefix, hop_seconds, window_samples, channels, duration):
+        self.hop_seconds = hop_seconds
+        self.window_samples = window_samples
+        self.channels = channels
+        self.duration = duration
+        self.energy_prefix = energy_prefix
+        # levels[k][i] is the max of window_peaks[i:i + 2**k]
+        self.levels = [window_peaks]
+        width = 1
+        while width * 2 <= len(window_peaks):
+            previous = self.levels[-1]
+            self.levels.append(np.maximum(previous[:-width], previous[width:]))
+            width *= 2
+        self.max_volume = float(window_peaks.max()) if len(window_peaks) else 0.0
+
+    @classmethod
+    def from_samples(cls, samples, sample_rate, hop_seconds=HOP_SECONDS):
+        # Windows are summarized a chunk at a time, so a memmapped track is
+        # never copied into memory whole. Only the last partial window is padded.
+        window_samples = max(int(round(hop_seconds * sample_rate)), 1)
+        channels = samples.shape[1] if samples.ndim > 1 else 1
+        n_full = len(samples) // window_samples
+        n_windows = -(-len(samples) // window_samples)
+        window_peaks = np.zeros(n_windows, dtype=np.float32)
+        energy = np.zeros(n_windows, dtype=np.float64)
+
+        def summarize(first, frames):
+            window_peaks[first:first + len(frames)] = np.abs(frames).max(axis=1)
+            energy[first:first + len(frames)] = np.einsum("ij,ij->i", frames, frames, dtype=np.float64)
+
+        for first in range(0, n_full, LOUDNESS_CHUNK_WINDOWS):
+            count = min(LOUDNESS_CHUNK_WINDOWS, n_full - first)
+            chunk = np.asarray(samples[first * window_samples:(first + count) * window_samples], dtype=np.float32)
+            summarize(first, chunk.reshape(count, -1))
+        if n_windows > n_full:
+            last = np.zeros((window_samples,) + samples.shape[1:], dtype=np.float32)
+            tail = samples[n_full * window_samples:]
+            last[:len(tail)] = tail
+            summarize(n_full, last.reshape(1, -1))
+        energy_prefix = np.concatenate([[0.0], np.cumsum(energy)])
+        return cls(window_peaks, energy_prefix, hop_seconds, window_samples, channels, len(samples) / sample_rate)
+
+    def _windows(self, start, end):
+        n = len(self.levels[0])
+        if start is None:
+            start = 0
+        if end is None:
+            end = self.duration
+        first = min(max(int(start / self.hop_seconds), 0), n)
+        last = min(max(int(np.ceil(end / self.hop_seconds)), first), n)
+        return first, last
+
+    def peak(self, start=None, end=None):
+        first, last = self._windows(start, end)
+        if last <= first:
+            return 0.0
+        level = (last - first).bit_length() - 1
+        table = self.levels[level]
+        return float(max(table[first], table[last - (1 << level)]))
+
+    def rms(self, start=None, end=None):
+        first, last = self._windows(start, end)
+        if last <= first:
+            return 0.0
+        energy = self.energy_prefix[last] - self.energy_prefix[first]
+        count = (last - first) * self.window_samples * self.channels
+        return float(np.sqrt(energy / count))
+
+    def save(self, path):
+        np.savez_compressed(
+            path,
+            window_peaks=self.levels[0],
+            energy_prefix=self.energy_prefix,
+            meta=np.array([self.hop_seconds, self.window_samples, self.channels, self.duration]),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            hop_seconds, window_samples, channels, duration = data["meta"]
+            return cls(data["window_peaks"], data["energy_prefix"], float(hop_seconds), int(window_samples), int(channels), float(duration))
+
+
+_memory_cache = OrderedDict()
+_memory_cache_lock = threading.Lock()
+
+
+def _cache_path(cache_key):
+    return os.path.join(LOUDNESS_CACHE_DIR, hashlib.sha1(cache_key.encode()).hexdigest() + ".npz")
+
+
+def evict_disk_cache(keep=None, max_bytes=None):
+    # LRU by mtime, which a load refreshes, like the TTS cache
+    max_bytes = LOUDNESS_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    for name in os.listdir(LOUDNESS_CACHE_DIR):
+        # Skip in-flight temporary files
+        if name.count(".") > 1:
+            continue
+        path = os.path.join(LOUDNESS_CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((path, stat.st_size, stat.st_mtime))
+    total = sum(size for _, size, _ in entries)
+    for path, size, _ in sorted(entries, key=lambda entry: entry[2]):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except FileNotFoundError:
+            pass
+
+
+def get_loudness_index(cache_key, samples, sample_rate):
+    # Keyed by the content of the source (its hash), so re-renders of the same
+    # video reuse the index. Checked in memory first, then on disk.
+    with _memory_cache_lock:
+        if cache_key in _memory_cache:
+            _memory_cache.move_to_end(cache_key)
+            return _memory_cache[cache_key]
+
+    path = _cache_path(cache_key)
+    index = None
+    if os.path.exists(path):
+        try:
+            index = LoudnessIndex.load(path)
+            os.utime(path)
+            logging.info(f"Loaded loudness index for {cache_key} from {path}")
+        except Exception as e:
+            logging.warning(f"Failed to load loudness index from {path}: {e}")
+    if index is None or abs(index.duration - len(samples) / sample_rate) > index.hop_seconds:
+        index = LoudnessIndex.from_samples(samples, sample_rate)
+        os.makedirs(LOUDNESS_CACHE_DIR, exist_ok=True)
+        temp_path = f"{path[:-len('.npz')]}.{uuid.uuid4().hex}.npz"
+        try:
+            index.save(temp_path)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        evict_disk_cache(keep=path)
+        logging.info(f"Built loudness index for {cache_key}: {len(index.levels[0])} windows")
+
+    with _memory_cache_lock:
+        _memory_cache[cache_key] = index
+        while len(_memory_cache) > MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+    return index
@@ -0,0 +1,119 @@
+import os
+import json
+import logging
+import threading
+import subprocess
+from fractions import Fraction
+
+
+def ffprobe_binary():
+    return os.getenv("FFPROBE_BINARY", "ffprobe")
+
+
+def probe_keyframes(video_path):
+    # Reads packet flags only, nothing is decoded
+    command = [
+        ffprobe_binary(), "-v", "error", "-select_streams", "v:0",
+        "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", video_path,
+    ]
+    result = subprocess.run(command, capture_output=True, check=True)
+    keyframes = []
+    for line in result.stdout.decode().splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" in flags and pts_time not in ("", "N/A"):
+            keyframes.append(float(pts_time))
+    return sorted(keyframes)
+
+
+def frame_rate(stream):
+    for key in ("avg_frame_rate", "r_frame_rate"):
+        value = stream.get(key, "0/0")
+        if value and not value.endswith("/0") and Fraction(value) > 0:
+            return Fraction(value)
+    return Fraction(25)
+
+
+class MediaInfo():
+    # What the pipeline needs to know about an input, from a single ffprobe
+    # call. The keyframe index, the content hash and the moviepy clip are only
+    # loaded when first needed, then reused by every stage of the job.
+
+    def __init__(self, path, streams, format_info):
+        self.path = path
+        self.streams = streams
+        self.format = format_info
+        self.duration = float(format_info.get("duration") or 0)
+        video_streams = [stream for stream in streams if stream.get("codec_type") == "video"]
+        audio_streams = [stream for stream in streams if stream.get("codec_type") == "audio"]
+        # The renderer works with the container duration, not the stream's own
+        self.video_stream = dict(video_streams[0], duration=self.duration) if video_streams else None
+        self.audio_stream = audio_streams[0] if audio_streams else None
+        self.has_audio = self.audio_stream is not None
+        self.fps = frame_rate(self.video_stream) if self.video_stream else None
+        self._keyframes = None
+        self._content_hash = None
+        self._clip = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def probe(cls, path):
+        command = [ffprobe_binary(), "-v", "error", "-show_streams", "-show_format", "-of", "json", path]
+        result = subprocess.run(command, capture_output=True, check=True)
+        info = json.loads(result.stdout)
+        return cls(path, info.get("streams", []), info.get("format", {}))
+
+    @property
+    def keyframes(self):
+        with self._lock:
+            if self._keyframes is None:
+                self._keyframes = probe_keyframes(self.path)
+            return self._keyframes
+
+    @property
+    def content_hash(self):
+        # SHA-256 of the file, the cache key of everything derived from its content
+        from util.analysis_cache import file_sha256
+        with self._lock:
+            if self._content_hash is None:
+                self._content_hash = file_sha256(self.path)
+            return self._content_hash
+
+    def video_clip(self):
+        # Shared moviepy reader for the fallback render, closed by close()
+        from moviepy.editor import VideoFileClip
+        with self._lock:
+            if self._clip is None:
+                self._clip = VideoFileClip(self.path, audio=False)
+            return self._clip
+
+    def close(self):
+        with self._lock:
+            if self._clip is not None:
+                self._clip.close()
+                self._clip = None
+
+
+# Containers whose duration and stream layout come from the header, so a file
+# with only its first and last chunks downloaded probes the same as a whole one
+HEADER_PROBE_FORMATS = ("mov", "mp4", "matroska", "webm")
+
+
+def probe_partial(path):
+    # MediaInfo from a file that is still downloading, or None when the result
+    # can't be trusted and the file has to be probed once complete
+    try:
+        media = MediaInfo.probe(path)
+    except (OSError, subprocess.CalledProcessError, ValueError) as e:
+        logging.info(f"Could not probe partial download {path}: {e}")
+        return None
+    format_names = media.format.get("format_name", "").split(",")
+    if media.video_stream is None or media.duration <= 0 or not any(name in HEADER_PROBE_FORMATS for name in format_names):
+        return None
+    logging.info(f"Probed partial download {path}: duration {media.duration}s, audio: {media.has_audio}")
+    return media
+
+
+def probe_media(path):
+    media = MediaInfo.probe(path)
+    logging.info(f"Probed {path}: duration {media.duration}s, {len(media.streams)} streams, audio: {media.has_audio}")
+    return media
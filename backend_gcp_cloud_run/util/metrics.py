@@ -0,0 +1,145 @@
+import math
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Upper bounds in seconds. Stages run from milliseconds (cache hits) to
+# several minutes (encoding a long video).
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# The job a span belongs to. Set once per job, it follows the job into its
+# tasks and, through run_in_stage and asyncio.to_thread, into worker threads.
+current_job = contextvars.ContextVar("current_job", default=None)
+
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [(name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for name, value in pairs]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Histogram():
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    def samples(self, label_values):
+        with self._lock:
+            series = self._series.get(tuple(label_values))
+            return dict(series, counts=list(series["counts"])) if series else None
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((label_values, dict(value, counts=list(value["counts"]))) for label_values, value in self._series.items())
+        for label_values, value in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, value["counts"]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names, label_values, [('le', format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, label_values)} {format_value(value['sum'])}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, label_values)} {value['count']}")
+        return lines
+
+
+class CallbackMetric():
+    # A gauge or counter read at scrape time. The callback returns a number, or
+    # a dict from label value tuples to numbers.
+
+    def __init__(self, name, help_text, metric_type, callback, label_names=()):
+        self.name = name
+        self.help = help_text
+        self.type = metric_type
+        self.callback = callback
+        self.label_names = tuple(label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        try:
+            values = self.callback()
+        except Exception as e:
+            logging.warning(f"Failed to collect metric {self.name}: {e}")
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in sorted(values.items()):
+            lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}")
+        return lines
+
+
+class MetricsRegistry():
+    # In-process metrics in the Prometheus text format. Each gunicorn worker
+    # has its own registry, so a scrape sees the worker that answered it.
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, label_names, buckets))
+
+    def gauge(self, name, help_text, callback, label_names=()):
+        return self._register(CallbackMetric(name, help_text, "gauge", callback, label_names))
+
+    def counter(self, name, help_text, callback, label_names=()):
+        return self._register(CallbackMetric(name, help_text, "counter", callback, label_names))
+
+    def render(self):
+        with self._lock:
+            metrics = [self._metrics[name] for name in sorted(self._metrics)]
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+stage_seconds = registry.histogram("viddyscribe_stage_seconds", "Wall time of pipeline stages", ["stage", "status"])
+
+
+@contextmanager
+def span(name, job_id=None):
+    # Times a pipeline stage into viddyscribe_stage_seconds and logs it with
+    # the job id. Works in both plain and async code.
+    job_id = job_id or current_job.get()
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        stage_seconds.observe(seconds, name, status)
+        logging.info(f"span stage={name} job={job_id} status={status} seconds={seconds:.3f}")
@@ -0,0 +1,61 @@
+import os
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Field, File, Data, Epilogue
+
+# Bytes read from the request body at a time
+UPLOAD_READ_BYTES = int(os.getenv("UPLOAD_READ_BYTES", 256 * 1024))
+# Text fields and part headers are held in memory, file parts never are
+MAX_FORM_FIELD_BYTES = 64 * 1024
+
+
+def multipart_events(stream, boundary, read_bytes=UPLOAD_READ_BYTES):
+    # The limit is on the decoder's unparsed buffer, which holds at most one
+    # read plus a part's headers
+    decoder = MultipartDecoder(boundary, max_form_memory_size=read_bytes + MAX_FORM_FIELD_BYTES)
+    while True:
+        try:
+            event = decoder.next_event()
+        except ValueError as e:
+            # The body ended (or broke off) in the middle of a part
+            raise BadRequest(f"Malformed multipart body: {e}")
+        if isinstance(event, NeedData):
+            decoder.receive_data(stream.read(read_bytes) or None)
+        elif isinstance(event, Epilogue):
+            return
+        elif isinstance(event, (Field, File, Data)):
+            yield event
+
+
+def read_multipart(stream, boundary, on_file, read_bytes=UPLOAD_READ_BYTES):
+    # Parses a multipart/form-data body while it arrives. Text fields are
+    # collected, and each file part goes to on_file(name, filename, chunks),
+    # with chunks an iterator over the part's data, so it can be passed on
+    # without being buffered. Returns the fields and what on_file returned,
+    # both by field name.
+    events = multipart_events(stream, boundary, read_bytes)
+    fields = {}
+    files = {}
+
+    def part_data():
+        for event in events:
+            if event.data:
+                yield event.data
+            if not event.more_data:
+                return
+        raise BadRequest("Malformed multipart body: the body ended inside a part")
+
+    for event in events:
+        if isinstance(event, Field):
+            value = bytearray()
+            for data in part_data():
+                value += data
+                if len(value) > MAX_FORM_FIELD_BYTES:
+                    raise RequestEntityTooLarge(f"Form field {event.name} is too large")
+            fields[event.name] = value.decode("utf-8", "replace")
+        elif isinstance(event, File):
+            chunks = part_data()
+            files[event.name] = on_file(event.name, event.filename, chunks)
+            # Skip whatever on_file didn't read
+            for _ in chunks:
+                pass
+    return fields, files
@@ -0,0 +1,98 @@
+import os
+import time
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+# Share of the job each stage accounts for, in pipeline order. With the
+# streaming pipeline speech and render overlap, the percentage is the
+# weighted sum of every stage's own fraction.
+STAGE_WEIGHTS = (
+    ("download", 5),
+    ("analysis", 20),
+    ("speech", 25),
+    ("render", 45),
+    ("upload", 5),
+)
+STAGE_STATUS = {
+    "download": "Downloading video",
+    "analysis": "Describing the video",
+    "speech": "Generating narration",
+    "render": "Rendering the described video",
+    "upload": "Uploading the result",
+}
+# Progress is written to the job store at most this often, stage changes are
+# written right away
+PROGRESS_MIN_INTERVAL = float(os.getenv("PROGRESS_MIN_INTERVAL", 1.0))
+
+# The progress of the job being run, if any. Like metrics.current_job it
+# follows the job into its tasks and stage threads.
+current_progress = contextvars.ContextVar("current_progress", default=None)
+
+# Store writes happen off the caller's thread, which may be the event loop
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="progress")
+
+
+def progress_status(stage, percent):
+    return f"{STAGE_STATUS[stage]} ({percent}%). Keep this tab open."
+
+
+class JobProgress():
+    def __init__(self, output_video_name, store, min_interval=PROGRESS_MIN_INTERVAL):
+        self.output_video_name = output_video_name
+        self.store = store
+        self.min_interval = min_interval
+        self.stage = None
+        self.percent = 0
+        self._fractions = {}
+        self._written = (None, -1)
+        self._written_at = 0.0
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def update(self, stage, fraction=0.0):
+        order = [name for name, _ in STAGE_WEIGHTS]
+        with self._lock:
+            self._fractions[stage] = max(self._fractions.get(stage, 0.0), min(max(fraction, 0.0), 1.0))
+            # The label is the furthest stage reached, the percentage never goes back
+            self.stage = max(self._fractions, key=order.index)
+            total = sum(weight for _, weight in STAGE_WEIGHTS)
+            done = sum(weight * self._fractions.get(name, 0.0) for name, weight in STAGE_WEIGHTS)
+            self.percent = max(self.percent, int(done * 100 / total))
+            now = time.time()
+            written_stage, written_percent = self._written
+            due = self.stage != written_stage or (self.percent > written_percent and now - self._written_at >= self.min_interval)
+            if not due:
+                return
+            self._written = (self.stage, self.percent)
+            self._written_at = now
+            self._pending = _writer.submit(self._write, self.stage, self.percent)
+
+    def _write(self, stage, percent):
+        try:
+            self.store.update_job(self.output_video_name, stage=stage, progress=percent, status=progress_status(stage, percent))
+        except Exception as e:
+            logging.warning(f"Failed to record progress of {self.output_video_name}: {e}")
+
+    def close(self):
+        # Waits for the last write, so it can't land after the final status
+        with self._lock:
+            pending = self._pending
+        if pending is not None:
+            pending.result()
+
+
+def report(stage, fraction=0.0):
+    progress = current_progress.get()
+    if progress is not None:
+        progress.update(stage, fraction)
+
+
+def reporter(stage):
+    # report() bound to the current job, for threads that don't carry the
+    # job's context (ffmpeg progress callbacks in the render pool)
+    progress = current_progress.get()
+    if progress is None:
+        return None
+    return lambda fraction: progress.update(stage, fraction)
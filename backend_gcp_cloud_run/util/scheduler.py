@@ -0,0 +1,204 @@
+import os
+import time
+import math
+import asyncio
+import logging
+import weakref
+import threading
+import functools
+import contextvars
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# Default concurrency per pipeline stage. Rendering is by far the most memory
+# hungry stage, so only one render runs at a time unless configured otherwise.
+# "encode" is a single ffmpeg encode of a render piece, at most RENDER_WORKERS
+# of them across all jobs.
+DEFAULT_STAGE_LIMITS = {
+    "download": 2,
+    "gemini": 4,
+    "tts": 6,
+    "render": 1,
+    "encode": int(os.getenv("RENDER_WORKERS", os.cpu_count() or 1)),
+    "upload": 2,
+}
+
+
+class SchedulerSaturated(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Job queue is full, retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+class JobScheduler():
+    # Runs all jobs on one long-lived event loop in a background thread.
+    # At most max_running jobs run at once, at most max_queued wait for a slot,
+    # and blocking stage work goes through per-stage limits.
+
+    def __init__(self, max_running=2, max_queued=10, stage_limits=None, job_duration_estimate=300):
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.stage_limits = dict(DEFAULT_STAGE_LIMITS)
+        self.stage_limits.update(stage_limits or {})
+        self._queued = OrderedDict()
+        self._running = set()
+        self._lock = threading.Lock()
+        self._avg_job_duration = job_duration_estimate
+        # Per event loop, weakly keyed so closed loops don't pile up
+        self._stage_semaphores = weakref.WeakKeyDictionary()
+        self._loop = None
+        self._thread = None
+        self._job_slots = None
+        self._executor = ThreadPoolExecutor(max_workers=sum(self.stage_limits.values()), thread_name_prefix="stage")
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._loop = asyncio.new_event_loop()
+            self._job_slots = asyncio.Semaphore(self.max_running)
+            self._thread = threading.Thread(target=self._run_loop, name="job-scheduler", daemon=True)
+            self._thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = None
+            self._thread = None
+        self._executor.shutdown(wait=False)
+
+    def submit(self, job_id, coro_fn, *args, force=False, on_start=None, on_queued=None):
+        # Returns the job's queue position (0 means it starts right away).
+        # Raises SchedulerSaturated when the queue is full, unless forced.
+        # on_queued(job_id, position) is called for a job that has to wait,
+        # before the job can start, so it always runs before on_start.
+        self.start()
+        with self._lock:
+            if job_id in self._queued or job_id in self._running:
+                return self._position(job_id)
+            if not force and self._waiting() >= self.max_queued:
+                raise SchedulerSaturated(self._retry_after())
+            self._queued[job_id] = time.time()
+            position = self._position(job_id)
+        if position and on_queued is not None:
+            try:
+                on_queued(job_id, position)
+            except BaseException:
+                # The job never starts, so it must not hold a queue slot
+                with self._lock:
+                    self._queued.pop(job_id, None)
+                raise
+        asyncio.run_coroutine_threadsafe(self._run_job(job_id, coro_fn, args, on_start), self._loop)
+        return position
+
+    async def _run_job(self, job_id, coro_fn, args, on_start):
+        async with self._job_slots:
+            with self._lock:
+                self._queued.pop(job_id, None)
+                self._running.add(job_id)
+            start_time = time.time()
+            try:
+                if on_start is not None:
+                    # Callbacks write to the job store, which may be a
+                    # network round trip, so they run off the loop
+                    await asyncio.to_thread(on_start, job_id)
+                await coro_fn(*args)
+            except Exception as e:
+                logging.error(f"Unhandled error in scheduled job {job_id}: {e}")
+            finally:
+                with self._lock:
+                    self._running.discard(job_id)
+                    # Exponential moving average, used for Retry-After estimates
+                    self._avg_job_duration = 0.8 * self._avg_job_duration + 0.2 * (time.time() - start_time)
+
+    def _waiting(self):
+        # Submitted jobs that will not get a free slot right away
+        free_slots = max(self.max_running - len(self._running), 0)
+        return max(len(self._queued) - free_slots, 0)
+
+    def _position(self, job_id):
+        if job_id in self._running:
+            return 0
+        if job_id not in self._queued:
+            return None
+        waiting_ahead = list(self._queued).index(job_id)
+        free_slots = max(self.max_running - len(self._running), 0)
+        return max(waiting_ahead + 1 - free_slots, 0)
+
+    def _retry_after(self):
+        waves = math.ceil((self._waiting() + 1) / self.max_running)
+        return max(int(self._avg_job_duration * waves / 2), 1)
+
+    def queue_position(self, job_id):
+        with self._lock:
+            return self._position(job_id)
+
+    def stats(self):
+        with self._lock:
+            return {"queued": len(self._queued), "running": len(self._running)}
+
+    def _stage_semaphore(self, name):
+        # Semaphores belong to the loop that uses them, so keep one per loop.
+        # Jobs normally all run on the scheduler loop.
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            semaphores = self._stage_semaphores.setdefault(loop, {})
+            if name not in semaphores:
+                semaphores[name] = asyncio.Semaphore(self.stage_limits[name])
+            return semaphores[name]
+
+    @asynccontextmanager
+    async def stage(self, name):
+        async with self._stage_semaphore(name):
+            yield
+
+    async def run_in_stage(self, name, func, *args, **kwargs):
+        # Run blocking work in the stage thread pool, so the shared event loop
+        # is never blocked by ffmpeg, moviepy or synchronous client calls.
+        # Context variables (the current job) carry over, as with to_thread.
+        async with self.stage(name):
+            loop = asyncio.get_running_loop()
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(self._executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+def _stage_limits_from_env():
+    limits = {}
+    for name, default in DEFAULT_STAGE_LIMITS.items():
+        limits[name] = int(os.getenv(f"STAGE_LIMIT_{name.upper()}", default))
+    return limits
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = JobScheduler(
+                max_running=int(os.getenv("SCHEDULER_MAX_RUNNING_JOBS", 2)),
+                max_queued=int(os.getenv("SCHEDULER_MAX_QUEUED_JOBS", 10)),
+                stage_limits=_stage_limits_from_env(),
+            )
+        return _scheduler
+
+
+def stage(name):
+    return get_scheduler().stage(name)
+
+
+def stage_limit(name):
+    return get_scheduler().stage_limits[name]
+
+
+async def run_in_stage(name, func, *args, **kwargs):
+    return await get_scheduler().run_in_stage(name, func, *args, **kwargs)
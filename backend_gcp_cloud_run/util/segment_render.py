@@ -0,0 +1,315 @@
+import os
+import math
+import shutil
+import logging
+import tempfile
+import threading
+import subprocess
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from moviepy.config import get_setting
+from util.media_probe import ffprobe_binary, probe_keyframes, probe_media, frame_rate
+
+# A render plan is a list of these, in output order. Spans are copied from the
+# source video, stills show the frame at `time` for `duration` seconds.
+VideoSpan = namedtuple("VideoSpan", ["start", "end"])
+StillFrame = namedtuple("StillFrame", ["time", "duration"])
+
+# Pieces are written as MPEG-TS so every piece carries its own SPS/PPS, which
+# lets stream-copied and freshly encoded pieces be joined with the concat demuxer.
+SEGMENT_FORMAT = os.getenv("SEGMENT_FORMAT", "mpegts")
+SEGMENT_EXTENSIONS = {"mpegts": ".ts", "matroska": ".mkv"}
+SMART_CODECS = ("h264",)
+X264_PROFILES = {"Constrained Baseline": "baseline", "Baseline": "baseline", "Main": "main", "High": "high"}
+# Spans shorter than this around a keyframe are not worth a separate piece
+MIN_PIECE_SECONDS = 0.01
+# Pieces are encoded by this many ffmpeg processes at once, 1 renders serially
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", os.cpu_count() or 1))
+# When the whole video has to be re-encoded, spans are split into pieces of at
+# most this length so they spread across the workers
+ENCODE_CHUNK_SECONDS = float(os.getenv("ENCODE_CHUNK_SECONDS", 20))
+
+
+def ffmpeg_binary():
+    return get_setting("FFMPEG_BINARY")
+
+
+def run_ffmpeg(args, on_progress=None):
+    # on_progress(frames) is called as ffmpeg reports the frames written so far
+    command = [ffmpeg_binary(), "-v", "error", "-y"] + args
+    if on_progress is None:
+        result = subprocess.run(command, capture_output=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed: {' '.join(command)}: {result.stderr.decode(errors='ignore')}")
+        return
+
+    # -progress writes key=value lines to stdout. stderr goes to a file so a
+    # chatty failure can't fill its pipe while stdout is being read.
+    command = [ffmpeg_binary(), "-v", "error", "-y", "-nostats", "-progress", "pipe:1"] + args
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr)
+        for line in process.stdout:
+            key, _, value = line.decode(errors="ignore").strip().partition("=")
+            if key == "frame" and value.isdigit():
+                on_progress(int(value))
+        if process.wait() != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"ffmpeg failed: {' '.join(command)}: {stderr.read().decode(errors='ignore')}")
+
+
+def probe_video_stream(video_path):
+    return probe_media(video_path).video_stream
+
+
+class SegmentRenderer():
+    # Renders a plan without re-encoding the untouched parts of the source.
+    # Each span is cut at keyframes: the GOP-aligned middle is stream-copied and
+    # only the partial GOPs at its edges, plus the still inserts, are encoded.
+    # Without stream copy every span is encoded, in chunks. Either way the
+    # pieces are independent and encoded by `workers` ffmpeg processes at once.
+
+    def __init__(self, video_path, work_dir, stream=None, keyframes=None, workers=None, stream_copy=True):
+        self.video_path = video_path
+        self.work_dir = work_dir
+        self.stream = stream or probe_video_stream(video_path)
+        self.keyframes = keyframes if keyframes is not None else probe_keyframes(video_path)
+        self.fps = frame_rate(self.stream)
+        self.duration = self.stream["duration"]
+        self.workers = max(workers or RENDER_WORKERS, 1)
+        self.stream_copy = stream_copy and self.supports_stream_copy()
+
+    def supports_stream_copy(self):
+        return self.stream.get("codec_name") in SMART_CODECS and len(self.keyframes) > 0
+
+    def encoder_args(self):
+        # Encoded pieces must match the copied ones for the concat to be valid.
+        # The cores are shared between the workers.
+        args = [
+            "-c:v", "libx264", "-preset", "veryfast", "-crf", "18",
+            "-pix_fmt", self.stream.get("pix_fmt") or "yuv420p",
+            "-r", str(self.fps),
+            "-threads", str(max((os.cpu_count() or 1) // self.workers, 1)),
+        ]
+        profile = X264_PROFILES.get(self.stream.get("profile"))
+        if profile:
+            args += ["-profile:v", profile]
+        return args
+
+    def encode_chunks(self, start, end):
+        # Chunk boundaries sit on the frame grid so rounding doesn't add frames
+        n = max(int(-(-(end - start) // ENCODE_CHUNK_SECONDS)), 1)
+        frames_per_chunk = round((end - start) * self.fps / n)
+        cuts = [start + float(i * frames_per_chunk / self.fps) for i in range(n)] + [end]
+        return [(cuts[i], cuts[i + 1], False) for i in range(n)]
+
+    def split_span(self, span):
+        # Returns (start, end, copy) pieces covering the span
+        start, end = span.start, min(span.end, self.duration)
+        if end - start < MIN_PIECE_SECONDS:
+            return []
+        if not self.stream_copy:
+            return self.encode_chunks(start, end)
+        first_key = bisect_left(self.keyframes, start - 1e-6)
+        last_key = bisect_right(self.keyframes, end + 1e-6) - 1
+        if first_key >= len(self.keyframes) or last_key < 0:
+            return [(start, end, False)]
+        copy_start, copy_end = self.keyframes[first_key], self.keyframes[last_key]
+        if end >= self.duration - 1 / self.fps:
+            # The span runs to the end of the video, copy the last GOP as well
+            copy_end = end
+        if copy_start >= copy_end:
+            return [(start, end, False)]
+        pieces = []
+        if copy_start - start >= MIN_PIECE_SECONDS:
+            pieces.append((start, copy_start, False))
+        pieces.append((copy_start, copy_end, True))
+        if end - copy_end >= MIN_PIECE_SECONDS:
+            pieces.append((copy_end, end, False))
+        return pieces
+
+    def plan_pieces(self, plan):
+        # Flattens a render plan into the list of pieces to produce, in order
+        pieces = []
+        for item in plan:
+            if isinstance(item, VideoSpan):
+                for start, end, copy in self.split_span(item):
+                    pieces.append(("copy" if copy else "encode", start, end))
+            else:
+                pieces.append(("still", item.time, item.duration))
+        return pieces
+
+    def piece_path(self, name):
+        return os.path.join(self.work_dir, f"{name}{SEGMENT_EXTENSIONS[SEGMENT_FORMAT]}")
+
+    def split_source(self, pieces):
+        # Cuts the source at every copy boundary in a single stream-copy pass.
+        # The segment muxer only cuts on keyframes, so each chunk is whole GOPs.
+        # Returns {(start, end): [(chunk path, duration)]} for every copy piece.
+        copies = [(a, b) for kind, a, b in pieces if kind == "copy"]
+        if not copies:
+            return {}
+        boundaries = sorted(set(t for a, b in copies for t in (a, b) if 0 < t < self.duration))
+        chunk_pattern = os.path.join(self.work_dir, f"chunk_%05d{SEGMENT_EXTENSIONS[SEGMENT_FORMAT]}")
+        args = ["-i", self.video_path, "-map", "0:v:0", "-an", "-c:v", "copy", "-f", "segment", "-segment_format", SEGMENT_FORMAT, "-reset_timestamps", "1"]
+        if boundaries:
+            # Slightly early, so rounding never pushes a cut to the next keyframe
+            args += ["-segment_times", ",".join(f"{max(t - 0.001, 0):.6f}" for t in boundaries)]
+        run_ffmpeg(args + [chunk_pattern])
+
+        starts = [0.0] + boundaries
+        ends = boundaries + [float("inf")]
+        chunks = {}
+        for a, b in copies:
+            # The last chunk runs to the end of the file
+            last = float("inf") if b >= self.duration else b
+            chunks[(a, b)] = [
+                (chunk_pattern % i, min(end, self.duration) - start)
+                for i, (start, end) in enumerate(zip(starts, ends)) if start >= a and end <= last
+            ]
+        return chunks
+
+    def span_frames(self, start, end):
+        # Source frames shown in [start, end). Counting on the frame grid
+        # instead of rounding the length keeps a cut between two frames from
+        # dropping one of them.
+        first = math.ceil(start * self.fps - 1e-6)
+        last = math.ceil(end * self.fps - 1e-6)
+        return max(last - first, 1)
+
+    def piece_frames(self, piece):
+        # Frames in a piece, None for a still whose duration isn't known yet
+        kind, a, b = piece
+        if kind == "still":
+            return None if b is None else max(int(round(b * self.fps)), 1)
+        return self.span_frames(a, b)
+
+    def render_piece(self, index, piece, on_progress=None):
+        # Encodes one span or still insert, returns [(path, duration)]
+        kind, a, b = piece
+        output = self.piece_path(f"piece_{index:05d}")
+        if kind == "encode":
+            n_frames = self.span_frames(a, b)
+            run_ffmpeg([
+                "-ss", f"{a:.6f}", "-i", self.video_path,
+                "-map", "0:v:0", "-an",
+                "-frames:v", str(n_frames), *self.encoder_args(), output,
+            ], on_progress)
+        else:
+            # Freeze the frame at `a` for `b` seconds
+            frame_time = min(a, max(self.duration - 2 / self.fps, 0))
+            n_frames = max(int(round(b * self.fps)), 1)
+            run_ffmpeg([
+                "-ss", f"{frame_time:.6f}", "-i", self.video_path,
+                "-map", "0:v:0", "-an",
+                "-vf", "loop=loop=-1:size=1:start=0,setpts=N/FRAME_RATE/TB",
+                "-frames:v", str(n_frames), *self.encoder_args(), output,
+            ], on_progress)
+        return [(output, float(n_frames / self.fps))]
+
+    def concat(self, pieces, output_path):
+        # pieces is a list of (path, duration). Explicit durations keep the
+        # concat demuxer from leaving gaps when a piece has a start offset.
+        list_path = os.path.join(self.work_dir, "pieces.txt")
+        # Single quotes are the only special character inside a quoted path
+        escape = lambda path: os.path.abspath(path).replace("'", "'\\''")
+        with open(list_path, "w") as f:
+            for path, duration in pieces:
+                f.write(f"file '{escape(path)}'\nduration {duration:.6f}\n")
+        run_ffmpeg([
+            "-f", "concat", "-safe", "0", "-i", list_path,
+            "-map", "0:v:0", "-c:v", "copy", "-an", "-movflags", "+faststart", output_path,
+        ])
+        return output_path
+
+    def start(self, plan, on_progress=None, submit=None):
+        # Stills whose duration is still None are encoded once it is set on
+        # the returned session. on_progress(fraction) follows the frames done.
+        session = RenderSession(self, plan, on_progress, submit)
+        copied = sum(b - a for kind, a, b in session.pieces if kind == "copy")
+        logging.info(f"Segment render: {len(session.pieces)} pieces, {copied:.2f}s stream-copied of {self.duration:.2f}s source, {self.workers} workers")
+        return session
+
+    def render(self, plan, output_path, on_progress=None):
+        return self.start(plan, on_progress).finish(output_path)
+
+
+class RenderSession():
+    # A render in progress. Everything that doesn't depend on a still's
+    # duration starts right away, so pieces can be encoded while the rest of
+    # the plan is still being worked out. The work is done by ffmpeg child
+    # processes, the pool threads only wait on them. submit(func, *args),
+    # returning a concurrent Future, replaces the session's own pool, so the
+    # caller can run the pieces on a shared, limited executor.
+
+    def __init__(self, renderer, plan, on_progress=None, submit=None):
+        self.renderer = renderer
+        self.pieces = renderer.plan_pieces(plan)
+        # Index into pieces of every still, in plan order
+        self.still_pieces = [i for i, piece in enumerate(self.pieces) if piece[0] == "still"]
+        self.on_progress = on_progress
+        self._futures = {}
+        self._frames_done = {}
+        self._progress_lock = threading.Lock()
+        os.makedirs(renderer.work_dir, exist_ok=True)
+        self._pool = None if submit else ThreadPoolExecutor(max_workers=renderer.workers)
+        self._run = submit or self._pool.submit
+        self._chunks = self._run(renderer.split_source, self.pieces)
+        self._chunks.add_done_callback(lambda _: self._copies_done())
+        for i, (kind, a, b) in enumerate(self.pieces):
+            if kind == "encode" or (kind == "still" and b is not None):
+                self._submit(i, (kind, a, b))
+
+    def _submit(self, index, piece):
+        self.pieces[index] = piece
+        on_progress = (lambda frames: self._advance(index, frames)) if self.on_progress else None
+        self._futures[index] = self._run(self.renderer.render_piece, index, piece, on_progress)
+
+    def _advance(self, index, frames):
+        # Frames are counted over the pieces whose length is known, so the
+        # fraction can dip when a still's duration arrives
+        with self._progress_lock:
+            self._frames_done[index] = frames
+            sizes = [self.renderer.piece_frames(piece) for piece in self.pieces]
+            total = sum(size for size in sizes if size is not None)
+            done = sum(min(self._frames_done.get(i, 0), size) for i, size in enumerate(sizes) if size is not None)
+        if total:
+            self.on_progress(done / total)
+
+    def _copies_done(self):
+        if not self.on_progress:
+            return
+        for i, piece in enumerate(self.pieces):
+            if piece[0] == "copy":
+                self._advance(i, self.renderer.piece_frames(piece))
+
+    def set_still_duration(self, still, duration):
+        index = self.still_pieces[still]
+        kind, time, _ = self.pieces[index]
+        self._submit(index, (kind, time, duration))
+
+    def finish(self, output_path):
+        try:
+            missing = [i for i in self.still_pieces if i not in self._futures]
+            if missing:
+                raise ValueError(f"{len(missing)} stills have no duration")
+            chunks = self._chunks.result()
+            rendered = []
+            for i, (kind, a, b) in enumerate(self.pieces):
+                rendered += chunks[(a, b)] if kind == "copy" else self._futures[i].result()
+            output_path = self.renderer.concat(rendered, output_path)
+            if self.on_progress:
+                self.on_progress(1.0)
+            return output_path
+        finally:
+            self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+        else:
+            # Pieces on a shared executor are cancelled but not waited for,
+            # the caller may be the thread that runs them
+            for future in [self._chunks] + list(self._futures.values()):
+                future.cancel()
+        shutil.rmtree(self.renderer.work_dir, ignore_errors=True)
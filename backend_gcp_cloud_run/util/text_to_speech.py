@@ -1,37 +1,63 @@
 import json
 import re
 import logging
+import threading
 from asyncio import Semaphore
 import shutil
-from moviepy.editor import VideoFileClip, concatenate_videoclips, ImageClip, AudioFileClip, CompositeVideoClip, CompositeAudioClip, TextClip
+from moviepy.editor import VideoFileClip, concatenate_videoclips, ImageClip, CompositeVideoClip, TextClip
 from google.api_core.exceptions import ResourceExhausted
-import uuid
 from util.Constants import BUCKET_NAME
 from moviepy.video.io.ffmpeg_tools import ffmpeg_extract_subclip
 import azure.cognitiveservices.speech as speechsdk
 from util.bgaudio import BackgroundAudioGenerator
-from util.gcs_bucket import upload_to_gcs, download_from_gcs
+from util.gcs_bucket import upload_to_gcs, download_from_gcs, delete_from_gcs
 from util.llm_instructions import insturctions_combined_format, instructions_timestamp_format, instructions_choose_category
-import datetime
 import os
 import asyncio
-from elevenlabs.client import AsyncElevenLabs
 from elevenlabs import save
 import os
-import glob
 import asyncio
-from pydub import AudioSegment
 from dotenv import load_dotenv
-from util.gemini import VertexAIUtility
+from util.gemini import VertexAIUtility, GEMINI_INPUT_MODE
+from util.timestamps import normalize_description, parse_timestamp
+from util.analysis_proxy import make_analysis_proxy, proxy_profile
+from util import audio_mixer
+from util.loudness import get_loudness_index
+from util.segment_render import SegmentRenderer, VideoSpan, StillFrame
+from util.media_probe import probe_media, probe_partial
+from util.scheduler import stage, stage_limit, run_in_stage
+from util.tts_cache import get_tts_cache, tts_cache_key
+from util.tts_clients import get_tts_client
+from util.metrics import span, current_job
+from util import progress
+from util.workspace import Workspace
 import os
+import subprocess
+from collections import namedtuple
+from urllib.parse import unquote
 
 load_dotenv()
-# Ensure the temp directory exists
-os.makedirs('temp', exist_ok=True)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# "smart" stream-copies untouched video and only encodes the inserts,
+# "parallel" re-encodes every segment with RENDER_WORKERS ffmpeg processes
+# (in the streaming pipeline, the "encode" stage limit, which defaults to it),
+# "moviepy" re-encodes the whole video serially
+RENDER_MODE = os.getenv("RENDER_MODE", "smart")
+# "streaming" starts rendering while TTS is still running, "sequential" waits
+# for all speech first. Streaming needs the smart or parallel render mode.
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "streaming")
+
+ELEVENLABS_MODEL = "eleven_turbo_v2_5"
+# pcm_<rate> formats skip the mp3 decode, but pcm_44100 needs a paid plan
+ELEVENLABS_OUTPUT_FORMAT = os.getenv("ELEVENLABS_OUTPUT_FORMAT", "mp3_44100_128")
+
+# One synthesized description line. samples is float32 PCM in the mixing format,
+# start and duration are in seconds.
+TTSResult = namedtuple("TTSResult", ["timestamp", "start", "text", "samples", "sample_rate", "duration"])
+
 def get_voice_name(voice_model: str):
     if voice_model == "Azure":
         return "en-US-NovaMultilingualNeural"
@@ -42,17 +68,26 @@ def get_voice_name(voice_model: str):
     else:
         raise ValueError(f"Unsupported voice model: {voice_model}")
 
-async def tts_utility(model_name, text, filename):
+async def tts_utility(model_name, text):
+    # Returns the synthesized speech as encoded bytes in ELEVENLABS_OUTPUT_FORMAT
     voice = get_voice_name(model_name)
     # if model_name == "Azure":
     #     return text_to_wav_azure(voice, text, filename)
     # elif model_name == "Google":
     #     return text_to_wav(voice, text, filename)
     if model_name == "ElevenLabs":
-        return await text_to_wav_elevenlabs(voice, text, filename)
-
-async def text_to_wav_elevenlabs(voice_id: str, text: str, filename: str):
-    client = AsyncElevenLabs(api_key=os.getenv("ELEVENLABS_API_KEY"))
+        cache = get_tts_cache()
+        key = tts_cache_key("ElevenLabs", voice, ELEVENLABS_MODEL, text, ELEVENLABS_OUTPUT_FORMAT)
+        audio = await asyncio.to_thread(cache.get, key)
+        if audio is not None:
+            logging.info(f"TTS cache hit for text: '{text}'")
+            return audio
+        audio = await text_to_wav_elevenlabs(voice, text)
+        await asyncio.to_thread(cache.put, key, audio)
+        return audio
+
+async def text_to_wav_elevenlabs(voice_id: str, text: str):
+    client = get_tts_client("ElevenLabs")
     max_retries = 3
     retry_delay = 2  # seconds
 
@@ -61,13 +96,14 @@ async def text_to_wav_elevenlabs(voice_id: str, text: str, filename: str):
             audio_generator = await client.generate(
                 text=text,
                 voice=voice_id,
-                model="eleven_turbo_v2_5"
+                model=ELEVENLABS_MODEL,
+                output_format=ELEVENLABS_OUTPUT_FORMAT
             )
-            with open(filename, "wb") as f:
-                async for chunk in audio_generator:
-                    f.write(chunk)
-            logging.info(f'Generated speech saved to "{filename}"')
-            return  # Exit the function if successful
+            audio = b"".join([chunk async for chunk in audio_generator])
+            if not audio:
+                raise ValueError("Empty audio returned")
+            logging.info(f"Generated {len(audio)} bytes of speech for text: '{text}'")
+            return audio
         except Exception as e:
             logging.error(f"Error generating WAV file on attempt {attempt + 1} for text: '{text}' - {e}")
             if attempt < max_retries - 1:
@@ -75,7 +111,15 @@ async def text_to_wav_elevenlabs(voice_id: str, text: str, filename: str):
             else:
                 raise
 
-async def generate_wav_files_from_response(response_body: dict, model_name: str, unique_id: str):
+def speech_to_samples(audio: bytes, output_format: str):
+    # pcm_<rate> output is raw mono s16le and needs no decoder
+    codec, _, rate = output_format.partition("_")
+    if codec == "pcm":
+        return audio_mixer.pcm16_to_samples(audio, int(rate))
+    return audio_mixer.decode_audio_bytes(audio)
+
+def parse_description(response_body: dict):
+    # Returns the (timestamp, text) description lines, in description order
     description = response_body["description"]
     logging.info(f"Description: {description}")
     pattern = re.compile(r'\[(\d{1,2}:\d{2}(?:\.\d{3})?)\] (.+)')
@@ -84,17 +128,20 @@ async def generate_wav_files_from_response(response_body: dict, model_name: str,
     if not matches:
         logging.error("No timestamps found in the description returned by gemini.")
         raise ValueError("Failed to generate response audio timestamps")
+    return matches
 
-    timestamp_ranges = []
-    tasks = []
+def speech_tasks(matches: list, model_name: str):
+    # One coroutine per description line, each returns a TTSResult
     semaphore = Semaphore(3)
+    completed = []
 
-    async def limited_tts_utility(model_name, text, filename):
-        async with semaphore:
+    async def limited_tts_utility(model_name, timestamp, text):
+        async with semaphore, stage("tts"):
             max_retries = 3
             for attempt in range(max_retries):
                 try:
-                    await tts_utility(model_name, text, filename)
+                    with span("tts"):
+                        audio = await tts_utility(model_name, text)
                     break
                 except Exception as e:
                     logging.error(f"Error generating WAV file on attempt {attempt + 1} for text: '{text}' - {e}")
@@ -102,144 +149,161 @@ async def generate_wav_files_from_response(response_body: dict, model_name: str,
                         await asyncio.sleep(2)
                     else:
                         raise
+        samples = await asyncio.to_thread(speech_to_samples, audio, ELEVENLABS_OUTPUT_FORMAT)
+        duration = audio_mixer.duration_of(samples)
+        logging.info(f"Generated speech for [{timestamp}] with duration: {duration}")
+        completed.append(timestamp)
+        progress.report("speech", len(completed) / len(matches))
+        return TTSResult(timestamp, parse_timestamp(timestamp), text, samples, audio_mixer.SAMPLE_RATE, duration)
 
-    for match in matches:
-        timestamp, text = match
-        start_time = timestamp.strip('[')
-        filename = f"temp/{unique_id}_{start_time.replace(':', '-')}.wav"
-        logging.info(f"Generating WAV for text: '{text}' at timestamp: {start_time} with filename: {filename}")
-        tasks.append(limited_tts_utility(model_name, text, filename))
-
-    await asyncio.gather(*tasks)
-
-    for match in matches:
-        timestamp, text = match
-        start_time = timestamp.strip('[')
-        filename = f"temp/{unique_id}_{start_time.replace(':', '-')}.wav"
-        logging.info(f"Generating WAV for text: '{text}' at timestamp: {start_time} with filename: {filename}")
-        
-        max_wait_time = 30
-        wait_interval = 0.5
-        elapsed_time = 0
-
-        while (not os.path.exists(filename) or os.path.getsize(filename) == 0) and elapsed_time < max_wait_time:
-            logging.info(f"Waiting for file {filename} to be created. Elapsed time: {elapsed_time}s")
-            await asyncio.sleep(wait_interval)
-            elapsed_time += wait_interval
-
-        if not os.path.exists(filename) or os.path.getsize(filename) == 0:
-            logging.error(f"Failed to generate WAV file: {filename}")
-            raise Exception(f"Failed to generate WAV file: {filename}")
-
-        audio_clip = AudioFileClip(filename)
-        duration = audio_clip.duration
-
-        try:
-            start_dt = datetime.datetime.strptime(start_time, "%M:%S.%f")
-        except ValueError:
-            start_dt = datetime.datetime.strptime(start_time, "%M:%S")
-
-        end_time = (start_dt + datetime.timedelta(seconds=duration)).strftime("%M-%S.%f")[:-3]
-        new_filename = f"temp/{unique_id}_{start_time.replace(':', '-')}_to_{end_time}.wav"
-        os.rename(filename, new_filename)
-        logging.info(f"Generated speech saved to \"{new_filename}\"")
-
-        timestamp_ranges.append(f"[{start_time}] - [{end_time}] {text}")
-
-    logging.info(f"Generated timestamp ranges: {timestamp_ranges}")
-    return timestamp_ranges
-
-def get_audio_desc_util(video_path, add_bg_music):
+    tasks = []
+    for timestamp, text in matches:
+        logging.info(f"Generating speech for text: '{text}' at timestamp: {timestamp}")
+        tasks.append(limited_tts_utility(model_name, timestamp, text))
+    return tasks
+
+async def generate_speech_from_response(response_body: dict, model_name: str):
+    # Returns one TTSResult per description line, in description order
+    return await asyncio.gather(*speech_tasks(parse_description(response_body), model_name))
+
+class AnalysisInput():
+    # What the model is sent: a small proxy of the video, or the source when a
+    # proxy wouldn't be smaller. In "uri" input mode the model reads it from
+    # the bucket, the upload is referenced as is and a proxy is uploaded next
+    # to it. Nothing is built or uploaded until an analysis misses the cache.
+
+    def __init__(self, video_path: str, source_blob: str = None):
+        self.video_path = video_path
+        self.source_blob = source_blob
+        self.uploaded_blob = None
+        self._input = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._input is None:
+                with span("analysis_proxy"):
+                    analysis_path = make_analysis_proxy(self.video_path)
+                self._input = (analysis_path, self._uri(analysis_path))
+            return self._input
+
+    def _uri(self, analysis_path):
+        if GEMINI_INPUT_MODE != "uri":
+            return None
+        if analysis_path == self.video_path and self.source_blob:
+            return f"gs://{BUCKET_NAME}/{unquote(self.source_blob)}"
+        blob_name = f"analysis_inputs/{os.path.basename(analysis_path)}"
+        upload_to_gcs(BUCKET_NAME, analysis_path, blob_name)
+        self.uploaded_blob = blob_name
+        return f"gs://{BUCKET_NAME}/{blob_name}"
+
+    def close(self):
+        if self.uploaded_blob:
+            try:
+                delete_from_gcs(BUCKET_NAME, self.uploaded_blob)
+            except Exception as e:
+                logging.warning(f"Failed to delete analysis input {self.uploaded_blob}: {e}")
+
+def get_audio_desc_util(video_path, add_bg_music, bypass_cache=False, source_blob=None, media=None):
     v = VertexAIUtility()
+    progress.report("analysis")
     
-    if not v.validate_video(video_path):
-        print(f"Error: Video file '{video_path}' is invalid or corrupted.")
-        return {"error": "Invalid video file"}
-
-    response_audio_desc = v.get_info_from_video(video_path, insturctions_combined_format)
-    if add_bg_music:
-        bg_audio_response = v.get_info_from_video(video_path, instructions_choose_category)["description"]
-        try:
-            # Strip the code block markers and parse the JSON
-            bg_audio_response = bg_audio_response.strip('```json').strip('```').strip()
-            bg_audio_category = json.loads(bg_audio_response)["category"]
-        except json.JSONDecodeError as e:
-            logging.error(f"Failed to decode JSON from bg_audio_response: {e}")
-            raise
+    try:
+        media = media or load_media(video_path)
+    except ValueError:
+        media = None
+    if media is None or media.video_stream is None or media.duration <= 0:
+        # Fails the job, process_video_task marks it as errored
+        logging.error(f"Video file '{video_path}' is invalid or corrupted")
+        raise ValueError("Invalid video file")
+
+    # Both analyses are cached under the source's hash and the proxy settings.
+    # The proxy is only built (and uploaded) if one of them misses.
+    video_hash = f"{media.content_hash}:{proxy_profile()}"
+    analysis_input = AnalysisInput(video_path, source_blob)
+    try:
+        with span("gemini_describe"):
+            response_audio_desc = v.get_info_from_video(video_path, insturctions_combined_format, video_hash, bypass_cache, prepare_input=analysis_input.get)
+        progress.report("analysis", 0.8)
+        if add_bg_music:
+            with span("gemini_category"):
+                bg_audio_response = v.get_info_from_video(video_path, instructions_choose_category, video_hash, bypass_cache, prepare_input=analysis_input.get)["description"]
+            try:
+                # Strip the code block markers and parse the JSON
+                bg_audio_response = bg_audio_response.strip('```json').strip('```').strip()
+                bg_audio_category = json.loads(bg_audio_response)["category"]
+            except json.JSONDecodeError as e:
+                logging.error(f"Failed to decode JSON from bg_audio_response: {e}")
+                raise
+        else:
+            bg_audio_category = None
+    finally:
+        analysis_input.close()
+
+    # Timestamps are normalized locally, the Gemini reformat is only a fallback
+    video_duration = media.duration
+    normalized_desc = normalize_description(response_audio_desc["description"], video_duration)
+    if normalized_desc is None:
+        logging.warning("No timestamps parsed from the description, reformatting with Gemini")
+        with span("gemini_reformat"):
+            reformmated_desc = v.gemini_llm(prompt=response_audio_desc["description"], inst=instructions_timestamp_format, bypass_cache=bypass_cache)
+        normalized_desc = normalize_description(reformmated_desc["description"], video_duration)
+        if normalized_desc is not None:
+            reformmated_desc = {"description": normalized_desc}
     else:
-        bg_audio_category = None
-
-    reformmated_desc = v.gemini_llm(prompt=response_audio_desc["description"], inst=instructions_timestamp_format)
+        reformmated_desc = {"description": normalized_desc}
+    progress.report("analysis", 1.0)
     return reformmated_desc, bg_audio_category
 
-def convert_mp4_to_wav(video_path):
-    logging.info(f"Converting video to audio: {video_path}")
-    audio_path = f"{os.path.splitext(video_path)[0]}.wav"
-    try:
-        # Check if the video file exists
-        if not os.path.exists(video_path):
-            raise FileNotFoundError(f"Video file not found: {video_path}")
+def download_video(gcs_url, video_path):
+    # Returns the MediaInfo every later stage of the job uses. The video is
+    # probed as soon as its headers arrive, overlapping the rest of the download.
+    progress.report("download")
+    early = []
 
-        # Get file info
-        file_size = os.path.getsize(video_path)
-        logging.info(f"Video file size: {file_size} bytes")
+    def probe_head(path):
+        with span("probe"):
+            early.append(probe_partial(path))
 
-        # Try to open the file with moviepy first
-        try:
-            video = VideoFileClip(video_path)
-            if video.audio is not None:
-                audio = video.audio
-                audio.write_audiofile(audio_path)
-                logging.info(f"Audio exported to: {audio_path} using moviepy")
-            else:
-                logging.warning(f"No audio stream found in video: {video_path}")
-                return None
-        except Exception as moviepy_error:
-            logging.warning(f"Moviepy conversion failed: {moviepy_error}. Trying pydub...")
-
-            # If moviepy fails, try pydub
-            video = AudioSegment.from_file(video_path, format="mp4")
-            video.export(audio_path, format="wav")
-            logging.info(f"Audio exported to: {audio_path} using pydub")
-
-    except FileNotFoundError as e:
-        logging.error(f"File not found error: {e}")
-        raise
-    except Exception as e:
-        logging.error(f"Error during conversion: {e}")
-        logging.error(f"Error type: {type(e).__name__}")
-        logging.error(f"Error args: {e.args}")
-        import traceback
-        logging.error(f"Traceback: {traceback.format_exc()}")
-        raise
+    with span("download"):
+        download_from_gcs(BUCKET_NAME, gcs_url, video_path, parallel=True, on_head=probe_head)
 
-    return audio_path
+    if early and early[0]:
+        media = early[0]
+    else:
+        with span("probe"):
+            media = load_media(video_path)
+    logging.info(f"Video loaded successfully. Duration: {media.duration} seconds")
+    progress.report("download", 1.0)
+    return media
 
 async def main_function(gcs_url, add_bg_music):
-    output_path = os.path.splitext(gcs_url)[0] + "_output.mp4"
-    try:
-        unique_id = uuid.uuid4()
-        video_path = f"temp/temp_video_{unique_id}.mp4"
-        download_from_gcs(BUCKET_NAME, gcs_url, video_path)
-        
-        clip = VideoFileClip(video_path)
-        video_duration = clip.duration
-        logging.info(f"Video loaded successfully. Duration: {video_duration} seconds")
-        clip.close()
-    except Exception as e:
-        logging.error(f"Error loading video: {e}")
-        return {"status": "error", "message": str(e)}
-    
-    response_audio_desc, bg_audio_category = get_audio_desc_util(video_path, add_bg_music)
-    if "error" in response_audio_desc:
-        logging.error(f"Error in Gemini response: {response_audio_desc['error']}")
-        return {"status": "error", "message": response_audio_desc["error"]}
+    output_name = os.path.basename(os.path.splitext(gcs_url)[0] + "_output.mp4")
+    # Spans anywhere in the job are tagged with the output name, the job id
+    current_job.set(output_name)
+    # Every intermediate of the job lives in its workspace, which is removed
+    # when the job ends, failed or not
+    async with Workspace(output_name) as workspace:
+        try:
+            video_path = workspace.path("input.mp4")
+            media = await run_in_stage("download", download_video, gcs_url, video_path)
+        except Exception as e:
+            logging.error(f"Error loading video: {e}")
+            return {"status": "error", "message": str(e)}
+
+        try:
+            return await process_video(gcs_url, add_bg_music, video_path, workspace.path(output_name), workspace, media)
+        finally:
+            media.close()
+
+async def process_video(gcs_url, add_bg_music, video_path, output_path, workspace, media):
+    response_audio_desc, bg_audio_category = await run_in_stage("gemini", get_audio_desc_util, video_path, add_bg_music, source_blob=gcs_url, media=media)
 
     response_body = {
         "description": response_audio_desc["description"],
     }
     try:
-        await create_final_video_v2(video_path, bg_audio_category, response_body, output_path, "ElevenLabs", unique_id, add_bg_music)
+        await create_final_video_v2(video_path, bg_audio_category, response_body, output_path, "ElevenLabs", workspace, add_bg_music, media)
     except ValueError as e:
         logging.error(f"Error during video processing: {e}")
         return {"status": "error", "message": str(e)}
@@ -247,178 +311,266 @@ async def main_function(gcs_url, add_bg_music):
         logging.error(f"Unexpected error during video processing: {e}")
         return {"status": "error", "message": str(e)}
     
-    gcs_url = upload_to_gcs(BUCKET_NAME, output_path, os.path.basename(output_path))
-
-    os.remove(video_path)
-    os.remove(output_path)
-    # Remove only the .wav files with the unique_id
-    wav_files = glob.glob(f'temp/{unique_id}_*.wav')
-    for wav_file in wav_files:
-        os.remove(wav_file)
-    
-    # Remove the temporary video file
-    temp_video_file = f"temp/temp_video_{unique_id}.mp4"
-    if os.path.exists(temp_video_file):
-        os.remove(temp_video_file)
-
-    # Remove the temporary video file
-    temp_generated_wav_file = f"temp/temp_video_{unique_id}.wav"
-    if os.path.exists(temp_generated_wav_file):
-        os.remove(temp_generated_wav_file)
-    
+    progress.report("upload")
+    with span("upload"):
+        gcs_url = await run_in_stage("upload", upload_to_gcs, BUCKET_NAME, output_path, os.path.basename(output_path))
+    progress.report("upload", 1.0)
+
     return {"status": "success", "output_url": gcs_url}
 
-async def create_final_video_v2(video_path: str, bg_audio_category: str, response_body: dict, output_path: str, model_name, unique_id: str, add_bg_music : str):
+async def create_final_video_v2(video_path: str, bg_audio_category: str, response_body: dict, output_path: str, model_name, workspace: Workspace, add_bg_music : str, media=None):
     logging.info(f"Starting create_final_video_v2 with video_path: {video_path}, output_path: {output_path}, model_name: {model_name}")
+    media = media or await asyncio.to_thread(load_media, video_path)
 
-    if add_bg_music and bg_audio_category:
-        bg_audio_generator = BackgroundAudioGenerator(bg_audio_category)
-    
-    original_videos_audio = convert_mp4_to_wav(video_path)
-    if original_videos_audio is None:
-        logging.warning(f"No audio found in video: {video_path}. Proceeding without original audio.")
-        original_audio_clip = None
-    else:
-        logging.info(f"Converted video to audio: {original_videos_audio}")
-        original_audio_clip = AudioFileClip(original_videos_audio)
-        logging.info(f"Loaded original audio clip with duration: {original_audio_clip.duration}")
+    if PIPELINE_MODE == "streaming" and RENDER_MODE in ("smart", "parallel"):
+        return await create_final_video_streaming(video_path, bg_audio_category, response_body, output_path, model_name, workspace, add_bg_music, media)
 
-    if original_audio_clip is None:
-        video = VideoFileClip(video_path)
-        blank_audio = AudioSegment.silent(duration=video.duration * 1000)  # duration in milliseconds
-        blank_audio_path = f"temp/{unique_id}_blank_audio.wav"
-        blank_audio.export(blank_audio_path, format="wav")
-        original_audio_clip = AudioFileClip(blank_audio_path).set_start(0)
-        logging.info(f"Created blank audio clip with duration: {original_audio_clip.duration}")
+    bg_audio_generator, original_audio, loudness = await run_in_stage("render", prepare_audio_sources, video_path, bg_audio_category, workspace, add_bg_music, output_path, media)
 
-
-    response_audio_timestamps = await generate_wav_files_from_response(response_body, model_name, unique_id)
-    if not response_audio_timestamps:
+    speech = await generate_speech_from_response(response_body, model_name)
+    if not speech:
         logging.error("Failed to generate response audio timestamps")
         raise ValueError("Failed to generate response audio timestamps")
 
+    await run_in_stage("render", render_final_video, video_path, bg_audio_category, speech, output_path, workspace, add_bg_music, bg_audio_generator, original_audio, loudness, media)
+
+async def create_final_video_streaming(video_path: str, bg_audio_category: str, response_body: dict, output_path: str, model_name, workspace: Workspace, add_bg_music : str, media):
+    # Same output as the sequential path, but the video render starts before
+    # TTS: copies and span edges right away, each still insert as soon as its
+    # speech is ready. Every piece is encoded in the "encode" stage and the
+    # render stage is only taken for the audio decode and the final mix and
+    # mux, so waiting on speech doesn't hold up other jobs' renders.
+    matches = parse_description(response_body)
+    audio_sources = asyncio.ensure_future(run_in_stage("render", prepare_audio_sources, video_path, bg_audio_category, workspace, add_bg_music, output_path, media))
+    plan = build_render_plan([parse_timestamp(timestamp) for timestamp, _ in matches], [None] * len(matches), media.duration)
+    loop = asyncio.get_running_loop()
+
+    def submit_piece(func, *args):
+        return asyncio.run_coroutine_threadsafe(run_in_stage("encode", func, *args), loop)
+
     try:
-        video = VideoFileClip(video_path)
-        logging.info(f"Loaded video file with duration: {video.duration}")
-    except OSError as e:
+        # Pieces run in the "encode" stage, so that limit is the number of
+        # ffmpeg processes the cores are split between
+        renderer = await run_in_stage("encode", segment_renderer, video_path, workspace, media, stage_limit("encode"))
+        session = renderer.start(plan, progress.reporter("render"), submit_piece)
+    except Exception as e:
+        logging.warning(f"Segment render could not start, rendering after TTS instead: {e}")
+        session = None
+
+    async def indexed(i, task):
+        return i, await task
+
+    tasks = [asyncio.ensure_future(indexed(i, task)) for i, task in enumerate(speech_tasks(matches, model_name))]
+    speech = [None] * len(tasks)
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            i, result = await next_result
+            speech[i] = result
+            if session is not None:
+                session.set_still_duration(i, result.duration)
+        bg_audio_generator, original_audio, loudness = await audio_sources
+    except Exception:
+        for task in tasks + [audio_sources]:
+            task.cancel()
+        if session is not None:
+            session.close()
+        raise
+
+    plan = build_render_plan([result.start for result in speech], [result.duration for result in speech], media.duration)
+    await run_in_stage(
+        "render", write_final_video, plan, speech, output_path, workspace, bg_audio_category, add_bg_music, bg_audio_generator, original_audio, loudness,
+        lambda video_only_path: render_streaming_video_track(session, video_path, plan, video_only_path, workspace, media),
+    )
+
+def render_streaming_video_track(session, video_path: str, plan: list, video_only_path: str, workspace: Workspace, media):
+    if session is None:
+        return render_video_track(video_path, plan, video_only_path, workspace, media)
+    try:
+        return session.finish(video_only_path)
+    except Exception as e:
+        render_fallback(e)
+    return render_video_track_moviepy(video_path, plan, video_only_path, media)
+
+def prepare_audio_sources(video_path: str, bg_audio_category: str, workspace: Workspace, add_bg_music: str, output_path: str, media=None):
+    bg_audio_generator = None
+    if add_bg_music and bg_audio_category:
+        bg_audio_generator = BackgroundAudioGenerator(bg_audio_category)
+    
+    # The original soundtrack is decoded to PCM once, straight from ffmpeg into
+    # memory. The loudness index and all mixing below use this one buffer.
+    media = media or load_media(video_path)
+    if media.has_audio:
+        with span("audio_extract"):
+            original_audio = audio_mixer.extract_audio(video_path, media.duration, spill_dir=workspace.directory)
+        logging.info(f"Loaded original audio with duration: {audio_mixer.duration_of(original_audio)}")
+    else:
+        logging.warning(f"No audio found in video: {video_path}. Proceeding without original audio.")
+        original_audio = audio_mixer.silence(media.duration)
+        logging.info(f"Created blank audio track with duration: {audio_mixer.duration_of(original_audio)}")
+
+    # Keyed by the video's content, so re-renders of the same video reuse the
+    # index and different videos with the same name never share one
+    loudness = get_loudness_index(f"{media.content_hash}:{audio_mixer.SAMPLE_RATE}", original_audio, audio_mixer.SAMPLE_RATE)
+
+    return bg_audio_generator, original_audio, loudness
+
+def mix_description_audio(original_audio, loudness, description_audio, ts_start_seconds: float, bg_music=None):
+    # Soundtrack for one still frame insert: the description, optional background
+    # music (a MusicClip), and short fades of the original track on both ends.
+    fade_duration = 0.5
+    bg_fade_duration = 0.2
+    insert_duration = audio_mixer.duration_of(description_audio)
+    original_duration = loudness.duration
+
+    e_time = ts_start_seconds + 5 if ts_start_seconds == 0 else ts_start_seconds
+    vid_max_volume = loudness.max_volume
+    still_frame_volume = loudness.peak(max(ts_start_seconds - 5, 0), e_time)
+    max_audio_desc_volume = audio_mixer.peak(description_audio)
+    if vid_max_volume == 0:
+        vid_max_volume = max_audio_desc_volume
+        still_frame_volume = vid_max_volume
+
+    logging.info(f"Calculated volumes: vid_max_volume={vid_max_volume}, max_audio_desc_volume={max_audio_desc_volume}, still_frame_volume={still_frame_volume}")
+
+    layers = [(description_audio, 0, audio_mixer.gain_to(vid_max_volume, max_audio_desc_volume))]
+    if bg_music is not None:
+        music_gain = audio_mixer.gain_to(vid_max_volume, bg_music.peak)
+        music = audio_mixer.fade_out(audio_mixer.fade_in(bg_music.samples, fade_duration), fade_duration)
+        layers.append((music, 0, (music_gain * 0.5) * 0.12 * (music_gain * 3)))
+    if ts_start_seconds + bg_fade_duration < int(original_duration):
+        logging.info(f"Fading out start audio original track from {ts_start_seconds} to {ts_start_seconds + bg_fade_duration}")
+        faded_out = audio_mixer.fade_out(audio_mixer.slice_seconds(original_audio, ts_start_seconds, ts_start_seconds + bg_fade_duration), bg_fade_duration)
+        layers.append((faded_out, 0, 1.0))
+    if ts_start_seconds > bg_fade_duration:
+        logging.info(f"Fading in end audio original track from {ts_start_seconds - bg_fade_duration} to {ts_start_seconds}")
+        faded_in = audio_mixer.fade_in(audio_mixer.slice_seconds(original_audio, ts_start_seconds - bg_fade_duration, ts_start_seconds), bg_fade_duration)
+        layers.append((faded_in, insert_duration - bg_fade_duration, 1.0))
+
+    return audio_mixer.overlay(insert_duration, layers)
+
+def load_media(video_path: str):
+    try:
+        media = probe_media(video_path)
+        if media.video_stream is None:
+            raise ValueError("no video stream")
+        logging.info(f"Loaded video file with duration: {media.duration}")
+        return media
+    except (OSError, subprocess.CalledProcessError, ValueError) as e:
         logging.error(f"Error loading video file {video_path}: {e}")
         raise ValueError(f"Error loading video file {video_path}: {e}")
 
-    description = response_body["description"]
-    pattern = re.compile(r'\[(\d{1,2}:\d{2}(?:\.\d{3})?)\] (.+)')
-    matches = pattern.findall(description)
-    logging.info(f"Found {len(matches)} matches in the description")
-
-    clips = []
+def build_render_plan(starts: list, durations: list, video_duration: float):
+    # The video is cut at every description start and a still frame as long as
+    # the description is inserted there. Durations may be None while unknown.
+    plan = []
     last_end = 0
-    added_timestamps = set()
-
-    for i, (start_timestamp, text) in enumerate(matches):
-        logging.info(f"Processing match {i}: start_timestamp={start_timestamp}, text={text}")
-        
-        ts_parts = start_timestamp.split(':')
-        ts_start_seconds = int(ts_parts[0]) * 60 + float(ts_parts[1])
-        logging.info(f"Calculated start time in seconds: {ts_start_seconds}")
-
-        audio_filename = f"temp/{unique_id}_{start_timestamp.replace(':', '-')}_to_*.wav"
-        audio_files = glob.glob(audio_filename)
-        if not audio_files:
-            raise FileNotFoundError(f"Audio file matching {audio_filename} not found")
-        audio_clip = AudioFileClip(audio_files[0])
-        logging.info(f"Loaded audio clip from {audio_files[0]} with duration: {audio_clip.duration}")
-        
-        insertion_time = ts_start_seconds
-        still_frame_time = ts_start_seconds
-        logging.warning(f"Inserting audio description at: {start_timestamp}")
-
-        if still_frame_time is not None:
-            if still_frame_time == insertion_time:
-                segment = video.subclip(last_end, still_frame_time)
-                clips.append(segment)
-                logging.info(f"Added video segment from {last_end} to {still_frame_time}")
-
-        if still_frame_time is not None and insertion_time == still_frame_time:
-            still_frame = video.get_frame(still_frame_time)
-            still_clip = ImageClip(still_frame).set_duration(audio_clip.duration)
-            still_clip = still_clip.set_audio(audio_clip)
-            logging.info(f"Created still clip with duration: {audio_clip.duration}")
-
-            if ts_start_seconds == 0: 
-                e_time = ts_start_seconds + 5 
-            else:
-                e_time = ts_start_seconds
-
-            fade_duration = 0.5
-            bg_fade_duration = 0.2
-            if original_audio_clip:
-                vid_max_volume = original_audio_clip.max_volume()
-                still_frame_volume = original_audio_clip.subclip(max(ts_start_seconds - 5, 0), e_time).max_volume()
-                if vid_max_volume == 0:
-                    vid_max_volume = audio_clip.max_volume()
-                    still_frame_volume = vid_max_volume
-                max_audio_desc_volume = audio_clip.max_volume()
-                
-                logging.info(f"Calculated volumes: vid_max_volume={vid_max_volume}, max_audio_desc_volume={max_audio_desc_volume}, still_frame_volume={still_frame_volume}")
-                
-                if add_bg_music and bg_audio_category:
-                    music_path = bg_audio_generator.generate_music_from_collection(
-                        duration=int(audio_clip.duration)
-                    )
-                    logging.info(f"Generated background music: {music_path}")
-
-                    generated_music_clip = AudioFileClip(music_path)
-                    generated_music_clip_max_volume = generated_music_clip.max_volume()
-                    generated_music_clip = generated_music_clip.volumex((vid_max_volume/generated_music_clip_max_volume)*0.5).audio_fadein(fade_duration).volumex(0.12).audio_fadeout(fade_duration).volumex((vid_max_volume/generated_music_clip_max_volume)*3)
-                    
-                    combined_audio_clips = [still_clip.audio.volumex(vid_max_volume/max_audio_desc_volume), generated_music_clip.set_start(0)]
-                    if ts_start_seconds + bg_fade_duration < int(original_audio_clip.duration):
-                        logging.info(f"Fading out start audio original track from {ts_start_seconds} to {ts_start_seconds + bg_fade_duration}")
-                        faded_out_start_audio_original_track = original_audio_clip.subclip(ts_start_seconds, ts_start_seconds + bg_fade_duration).audio_fadeout(bg_fade_duration)
-                        combined_audio_clips.append(faded_out_start_audio_original_track.set_start(0))
-                    if ts_start_seconds > bg_fade_duration:
-                        logging.info(f"Fading in end audio original track from {ts_start_seconds - bg_fade_duration} to {ts_start_seconds}")
-                        faded_in_end_audio_original_track = original_audio_clip.subclip(ts_start_seconds - bg_fade_duration, ts_start_seconds).audio_fadein(bg_fade_duration)
-                        combined_audio_clips.append(faded_in_end_audio_original_track.set_start(audio_clip.duration - bg_fade_duration))
-
-                    combined_audio = CompositeAudioClip(combined_audio_clips)
-
-                else:
-                    combined_audio_clips = [still_clip.audio.volumex(vid_max_volume/max_audio_desc_volume)]
-                    if ts_start_seconds + bg_fade_duration < int(original_audio_clip.duration):
-                        logging.info(f"Fading out start audio original track from {ts_start_seconds} to {ts_start_seconds + bg_fade_duration}")
-                        faded_out_start_audio_original_track = original_audio_clip.subclip(ts_start_seconds, ts_start_seconds + bg_fade_duration).audio_fadeout(bg_fade_duration)
-                        combined_audio_clips.append(faded_out_start_audio_original_track.set_start(0))
-                    if ts_start_seconds > bg_fade_duration:
-                        logging.info(f"Fading in end audio original track from {ts_start_seconds - bg_fade_duration} to {ts_start_seconds}")
-                        faded_in_end_audio_original_track = original_audio_clip.subclip(ts_start_seconds - bg_fade_duration, ts_start_seconds).audio_fadein(bg_fade_duration)
-                        combined_audio_clips.append(faded_in_end_audio_original_track.set_start(audio_clip.duration - bg_fade_duration))
-
-                    
-                    combined_audio = CompositeAudioClip(combined_audio_clips)
-                
-
-                still_clip = still_clip.set_audio(combined_audio)
-                logging.info(f"Set combined audio for still clip")
-            
-            clips.append(still_clip)
-            logging.info(f"Added still clip to clips")
-
-        added_timestamps.add(start_timestamp)
-        last_end = still_frame_time
-        logging.info(f"Updated last_end to {last_end}")
-
-    if last_end < int(video.duration):
-        final_segment_end = int(video.duration)
-        final_segment = video.subclip(last_end, final_segment_end)
-        clips.append(final_segment)
-        logging.info(f"Added final video segment from {last_end} to {final_segment_end}")
-
-    final_clip = concatenate_videoclips(clips)
+    for ts_start_seconds, description_duration in zip(starts, durations):
+        if ts_start_seconds > last_end:
+            plan.append(VideoSpan(last_end, ts_start_seconds))
+        plan.append(StillFrame(ts_start_seconds, description_duration))
+        last_end = ts_start_seconds
+
+    if last_end < int(video_duration):
+        plan.append(VideoSpan(last_end, int(video_duration)))
+    return plan
+
+def build_soundtrack(plan: list, speech: list, bg_audio_category: str, add_bg_music: str, bg_audio_generator, original_audio, loudness):
+    # The soundtrack follows the video plan: the original audio under spans and
+    # a mix of the description over each still, in plan order
+    timeline = audio_mixer.AudioTimeline()
+    stills = iter(speech)
+    for item in plan:
+        if isinstance(item, VideoSpan):
+            timeline.append(audio_mixer.slice_seconds(original_audio, item.start, item.end))
+            logging.info(f"Added video segment from {item.start} to {item.end}")
+            continue
+
+        result = next(stills)
+        logging.warning(f"Inserting audio description at: {result.timestamp}")
+        bg_music = None
+        if add_bg_music and bg_audio_category:
+            bg_music = bg_audio_generator.generate_music_from_collection(
+                duration=int(result.duration)
+            )
+            logging.info(f"Generated background music: {audio_mixer.duration_of(bg_music.samples)}s from {bg_audio_generator.selected_file}")
+
+        timeline.append(mix_description_audio(original_audio, loudness, result.samples, result.start, bg_music))
+        logging.info(f"Added still frame and mixed audio with duration: {result.duration}")
+    return timeline
+
+def write_final_video(plan: list, speech: list, output_path: str, workspace: Workspace, bg_audio_category: str, add_bg_music: str, bg_audio_generator, original_audio, loudness, render_video):
+    # render_video(video_only_path) renders the video track of the plan. The
+    # soundtrack is mixed in numpy and muxed into it at the end.
+    video_only_path = workspace.path("video_only.mp4")
+    mixed_audio_path = workspace.path("mixed_audio.wav")
     try:
-        final_clip.write_videofile(output_path, codec="libx264", audio_codec="aac")
+        with span("audio_mix"):
+            timeline = build_soundtrack(plan, speech, bg_audio_category, add_bg_music, bg_audio_generator, original_audio, loudness)
+            audio_mixer.write_wav(mixed_audio_path, timeline.render())
+        with span("encode"):
+            render_video(video_only_path)
+        workspace.check_quota()
+        with span("mux"):
+            audio_mixer.mux_audio(video_only_path, mixed_audio_path, output_path)
+        progress.report("render", 1.0)
         logging.info(f"Final video written to {output_path}")
     except Exception as e:
         logging.error(f"Error during final video writing: {e}")
         raise
+    finally:
+        for path in (video_only_path, mixed_audio_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    logging.info(f"Final video created successfully. Duration: {timeline.duration} seconds")
+
+def render_final_video(video_path: str, bg_audio_category: str, speech: list, output_path: str, workspace: Workspace, add_bg_music: str, bg_audio_generator, original_audio, loudness, media=None):
+    media = media or load_media(video_path)
+    logging.info(f"Rendering {len(speech)} audio descriptions")
+    plan = build_render_plan([result.start for result in speech], [result.duration for result in speech], media.duration)
+    write_final_video(
+        plan, speech, output_path, workspace, bg_audio_category, add_bg_music, bg_audio_generator, original_audio, loudness,
+        lambda video_only_path: render_video_track(video_path, plan, video_only_path, workspace, media),
+    )
+
+# Segment renders that failed and were redone serially by moviepy, exported
+# as viddyscribe_render_fallbacks_total. A steady rise means the fast path
+# is broken, not that a video was odd.
+render_fallbacks = 0
+render_fallbacks_lock = threading.Lock()
+
+def render_fallback(e):
+    global render_fallbacks
+    with render_fallbacks_lock:
+        render_fallbacks += 1
+    logging.warning(f"Segment render failed, falling back to a serial moviepy render: {e}", exc_info=e)
+
+def segment_renderer(video_path: str, workspace: Workspace, media, workers=None):
+    return SegmentRenderer(video_path, workspace.path("segments"), stream=media.video_stream, keyframes=media.keyframes, workers=workers, stream_copy=RENDER_MODE == "smart")
+
+def render_video_track(video_path: str, plan: list, video_only_path: str, workspace: Workspace, media):
+    if RENDER_MODE in ("smart", "parallel"):
+        try:
+            renderer = segment_renderer(video_path, workspace, media)
+            if RENDER_MODE == "smart" and not renderer.stream_copy:
+                logging.info(f"Stream copy not supported for codec {renderer.stream.get('codec_name')}, encoding all segments")
+            return renderer.render(plan, video_only_path, progress.reporter("render"))
+        except Exception as e:
+            render_fallback(e)
+    return render_video_track_moviepy(video_path, plan, video_only_path, media)
 
-    logging.info(f"Final video created successfully. Duration: {final_clip.duration} seconds")
\ No newline at end of file
+def render_video_track_moviepy(video_path: str, plan: list, video_only_path: str, media=None):
+    # Reuses the job's reader when there is one, it is closed with the job
+    video = media.video_clip() if media is not None else VideoFileClip(video_path, audio=False)
+    try:
+        clips = []
+        for item in plan:
+            if isinstance(item, VideoSpan):
+                clips.append(video.subclip(item.start, item.end))
+            else:
+                clips.append(ImageClip(video.get_frame(item.time)).set_duration(item.duration))
+        concatenate_videoclips(clips).write_videofile(video_only_path, codec="libx264", audio=False)
+    finally:
+        if media is None:
+            video.close()
+    return video_only_path
@@ -0,0 +1,71 @@
+import re
+
+# A timestamp as Gemini writes it: 0:05, 00:05.1, 1:02:03, 1:02:03,250
+TIMESTAMP = r"\d{1,2}(?::\d{2}){1,2}(?:[.,]\d{1,3})?"
+# An optionally bracketed or bolded timestamp, e.g. [0:05], (0:05), **0:05**
+BRACKETED = rf"[*_]*[\[(]?\s*({TIMESTAMP})\s*[\])]?[*_]*"
+# Optional bullet or list number, the start timestamp, an optional range end
+# and a separator before the text
+LINE = re.compile(
+    rf"^\s*(?:[-*•+]|\d+[.)])?\s*{BRACKETED}"
+    rf"(?:\s*(?:-|–|—|to)\s*{BRACKETED})?"
+    rf"\s*[:\-–—]?\s*(.*)$"
+)
+
+
+def parse_timestamp(value):
+    # Seconds from [[H:]M:]S[.fff]
+    seconds = 0.0
+    for part in value.replace(",", ".").split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def format_timestamp(seconds):
+    # The [M:SS.mmm] format the rest of the pipeline parses
+    millis = int(round(seconds * 1000))
+    minutes, millis = divmod(millis, 60000)
+    return f"{minutes}:{millis // 1000:02d}.{millis % 1000:03d}"
+
+
+def clean_text(text):
+    return text.strip().strip("*_").strip()
+
+
+def parse_description_lines(description):
+    # Returns [(seconds, text)] in the order found. A timestamp on a line of its
+    # own takes the next untimestamped line as its text.
+    entries = []
+    pending = None
+    for line in description.splitlines():
+        if line.strip().startswith("```"):
+            continue
+        match = LINE.match(line)
+        if match:
+            start, _, text = match.groups()
+            text = clean_text(text)
+            if text:
+                entries.append((parse_timestamp(start), text))
+                pending = None
+            else:
+                pending = parse_timestamp(start)
+        elif pending is not None and clean_text(line):
+            entries.append((pending, clean_text(line)))
+            pending = None
+    return entries
+
+
+def normalize_description(description, duration=None):
+    # Sorted, de-duplicated "[M:SS.mmm] text" lines clamped to the video, or
+    # None when no timestamped lines were found
+    entries = []
+    seen = set()
+    for seconds, text in sorted(parse_description_lines(description), key=lambda entry: entry[0]):
+        if duration is not None:
+            seconds = min(seconds, duration)
+        key = (format_timestamp(seconds), text)
+        if key in seen:
+            continue
+        seen.add(key)
+        entries.append(f"[{key[0]}] {text}")
+    return "\n".join(entries) if entries else None
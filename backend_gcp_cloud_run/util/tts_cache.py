@@ -0,0 +1,149 @@
+import os
+import json
+import uuid
+import hashlib
+import logging
+import threading
+from util.gcs_bucket import upload_to_gcs, download_from_gcs
+
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "/tmp/viddyscribe/tts_cache")
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# Optional shared tier, so every instance benefits from audio synthesized once
+TTS_CACHE_BUCKET = os.getenv("TTS_CACHE_BUCKET")
+TTS_CACHE_PREFIX = "tts_cache/"
+
+
+def tts_cache_key(provider, voice_id, model, text, output_format):
+    payload = json.dumps([provider, voice_id, model, text, output_format], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class TTSCache():
+    # Content-addressed cache of synthesized speech. Entries live on local disk
+    # with a size cap and LRU eviction (a hit refreshes the file's mtime), and
+    # optionally in a shared bucket behind it.
+
+    def __init__(self, directory, max_bytes, bucket_name=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.bucket_name = bucket_name
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            # Skip in-flight temporary files, entries are named by their key only
+            if "." in name:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+            with self._lock:
+                self.hits += 1
+            return data
+        except FileNotFoundError:
+            pass
+
+        data = self._get_shared(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.shared_hits += 1
+        if data is not None:
+            self._store_local(key, data)
+        return data
+
+    def put(self, key, data):
+        self._store_local(key, data)
+        self._put_shared(key, data)
+
+    def _store_local(self, key, data):
+        # Write to a temporary name first so readers never see a partial file
+        path = self._path(key)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        with self._lock:
+            # An overwritten entry no longer counts. The replace happens under
+            # the lock so concurrent puts of one key see each other's sizes.
+            try:
+                replaced = os.stat(path).st_size
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(temp_path, path)
+            self._size += len(data) - replaced
+            over_cap = self._size > self.max_bytes
+        if over_cap:
+            self.evict()
+
+    def evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._size = total
+
+    def _get_shared(self, key):
+        if not self.bucket_name:
+            return None
+        temp_path = f"{self._path(key)}.{uuid.uuid4().hex}.download"
+        try:
+            download_from_gcs(self.bucket_name, TTS_CACHE_PREFIX + key, temp_path)
+            with open(temp_path, "rb") as f:
+                return f.read()
+        except Exception:
+            return None
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _put_shared(self, key, data):
+        if not self.bucket_name:
+            return
+        try:
+            upload_to_gcs(self.bucket_name, self._path(key), TTS_CACHE_PREFIX + key)
+        except Exception as e:
+            logging.warning(f"Failed to upload TTS cache entry {key}: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "shared_hits": self.shared_hits, "misses": self.misses, "bytes": self._size}
+
+
+_tts_cache = None
+_tts_cache_lock = threading.Lock()
+
+
+def get_tts_cache():
+    global _tts_cache
+    with _tts_cache_lock:
+        if _tts_cache is None:
+            _tts_cache = TTSCache(TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES, TTS_CACHE_BUCKET)
+        return _tts_cache
@@ -0,0 +1,66 @@
+import os
+import asyncio
+import logging
+import threading
+import httpx
+from elevenlabs.client import AsyncElevenLabs
+
+# Connections kept open per provider, and how long an idle one stays open
+TTS_POOL_SIZE = int(os.getenv("TTS_POOL_SIZE", 10))
+TTS_KEEPALIVE_SECONDS = float(os.getenv("TTS_KEEPALIVE_SECONDS", 60))
+TTS_TIMEOUT_SECONDS = float(os.getenv("TTS_TIMEOUT_SECONDS", 60))
+
+
+def elevenlabs_client(http_client):
+    return AsyncElevenLabs(api_key=os.getenv("ELEVENLABS_API_KEY"), httpx_client=http_client)
+
+
+CLIENT_FACTORIES = {
+    "ElevenLabs": elevenlabs_client,
+}
+
+
+class TTSClientRegistry():
+    # One client per provider and event loop, so all jobs on the scheduler loop
+    # share warm keep-alive connections. httpx clients can't be shared across
+    # loops, and entries for loops that have been closed are dropped.
+
+    def __init__(self, pool_size=TTS_POOL_SIZE, keepalive_seconds=TTS_KEEPALIVE_SECONDS, timeout=TTS_TIMEOUT_SECONDS, factories=None):
+        self.pool_size = pool_size
+        self.keepalive_seconds = keepalive_seconds
+        self.timeout = timeout
+        self.factories = factories or CLIENT_FACTORIES
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def http_client(self):
+        limits = httpx.Limits(
+            max_connections=self.pool_size,
+            max_keepalive_connections=self.pool_size,
+            keepalive_expiry=self.keepalive_seconds,
+        )
+        return httpx.AsyncClient(limits=limits, timeout=self.timeout)
+
+    def get(self, provider):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            for key in [key for key in self._clients if key[1].is_closed()]:
+                del self._clients[key]
+            client = self._clients.get((provider, loop))
+            if client is None:
+                client = self.factories[provider](self.http_client())
+                self._clients[(provider, loop)] = client
+                logging.info(f"Created {provider} client with a pool of {self.pool_size} connections")
+            return client
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_tts_client(provider):
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = TTSClientRegistry()
+    return _registry.get(provider)
@@ -0,0 +1,202 @@
+import os
+import re
+import asyncio
+import time
+import uuid
+import shutil
+import socket
+import logging
+import tempfile
+import threading
+from util.job_store import current_owner, owner_is_alive
+
+# Bytes a single workspace may hold. A job's intermediates are the source
+# video, its analysis proxy, the rendered segments and the final output.
+WORKSPACE_QUOTA_BYTES = int(os.getenv("WORKSPACE_QUOTA_BYTES", 2 * 1024 * 1024 * 1024))
+# Workspaces of owners on other hosts are removed when their heartbeat is
+# older than this. The sweeper refreshes the heartbeat of open workspaces
+# every WORKSPACE_SWEEP_INTERVAL.
+WORKSPACE_MAX_AGE_SECONDS = int(os.getenv("WORKSPACE_MAX_AGE_SECONDS", 6 * 3600))
+WORKSPACE_SWEEP_INTERVAL = int(os.getenv("WORKSPACE_SWEEP_INTERVAL", 600))
+OWNER_FILE = ".owner"
+
+
+def default_workspace_dir(quota_bytes=WORKSPACE_QUOTA_BYTES):
+    # tmpfs keeps intermediates off the disk, but container runtimes often
+    # give /dev/shm only a few MB, so it is used only if a full workspace fits
+    try:
+        if os.access("/dev/shm", os.W_OK) and shutil.disk_usage("/dev/shm").total >= quota_bytes:
+            return "/dev/shm/viddyscribe/workspaces"
+    except OSError:
+        pass
+    return os.path.join(tempfile.gettempdir(), "viddyscribe", "workspaces")
+
+
+WORKSPACE_DIR = os.getenv("WORKSPACE_DIR") or default_workspace_dir()
+
+
+class WorkspaceQuotaExceeded(Exception):
+    def __init__(self, directory, used_bytes, quota_bytes):
+        super().__init__(f"Workspace {directory} holds {used_bytes} bytes, over its quota of {quota_bytes}")
+        self.used_bytes = used_bytes
+        self.quota_bytes = quota_bytes
+
+
+def directory_bytes(directory):
+    total = 0
+    for parent, _, files in os.walk(directory):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(parent, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+# Directories of the workspaces open in this process, the sweeper leaves them alone
+_active = set()
+_active_lock = threading.Lock()
+
+
+class Workspace():
+    # Scratch directory of one job. Stages ask it for paths instead of building
+    # them by hand, and everything in it is removed when the job ends, however
+    # it ends. An owner file names the process using it, so the sweeper can
+    # tell orphans of crashed processes from live jobs.
+
+    def __init__(self, job_id, root=None, quota_bytes=None):
+        self.job_id = job_id
+        self.root = root or WORKSPACE_DIR
+        self.quota_bytes = WORKSPACE_QUOTA_BYTES if quota_bytes is None else quota_bytes
+        safe_id = re.sub(r"[^A-Za-z0-9_.-]", "_", str(job_id))[:64]
+        self.directory = os.path.join(self.root, f"{safe_id}-{uuid.uuid4().hex[:12]}")
+
+    def __enter__(self):
+        os.makedirs(self.directory)
+        with _active_lock:
+            _active.add(self.directory)
+        with open(os.path.join(self.directory, OWNER_FILE), "w") as f:
+            f.write(current_owner())
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+        return False
+
+    # In a coroutine, creating and removing the directory tree run in a
+    # thread so they don't stall the event loop
+    async def __aenter__(self):
+        return await asyncio.to_thread(self.__enter__)
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await asyncio.to_thread(self.cleanup)
+        return False
+
+    def cleanup(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        with _active_lock:
+            _active.discard(self.directory)
+
+    def used_bytes(self):
+        return directory_bytes(self.directory)
+
+    def check_quota(self, extra_bytes=0):
+        used = self.used_bytes() + extra_bytes
+        if used > self.quota_bytes:
+            raise WorkspaceQuotaExceeded(self.directory, used, self.quota_bytes)
+        return used
+
+    def path(self, name):
+        # Every new path is a point where the job is about to write more, so
+        # the quota is checked here
+        self.check_quota()
+        return os.path.join(self.directory, name)
+
+
+def workspace_owner(directory):
+    try:
+        with open(os.path.join(directory, OWNER_FILE)) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def heartbeat_workspaces():
+    # Touches the owner files of this process's open workspaces. Another host
+    # sharing the root can't check if the owner lives, it goes by this.
+    with _active_lock:
+        directories = list(_active)
+    for directory in directories:
+        try:
+            os.utime(os.path.join(directory, OWNER_FILE))
+        except FileNotFoundError:
+            pass
+
+
+def sweep_workspaces(root=None, max_age=WORKSPACE_MAX_AGE_SECONDS, now=None):
+    # Removes workspaces left behind by crashed jobs: those of dead processes
+    # and those of this process that are no longer open. Workspaces of a live
+    # process on this host are kept however old. Owners on other hosts can't
+    # be checked, theirs are removed once their heartbeat is max_age old.
+    root = root or WORKSPACE_DIR
+    now = now or time.time()
+    me = current_owner()
+    host = socket.gethostname()
+    removed = []
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return removed
+    for name in names:
+        directory = os.path.join(root, name)
+        with _active_lock:
+            if directory in _active:
+                continue
+        owner = workspace_owner(directory)
+        try:
+            heartbeat = os.stat(os.path.join(directory, OWNER_FILE) if owner else directory).st_mtime
+        except FileNotFoundError:
+            continue
+        age = now - heartbeat
+        if owner is None:
+            # May be just being created
+            orphaned = age > max_age
+        elif owner == me:
+            orphaned = True
+        elif owner.rpartition(":")[0] == host:
+            orphaned = not owner_is_alive(owner)
+        else:
+            orphaned = age > max_age
+        if not orphaned:
+            continue
+        if os.path.isdir(directory):
+            shutil.rmtree(directory, ignore_errors=True)
+        else:
+            os.remove(directory)
+        removed.append(directory)
+        logging.info(f"Removed orphaned workspace {directory} (owner {owner}, last seen {age:.0f}s ago)")
+    return removed
+
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+def start_workspace_sweeper(interval=WORKSPACE_SWEEP_INTERVAL):
+    # Sweeps once right away, then every interval seconds in a daemon thread
+    global _sweeper
+
+    def run():
+        while True:
+            try:
+                heartbeat_workspaces()
+                sweep_workspaces()
+            except Exception as e:
+                logging.warning(f"Workspace sweep failed: {e}")
+            time.sleep(interval)
+
+    with _sweeper_lock:
+        if _sweeper is None:
+            _sweeper = threading.Thread(target=run, name="workspace-sweeper", daemon=True)
+            _sweeper.start()
+        return _sweeper
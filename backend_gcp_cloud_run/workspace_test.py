@@ -0,0 +1,81 @@
+import os
+import time
+import socket
+
+import pytest
+
+from util.job_store import current_owner
+from util.workspace import Workspace, WorkspaceQuotaExceeded, OWNER_FILE, heartbeat_workspaces, sweep_workspaces
+
+
+def test_workspace_is_removed_on_any_exit(tmp_path):
+    with Workspace("video_output.mp4", root=str(tmp_path)) as workspace:
+        with open(workspace.path("input.mp4"), "wb") as f:
+            f.write(b"video")
+        with open(os.path.join(workspace.directory, OWNER_FILE)) as f:
+            assert f.read() == current_owner()
+    assert not os.path.exists(workspace.directory)
+
+    with pytest.raises(RuntimeError):
+        with Workspace("video_output.mp4", root=str(tmp_path)) as workspace:
+            os.makedirs(workspace.path("segments"))
+            raise RuntimeError("render failed")
+    assert os.listdir(tmp_path) == []
+
+
+def test_paths_are_refused_over_the_quota(tmp_path):
+    with Workspace("../video output.mp4", root=str(tmp_path), quota_bytes=1000) as workspace:
+        assert os.path.dirname(workspace.directory) == str(tmp_path)
+        with open(workspace.path("input.mp4"), "wb") as f:
+            f.write(os.urandom(1500))
+        with pytest.raises(WorkspaceQuotaExceeded):
+            workspace.path("video_only.mp4")
+
+
+def test_sweeper_removes_orphans_only(tmp_path):
+    def orphan(name, owner, age=0):
+        directory = tmp_path / name
+        directory.mkdir()
+        if owner is not None:
+            (directory / OWNER_FILE).write_text(owner)
+        if age:
+            for path in (directory / OWNER_FILE, directory):
+                if path.exists():
+                    os.utime(path, (time.time() - age, time.time() - age))
+        return directory
+
+    dead = orphan("dead", f"{socket.gethostname()}:999999999")
+    leaked = orphan("leaked", current_owner())
+    expired = orphan("expired", "other-host:1", age=7200)
+    other_host = orphan("other_host", "other-host:1")
+    creating = orphan("creating", None)
+    # A long job of a live process on this host is never swept
+    long_job = orphan("long_job", f"{socket.gethostname()}:{os.getppid()}", age=7200)
+
+    with Workspace("video_output.mp4", root=str(tmp_path)) as workspace:
+        removed = sweep_workspaces(str(tmp_path), max_age=3600)
+        assert os.path.exists(workspace.directory)
+
+    assert sorted(removed) == sorted(str(path) for path in (dead, leaked, expired))
+    assert other_host.exists() and creating.exists() and long_job.exists()
+
+
+def test_heartbeat_keeps_open_workspaces_from_other_hosts_sweepers(tmp_path):
+    with Workspace("video_output.mp4", root=str(tmp_path)) as workspace:
+        owner_file = os.path.join(workspace.directory, OWNER_FILE)
+        os.utime(owner_file, (time.time() - 7200, time.time() - 7200))
+        heartbeat_workspaces()
+        assert time.time() - os.stat(owner_file).st_mtime < 60
+
+
+def test_async_workspace_is_removed_on_exit(tmp_path):
+    import asyncio
+
+    async def job():
+        async with Workspace("video_output.mp4", root=str(tmp_path)) as workspace:
+            with open(workspace.path("input.mp4"), "wb") as f:
+                f.write(b"video")
+        return workspace
+
+    workspace = asyncio.run(job())
+    assert not os.path.exists(workspace.directory)
@@ -165,34 +165,75 @@ const handleUpload = async () => {
       });
 
       const { output_video_name } = response.data;
-      console.log("Upload successful, starting to poll for status");
-      pollForStatus(output_video_name);
+      console.log("Upload successful, watching status");
+      watchStatus(output_video_name);
 
     } catch (error) {
       console.error("Error uploading file:", error);
-      setProcessingStatus("Error: Failed to upload file");
+      if (axios.isAxiosError(error) && error.response?.status === 429) {
+        const retryAfter = error.response.headers["retry-after"];
+        setProcessingStatus(`Error: Server is busy, please try again in ${retryAfter || "a few"} seconds`);
+      } else {
+        setProcessingStatus("Error: Failed to upload file");
+      }
       setLoading(false);
     }
   }
 };
 
 
+// Status updates are pushed over server-sent events. If the browser or the
+// server can't stream, fall back to polling.
+const watchStatus = (outputVideoName: string) => {
+  if (typeof EventSource === "undefined") {
+    pollForStatus(outputVideoName);
+    return;
+  }
+
+  const source = new EventSource(`${backendUrl}/status_events/${outputVideoName}`);
+  source.addEventListener("status", (event) => {
+    const { status, state } = JSON.parse((event as MessageEvent).data);
+    setProcessingStatus(status);
+    if (state === "completed") {
+      source.close();
+      pollForSignedUrl(outputVideoName);
+    } else if (state === "error") {
+      source.close();
+      setLoading(false);
+    }
+  });
+  source.onerror = () => {
+    // A dropped stream reconnects by itself, a refused one is closed
+    if (source.readyState === EventSource.CLOSED) {
+      pollForStatus(outputVideoName);
+    }
+  };
+};
+
 const pollForStatus = async (outputVideoName: string) => {
   const pollInterval = 10000;
+  // Even after a change, wait a little before the next long-poll, so a job
+  // that changes often doesn't poll faster than the plain interval would
+  const minPollDelay = 3000;
   const maxAttempts = 300;
   let attempts = 0;
+  let since: number | null = null;
 
   const checkStatus = async () => {
     try {
       console.log(`Checking status for: ${outputVideoName}, attempt: ${attempts}`);
-      const response = await axios.get(`${backendUrl}/update_status/${outputVideoName}`);
-      const { status } = response.data;
+      // Long-poll: the server answers as soon as the job changes
+      const query = since !== null ? `?since=${since}&wait=25` : "";
+      const response = await axios.get(`${backendUrl}/update_status/${outputVideoName}${query}`);
+      const { status, updated_at } = response.data;
       console.log(`Status response: ${status}`);
       setProcessingStatus(status);
+      const changed = updated_at !== since;
+      since = updated_at ?? null;
 
       if (status !== "Processing completed" && attempts < maxAttempts) {
         attempts++;
-        setTimeout(checkStatus, pollInterval);
+        setTimeout(checkStatus, changed ? minPollDelay : pollInterval);
       } else if (status === "Processing completed") {
         pollForSignedUrl(outputVideoName);
       }